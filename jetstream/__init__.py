@@ -35,9 +35,11 @@ log.addHandler(logging.NullHandler())
 
 
 # Package module imports
-from jetstream import backends, pipelines, runner, templates, utils, workflows
+from jetstream import accounting, backends, capacity, fusion, history, \
+    isolation, launcher, logstore, pipelines, routing, runner, simulation, \
+    sizing, spool, templates, utils, workflows
 from jetstream.projects import Project, init, is_project
-from jetstream.runner import Runner
+from jetstream.runner import Runner, MultiRunner
 from jetstream.templates import environment, render_template
 from jetstream.workflows import Workflow, Task, load_workflow, save_workflow, \
     random_workflow
@@ -0,0 +1,240 @@
+"""Resource usage accounting for finished tasks
+
+Slurm jobs get their resource usage from sacct (task.state['slurm_sacct']).
+For local tasks, the LocalBackend collects the rusage of each task process
+when it is reaped with os.wait4: max RSS, user/system cpu time, context
+switches and block I/O. It is saved in task.state['rusage'] with the same
+field names and formats as sacct, so local and Slurm tasks can be compared,
+and the runtime history reads either one.
+
+asyncio reaps child processes with os.waitpid, which throws the rusage away.
+`install_child_watcher` replaces the asyncio child watcher with one that
+uses os.wait4 and keeps the rusage of each pid until the backend asks for it.
+Child watchers are deprecated in Python 3.12 and removed in 3.14, so on those
+versions tasks started directly by the LocalBackend have no rusage. The
+process launcher helper uses os.wait4 itself and sends the rusage back with
+the exit status, on any version.
+
+The runner adds up the cpu time used and the cpu time requested (elapsed
+time x cpus) by every finished task, and reports the cpu efficiency of the
+run when it ends.
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+from jetstream import utils
+
+log = logging.getLogger(__name__)
+
+# Fields in struct rusage that are kept
+RUSAGE_FIELDS = (
+    'ru_utime',
+    'ru_stime',
+    'ru_maxrss',
+    'ru_inblock',
+    'ru_oublock',
+    'ru_nvcsw',
+    'ru_nivcsw',
+)
+
+# Size of the blocks counted by ru_inblock and ru_oublock
+BLOCK_SIZE = 512
+
+
+def rusage_dict(ru):
+    """Returns a dictionary of the fields kept from a struct rusage"""
+    return {f: getattr(ru, f) for f in RUSAGE_FIELDS}
+
+
+def returncode(status):
+    """Converts a wait status to a returncode like subprocess does, negative
+    numbers are the signal that ended the process"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def format_cpu_time(seconds):
+    """Formats seconds like sacct cpu times: [D-]HH:MM:SS.mmm"""
+    ms = int(round(seconds * 1000))
+    s, ms = divmod(ms, 1000)
+    m, s = divmod(s, 60)
+    h, m = divmod(m, 60)
+    d, h = divmod(h, 24)
+    value = f'{h:02d}:{m:02d}:{s:02d}.{ms:03d}'
+    return f'{d}-{value}' if d else value
+
+
+def parse_cpu_time(value):
+    """Returns the seconds in a sacct time value: [D-][HH:]MM:SS[.mmm].
+    Returns None if the value cannot be parsed."""
+    try:
+        days = 0
+        if '-' in value:
+            d, value = value.split('-', 1)
+            days = int(d)
+
+        parts = [float(p) for p in value.split(':')]
+        if not 2 <= len(parts) <= 3:
+            return None
+
+        seconds = 0
+        for p in parts:
+            seconds = seconds * 60 + p
+        return days * 86400 + seconds
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def sacct_record(pid, rc, elapsed, cpus, rusage):
+    """Returns the rusage of a local task in the same shape as the sacct
+    data saved for Slurm tasks. Context switches have no sacct field, so
+    they use the names from getrusage.
+
+    :param pid: Process id, used as the JobID
+    :param rc: Returncode of the process
+    :param elapsed: Wall time in seconds
+    :param cpus: Cpus requested by the task
+    :param rusage: rusage_dict of the process
+    """
+    if rc < 0:
+        state = 'CANCELLED' if rc == -15 else 'FAILED'
+        exit_code = f'0:{-rc}'
+    else:
+        state = 'COMPLETED' if rc == 0 else 'FAILED'
+        exit_code = f'{rc}:0'
+
+    utime = rusage['ru_utime']
+    stime = rusage['ru_stime']
+
+    return {
+        'JobID': str(pid),
+        'State': state,
+        'ExitCode': exit_code,
+        'AllocCPUS': str(cpus or 1),
+        'Elapsed': format_cpu_time(elapsed).split('.')[0],
+        # Slurm only counts whole seconds, but local tasks are often shorter
+        'ElapsedRaw': f'{elapsed:.3f}',
+        'UserCPU': format_cpu_time(utime),
+        'SystemCPU': format_cpu_time(stime),
+        'TotalCPU': format_cpu_time(utime + stime),
+        # ru_maxrss is kilobytes on Linux
+        'MaxRSS': f'{rusage["ru_maxrss"]}K',
+        'MaxDiskRead': f'{rusage["ru_inblock"] * BLOCK_SIZE // 1024}K',
+        'MaxDiskWrite': f'{rusage["ru_oublock"] * BLOCK_SIZE // 1024}K',
+        'VoluntaryContextSwitches': rusage['ru_nvcsw'],
+        'InvoluntaryContextSwitches': rusage['ru_nivcsw'],
+    }
+
+
+def cpu_usage(task):
+    """Returns (cpu seconds used, cpu seconds requested) for a finished task
+    from its local rusage or Slurm sacct data. Returns None if the task does
+    not have the TotalCPU and elapsed time needed."""
+    data = task.state.get('rusage') or task.state.get('slurm_sacct') or {}
+    used = parse_cpu_time(data.get('TotalCPU'))
+
+    try:
+        elapsed = float(data['ElapsedRaw'])
+    except (KeyError, TypeError, ValueError):
+        elapsed = utils.parse_elapsed(task.state.get('elapsed_time'))
+
+    if used is None or elapsed is None:
+        return None
+
+    try:
+        cpus = int(data.get('AllocCPUS') or task.directives.get('cpus') or 1)
+    except (TypeError, ValueError):
+        cpus = 1
+
+    return used, elapsed * cpus
+
+
+class UsageSummary:
+    """Adds up the cpu usage of finished tasks for the efficiency summary"""
+    def __init__(self):
+        self.tasks = 0
+        self.cpu_used = 0.0
+        self.cpu_requested = 0.0
+
+    def __repr__(self):
+        return f'<UsageSummary {self.tasks} tasks>'
+
+    def add(self, task):
+        usage = cpu_usage(task)
+
+        if usage is not None:
+            self.tasks += 1
+            self.cpu_used += usage[0]
+            self.cpu_requested += usage[1]
+
+    def efficiency(self):
+        """Cpu time used / cpu time requested, None if nothing was counted"""
+        if not self.cpu_requested:
+            return None
+        return self.cpu_used / self.cpu_requested
+
+    def summary(self):
+        used = format_cpu_time(self.cpu_used)
+        requested = format_cpu_time(self.cpu_requested)
+        efficiency = self.efficiency()
+        pct = f'{efficiency * 100:.1f}%' if efficiency is not None else 'n/a'
+        return f'{pct} ({used} cpu time used of {requested} requested, ' \
+               f'{self.tasks} tasks)'
+
+
+if sys.version_info < (3, 12) and hasattr(asyncio, 'SafeChildWatcher'):
+    class RusageChildWatcher(asyncio.SafeChildWatcher):
+        """asyncio child watcher that reaps processes with os.wait4 and keeps
+        their rusage in self.rusage until it is popped"""
+        def __init__(self):
+            super(RusageChildWatcher, self).__init__()
+            self.rusage = {}
+
+        def _do_waitpid(self, expected_pid):
+            try:
+                pid, status, ru = os.wait4(expected_pid, os.WNOHANG)
+            except ChildProcessError:
+                # Let asyncio report the unknown process
+                return super(RusageChildWatcher, self)._do_waitpid(
+                    expected_pid)
+
+            if pid == 0:
+                return
+
+            self.rusage[pid] = rusage_dict(ru)
+
+            try:
+                callback, args = self._callbacks.pop(pid)
+            except KeyError:
+                return
+
+            callback(pid, returncode(status), *args)
+else:
+    RusageChildWatcher = None
+
+
+def install_child_watcher():
+    """Makes asyncio reap child processes with a RusageChildWatcher, and
+    returns it. Returns None if that is not possible here: outside the main
+    thread, or on Python 3.12 and later where child watchers are deprecated.
+    This should be called before any asyncio subprocesses are started,
+    processes watched by the previous watcher would not be reaped."""
+    if RusageChildWatcher is None \
+            or threading.current_thread() is not threading.main_thread():
+        log.debug('Cannot collect rusage for local tasks here')
+        return None
+
+    current = asyncio.get_child_watcher()
+
+    if isinstance(current, RusageChildWatcher):
+        return current
+
+    # The old watcher removes the SIGCHLD handler from the loop when it is
+    # closed, so the new one is attached after it is replaced
+    watcher = RusageChildWatcher()
+    asyncio.set_child_watcher(watcher)
+    watcher.attach_loop(asyncio.get_event_loop())
+    return watcher
@@ -5,7 +5,13 @@ import random
 class BaseBackend(object):
     """To subclass a backend, just override the "spawn" method with a
     coroutine. max_concurrency can be set to limit the number of jobs
-    that a backend will allow to spawn concurrently."""
+    that a backend will allow to spawn concurrently. Backends that can run
+    tasks with a "call" directive (Python callables) set runs_calls.
+    Backends that can hold a task until its predecessors finish set
+    submit_ahead to the number of levels they accept (see is_submitted)."""
+    runs_calls = False
+    submit_ahead = 0
+
     def __init__(self):
         self.runner = None
         self.coroutines = tuple()
@@ -20,20 +26,35 @@ class BaseBackend(object):
         spot to clean up any outstanding jobs etc.."""
         pass
 
+    def close(self):
+        """Called when the run is finished, after cancel if there were
+        errors. Release any resources held by the backend here."""
+        pass
+
+    def is_saturated(self):
+        """True if new tasks would have to wait for resources. The runner
+        uses this to send overflow tasks to another backend."""
+        return False
+
+    def is_submitted(self, task):
+        """True if a task is in flight on this backend, and tasks submitted
+        now can be held until it completes. Used by the runner for backends
+        with submit_ahead."""
+        return False
+
     def get_fd_paths(self, task):
         """When working inside project, task outputs will be directed into
-        log files inside project.logs_dir. But task.stdout/stderr should
+        log files in the project log store (see jetstream.logstore). But task.stdout/stderr should
         override this behavior. Backend subclasses should use this method to
         get the correct output paths for a task."""
         stdin = task.directives.get('stdin')
+        project = self.runner.get_project(task)
 
-        if self.runner.project:
+        if project:
             if 'stdout' in task.directives:
                 stdout = task.directives['stdout']
             else:
-                filename = f'{task.name}.log'
-                logs_dir = self.runner.project.paths.logs_dir
-                stdout = os.path.join(logs_dir, filename)
+                stdout = project.log_store.path(task.name)
 
             if 'stderr' in task.directives:
                 stderr = task.directives['stderr']
@@ -45,6 +66,24 @@ class BaseBackend(object):
 
         return stdin, stdout, stderr
 
+    def get_cwd(self, task):
+        """Tasks in a project are run from the project directory. This returns
+        the project path for a task, or None if it does not have a project."""
+        project = self.runner.get_project(task)
+
+        if project:
+            return project.path
+
+    def get_env(self, task):
+        """Returns the environment variables for a task. Tasks in a project
+        get JS_PROJECT_PATH for their own project, even when the runner is
+        handling several projects at once. None means inherit the runner
+        environment unchanged."""
+        project = self.runner.get_project(task)
+
+        if project:
+            return dict(os.environ, JS_PROJECT_PATH=project.path)
+
 
 class PoisonedBackend(BaseBackend):
     async def spawn(self, something):
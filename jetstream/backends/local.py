@@ -1,13 +1,114 @@
 import logging
 import asyncio
+import functools
+import json
+import os
+import sys
+import time
+import traceback
 import jetstream
 from asyncio import BoundedSemaphore, create_subprocess_shell, CancelledError
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from jetstream import accounting, isolation
+from jetstream.concurrency import MemoryLimit
 
 log = logging.getLogger('jetstream.local')
 
 
+def _redirect(fd, fp):
+    """Points a file descriptor at an open file, returns a copy of the
+    original descriptor to restore it with"""
+    saved = os.dup(fd)
+    os.dup2(fp.fileno(), fd)
+    return saved
+
+
+def run_call(path, args, kwargs, stdin, stdout, stderr, cwd, env):
+    """Runs a call directive in a pool worker, with the task stdin/stdout/
+    stderr, working directory and environment. The worker is restored
+    afterwards so that it can be reused. Returns (returncode, value), where
+    value is the return value of the callable, or its repr if that cannot be
+    serialized as JSON."""
+    saved_fds = {}
+    saved_streams = (sys.stdin, sys.stdout, sys.stderr)
+    open_fps = []
+    saved_cwd = os.getcwd()
+    saved_env = dict(os.environ)
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    try:
+        # Both the file descriptors and the Python streams are redirected, so
+        # output from child processes ends up in the task logs as well
+        if stdin:
+            sys.stdin = open(stdin, 'r')
+            open_fps.append(sys.stdin)
+            saved_fds[0] = _redirect(0, sys.stdin)
+
+        if stdout:
+            sys.stdout = open(stdout, 'w')
+            open_fps.append(sys.stdout)
+            saved_fds[1] = _redirect(1, sys.stdout)
+
+        if stderr:
+            if stderr == stdout:
+                sys.stderr = sys.stdout
+            else:
+                sys.stderr = open(stderr, 'w')
+                open_fps.append(sys.stderr)
+            saved_fds[2] = _redirect(2, sys.stderr)
+
+        if cwd:
+            os.chdir(cwd)
+
+        if env is not None:
+            os.environ.clear()
+            os.environ.update(env)
+
+        try:
+            fn = jetstream.utils.dynamic_import(path)
+            value = fn(*(args or ()), **(kwargs or {}))
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                return e.code or 0, None
+            print(e.code, file=sys.stderr)
+            return 1, None
+        except BaseException:
+            traceback.print_exc()
+            return 1, None
+
+        try:
+            json.dumps(value)
+        except (TypeError, ValueError):
+            value = repr(value)
+
+        return 0, value
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        for fd, saved in saved_fds.items():
+            os.dup2(saved, fd)
+            os.close(saved)
+
+        for fp in open_fps:
+            fp.close()
+
+        sys.stdin, sys.stdout, sys.stderr = saved_streams
+
+        os.chdir(saved_cwd)
+        os.environ.clear()
+        os.environ.update(saved_env)
+
+
 class LocalBackend(jetstream.backends.BaseBackend):
-    def __init__(self, cpus=None, blocking_io_penalty=None):
+    runs_calls = True
+
+    def __init__(self, cpus=None, mem=None, blocking_io_penalty=None,
+                 launcher=None, call_workers=None, isolate=None,
+                 cgroup_root=None):
         """The LocalBackend executes tasks as processes on the local machine.
 
         This contains a semaphore that limits tasks by the number of cpus
@@ -16,29 +117,164 @@ class LocalBackend(jetstream.backends.BaseBackend):
 
         :param cpus: If this is None, the number of available CPUs will be
             guessed. This cannot be changed after starting the backend.
-        :param blocking_io_penalty: Delay (in seconds) when a BlockingIOError
-            prevents a new process from spawning.
+        :param mem: Memory shared by tasks with a mem directive, in the same
+            format as the directive. If this is None, the memory this
+            process may use is detected (see jetstream.capacity).
+        :param blocking_io_penalty: Max delay (in seconds) when a
+            BlockingIOError prevents a new process from spawning. Retries
+            back off exponentially up to this delay.
+        :param launcher: Spawn processes from a small helper process instead
+            of the runner process (see jetstream.launcher)
+        :param call_workers: Worker processes for tasks with a call
+            directive, defaults to the number of cpus. Workers are started
+            the first time a call is run, and reused until the run ends.
+        :param isolate: Pin each task to its own cpus, and limit it with a
+            cgroup where cgroup v2 is writable (see jetstream.isolation)
+        :param cgroup_root: Cgroup directory for task cgroups, defaults to
+            the cgroup of the runner
         :param max_concurrency: Max concurrency limit
         """
         super(LocalBackend, self).__init__()
         self.cpus = cpus \
                     or jetstream.settings['backends']['local']['cpus'] \
                     or jetstream.utils.guess_local_cpus()
+        self.mem = jetstream.utils.parse_mem(
+            mem or jetstream.settings['backends']['local']['mem'].get()) \
+            or jetstream.capacity.detect().mem
         self.bip = blocking_io_penalty \
                    or jetstream.settings['backends']['local']['blocking_io_penalty'].get(int)
+        if launcher is None:
+            launcher = jetstream.settings['backends']['local']['launcher'].get(bool)
+        self.launcher = jetstream.launcher.get_launcher() if launcher else None
+        self.call_workers = call_workers \
+                            or jetstream.settings['backends']['local']['call_workers'].get() \
+                            or self.cpus
+        self._pool = None
+        if isolate is None:
+            isolate = jetstream.settings['backends']['local']['isolate'].get(bool)
+        self.cpu_allocator = None
+        self.cgroups = None
+        if isolate:
+            self._setup_isolation(cgroup_root
+                or jetstream.settings['backends']['local']['cgroup_root'].get())
+        if self.launcher is None:
+            # Processes started by the launcher are reaped with wait4 there
+            self.child_watcher = accounting.install_child_watcher()
+        else:
+            self.child_watcher = None
         self._cpu_sem = BoundedSemaphore(self.cpus)
-        log.info(f'LocalBackend initialized with {self.cpus} cpus')
+        self._mem_limit = MemoryLimit(self.mem) if self.mem else None
+        log.info(f'LocalBackend initialized with {self.cpus} cpus, '
+                 f'{self.mem or "unlimited"} MB mem')
+
+    def is_saturated(self):
+        return self._cpu_sem.locked() \
+            or (self._mem_limit is not None and self._mem_limit.locked())
+
+    async def reserve_mem(self, task):
+        """Waits until the memory for a task is free, and returns the
+        megabytes reserved"""
+        mem = jetstream.utils.parse_mem(task.directives.get('mem'))
+
+        if not mem or self._mem_limit is None:
+            return 0
+
+        if mem > self.mem:
+            log.warning(f'{task.name} mem ({mem} MB) is greater than the '
+                        f'available mem ({self.mem} MB), it will run alone')
+
+        return await self._mem_limit.acquire(mem)
+
+    def release_mem(self, mem):
+        if mem:
+            self._mem_limit.release(mem)
+
+    def _setup_isolation(self, cgroup_root=None):
+        if hasattr(os, 'sched_setaffinity'):
+            self.cpu_allocator = isolation.CpuAllocator()
+            log.info(f'Tasks will be pinned to cpus: {self.cpu_allocator}')
+        else:
+            log.warning('Cpu affinity is not supported on this platform')
+
+        cgroups = isolation.Cgroups(cgroup_root)
+        if cgroups.setup():
+            self.cgroups = cgroups
+
+    def cancel(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+        if self.cgroups is not None:
+            self.cgroups.close()
+
+    def record_rusage(self, task, p, elapsed):
+        """Saves the rusage of a finished task process in task.state, in the
+        same shape as Slurm sacct data (see jetstream.accounting)"""
+        rusage = getattr(p, 'rusage', None)
+
+        if rusage is None and self.child_watcher is not None:
+            rusage = self.child_watcher.rusage.pop(p.pid, None)
+
+        if rusage is not None:
+            task.state['rusage'] = accounting.sacct_record(
+                p.pid,
+                p.returncode,
+                elapsed,
+                task.directives.get('cpus'),
+                rusage
+            )
+
+    def isolate(self, task):
+        """Assigns cpus and a cgroup to a task when isolation is enabled.
+        Returns the kwargs for isolation.enter, these are also recorded in
+        task.state as cpu_affinity and cgroup."""
+        cpus = task.directives.get('cpus', 0)
+        mem = jetstream.utils.parse_mem(task.directives.get('mem'))
+        kwargs = {}
+
+        if self.cpu_allocator is not None and cpus:
+            kwargs['affinity'] = self.cpu_allocator.acquire(cpus)
+            task.state['cpu_affinity'] = kwargs['affinity']
+
+        if self.cgroups is not None and (cpus or mem):
+            try:
+                kwargs['cgroup'] = self.cgroups.create(
+                    task.name, cpus=cpus, mem=mem * 2 ** 20 if mem else None)
+                task.state['cgroup'] = kwargs['cgroup']
+            except OSError as e:
+                log.warning(f'Failed to create cgroup for {task.name}: {e}')
+
+        return kwargs
+
+    def release(self, isolated):
+        """Frees the cpus and cgroup assigned by isolate"""
+        if 'affinity' in isolated:
+            self.cpu_allocator.release(isolated['affinity'])
+
+        if 'cgroup' in isolated:
+            self.cgroups.remove(isolated['cgroup'])
 
     async def spawn(self, task):
         log.debug('Spawn: {}'.format(task))
 
+        if task.directives.get('call'):
+            return await self.spawn_call(task)
+
         if 'cmd' not in task.directives:
             return task.complete()
 
         cmd = task.directives['cmd']
         cpus = task.directives.get('cpus', 0)
         cpus_reserved = 0
+        mem_reserved = 0
         open_fps = list()
+        isolated = {}
 
         if cpus > self.cpus:
             raise RuntimeError('Task cpus greater than available cpus')
@@ -48,32 +284,53 @@ class LocalBackend(jetstream.backends.BaseBackend):
                 await self._cpu_sem.acquire()
                 cpus_reserved += 1
 
+            mem_reserved = await self.reserve_mem(task)
             stdin, stdout, stderr = self.get_fd_paths(task)
+            isolated = self.isolate(task)
 
-            if stdin:
-                stdin_fp = open(stdin, 'r')
-                open_fps.append(stdin_fp)
+            if self.launcher:
+                p = await self.launch(
+                    cmd,
+                    stdin=stdin,
+                    stdout=stdout,
+                    stderr=stderr,
+                    cwd=self.get_cwd(task),
+                    env=self.get_env(task),
+                    **isolated
+                )
             else:
-                stdin_fp = None
+                if stdin:
+                    stdin_fp = open(stdin, 'r')
+                    open_fps.append(stdin_fp)
+                else:
+                    stdin_fp = None
 
-            if stdout:
-                stdout_fp = open(stdout, 'w')
-                open_fps.append(stdout_fp)
-            else:
-                stdout_fp = None
+                if stdout:
+                    stdout_fp = open(stdout, 'w')
+                    open_fps.append(stdout_fp)
+                else:
+                    stdout_fp = None
 
-            if stderr:
-                stderr_fp = open(stderr, 'w')
-                open_fps.append(stderr_fp)
-            else:
-                stderr_fp = None
+                if stderr:
+                    stderr_fp = open(stderr, 'w')
+                    open_fps.append(stderr_fp)
+                else:
+                    stderr_fp = None
 
-            p = await self.subprocess_sh(
-                cmd,
-                stdin=stdin_fp,
-                stdout=stdout_fp,
-                stderr=stderr_fp
-            )
+                if isolated:
+                    preexec_fn = functools.partial(isolation.enter, **isolated)
+                else:
+                    preexec_fn = None
+
+                p = await self.subprocess_sh(
+                    cmd,
+                    stdin=stdin_fp,
+                    stdout=stdout_fp,
+                    stderr=stderr_fp,
+                    cwd=self.get_cwd(task),
+                    env=self.get_env(task),
+                    preexec_fn=preexec_fn
+                )
 
             task.state.update(
                 stdout_path=stdout,
@@ -82,7 +339,9 @@ class LocalBackend(jetstream.backends.BaseBackend):
             )
 
             log.info(f'LocalBackend spawned({p.pid}): {task.name}')
+            started = time.monotonic()
             rc = await p.wait()
+            self.record_rusage(task, p, time.monotonic() - started)
 
             if rc != 0:
                 log.info(f'Failed: {task.name}')
@@ -93,10 +352,87 @@ class LocalBackend(jetstream.backends.BaseBackend):
         except CancelledError:
             task.state['err'] = 'Runner cancelled Backend.spawn()'
             return task.fail(-15)
+        except ConnectionError as e:
+            log.error(f'Lost process launcher while running {task.name}: {e}')
+            task.state['err'] = f'Process launcher error: {e}'
+            return task.fail(-1)
         finally:
             for fp in open_fps:
                 fp.close()
 
+            self.release(isolated)
+            self.release_mem(mem_reserved)
+
+            for i in range(cpus_reserved):
+                self._cpu_sem.release()
+
+            return task
+
+    async def spawn_call(self, task):
+        """Runs a task with a call directive in the worker pool. The task
+        fails if the callable raises an exception, or if the worker dies."""
+        call = task.directives['call']
+        cpus = task.directives.get('cpus', 0)
+        cpus_reserved = 0
+        mem_reserved = 0
+
+        if cpus > self.cpus:
+            raise RuntimeError('Task cpus greater than available cpus')
+
+        try:
+            for i in range(task.directives.get('cpus', 0)):
+                await self._cpu_sem.acquire()
+                cpus_reserved += 1
+
+            mem_reserved = await self.reserve_mem(task)
+            stdin, stdout, stderr = self.get_fd_paths(task)
+
+            if self._pool is None:
+                log.info(f'Starting {self.call_workers} call workers')
+                self._pool = ProcessPoolExecutor(self.call_workers)
+
+            task.state.update(
+                stdout_path=stdout,
+                stderr_path=stderr,
+                label=f'Call({call})',
+            )
+
+            log.info(f'LocalBackend calling: {task.name}')
+
+            try:
+                rc, value = await self.runner.loop.run_in_executor(
+                    self._pool,
+                    run_call,
+                    call,
+                    task.directives.get('args'),
+                    task.directives.get('kwargs'),
+                    stdin,
+                    stdout,
+                    stderr,
+                    self.get_cwd(task),
+                    self.get_env(task)
+                )
+            except BrokenProcessPool as e:
+                log.error(f'Call worker died while running {task.name}: {e}')
+                task.state['err'] = f'Call worker died: {e}'
+                self._pool = None
+                return task.fail(-1)
+
+            if value is not None:
+                task.state['returned'] = value
+
+            if rc != 0:
+                log.info(f'Failed: {task.name}')
+                return task.fail(rc)
+            else:
+                log.info(f'Complete: {task.name}')
+                return task.complete(rc)
+        except CancelledError:
+            task.state['err'] = 'Runner cancelled Backend.spawn()'
+            return task.fail(-15)
+        finally:
+            self.release_mem(mem_reserved)
+
             for i in range(cpus_reserved):
                 self._cpu_sem.release()
 
@@ -105,12 +441,13 @@ class LocalBackend(jetstream.backends.BaseBackend):
     async def subprocess_sh(
             self, args, *, stdin=None, stdout=None, stderr=None,
             cwd=None, encoding=None, errors=None, env=None,
-            loop=None, executable='/bin/bash'):
+            loop=None, executable='/bin/bash', preexec_fn=None):
         """Asynchronous version of subprocess.run
 
         This will always use a shell to launch the subprocess, and it prefers
         /bin/bash (can be changed via arguments)"""
         log.debug(f'subprocess_sh:\n{args}')
+        attempt = 0
 
         while 1:
             try:
@@ -124,11 +461,51 @@ class LocalBackend(jetstream.backends.BaseBackend):
                     errors=errors,
                     env=env,
                     loop=loop,
-                    executable=executable
+                    executable=executable,
+                    preexec_fn=preexec_fn
                 )
                 break
             except BlockingIOError as e:
-                log.warning(f'System refusing new processes: {e}')
-                await asyncio.sleep(self.bip)
+                await self._fork_failed(attempt, e)
+                attempt += 1
 
         return p
+
+    async def launch(self, args, *, stdin=None, stdout=None, stderr=None,
+                     cwd=None, env=None, executable='/bin/bash',
+                     affinity=None, cgroup=None):
+        """Same as subprocess_sh, but the process is started by the process
+        launcher, and stdin/stdout/stderr are paths instead of files. The
+        affinity and cgroup are passed to isolation.enter in the child."""
+        log.debug(f'launch:\n{args}')
+        attempt = 0
+
+        while 1:
+            try:
+                return await self.launcher.spawn(
+                    args,
+                    stdin=stdin,
+                    stdout=stdout,
+                    stderr=stderr,
+                    cwd=cwd,
+                    env=env,
+                    executable=executable,
+                    affinity=affinity,
+                    cgroup=cgroup
+                )
+            except BlockingIOError as e:
+                await self._fork_failed(attempt, e)
+                attempt += 1
+
+    async def _fork_failed(self, attempt, error):
+        """Backs off after a BlockingIOError when spawning a process"""
+        # Let the adaptive concurrency controller know, so it can lower the
+        # number of tasks in flight
+        concurrency = getattr(self.runner, 'concurrency', None)
+        if concurrency is not None:
+            concurrency.fork_failed()
+
+        delay = min(self.bip, 2 ** attempt)
+        log.warning(f'System refusing new processes, retrying in '
+                    f'{delay}s: {error}')
+        await asyncio.sleep(delay)
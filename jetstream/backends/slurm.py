@@ -1,4 +1,5 @@
 import asyncio
+import getpass
 import itertools
 import json
 import logging
@@ -7,16 +8,28 @@ import re
 import shlex
 import shutil
 import subprocess
+import sys
 import tempfile
 import time
 from asyncio.subprocess import PIPE
-from datetime import datetime, timedelta
+from datetime import datetime
 from jetstream.backends import BaseBackend
-from jetstream import settings
+from jetstream.fusion import redirects
+from jetstream.concurrency import ConcurrencyLimit, TokenBucket
+from jetstream import routing, settings, spool, utils
+from jetstream.routing import PartitionRouter
+from jetstream.sizing import SizingPolicy
 
 log = logging.getLogger('jetstream.slurm')
 sacct_delimiter = '\037'
-job_id_pattern = re.compile(r"^(?P<jobid>\d+)(_(?P<arraystepid>\d+))?(\.(?P<stepid>(\d+|batch|extern)))?$")
+job_id_pattern = re.compile(r"^(?P<jobid>\d+)(_(?P<arraystepid>\d+|\[[^\]]*\]))?(\.(?P<stepid>(\d+|batch|extern)))?$")
+# sbatch errors when the user has reached the MaxSubmitJobs limit of their
+# association (AssocMaxSubmitJobLimit) or QOS (QOSMaxSubmitJobPerUserLimit)
+submit_limit_pattern = re.compile(r'MaxSubmitJob|job submit limit')
+
+# sacct fields the job monitor always needs, the sacct_fields setting adds
+# the fields saved in task.state['slurm_sacct']
+SACCT_REQUIRED_FIELDS = ('JobID', 'State', 'ExitCode')
 
 
 class SlurmBackend(BaseBackend):
@@ -31,23 +44,159 @@ class SlurmBackend(BaseBackend):
 
     def __init__(self, sacct_frequency=60, sbatch_delay=0.1,
                  sbatch_executable=None, sacct_fields=('JobID', 'Elapsed'),
-                 job_monitor_max_fails=5):
+                 job_monitor_max_fails=5, max_pending=None, sbatch_rate=None,
+                 sbatch_burst=10, sbatch_parallel=4, sbatch_retries=10,
+                 sbatch_max_retry_delay=60, max_submit_jobs=None,
+                 array_max_size=1000, array_delay=1, sacct_executable=None,
+                 squeue_executable=None, scancel_executable=None,
+                 sacctmgr_executable=None, sacct_starttime_margin=3600,
+                 submit_ahead=0, spool=False, spool_dir=None,
+                 spool_scan_interval=5, spool_reconcile_frequency=300,
+                 sacct_max_staleness=600, sacct_backoff=0.1,
+                 sacct_latency_factor=10, sizing=False, sizing_percentile=95,
+                 sizing_margin=0.25, sizing_min_count=5, sizing_escalation=2,
+                 sizing_min_mem='256M', sizing_min_walltime='10',
+                 partitions=None, partition_refresh=30,
+                 sinfo_executable=None):
         """SlurmBackend submits tasks as jobs to a Slurm batch cluster
 
-        :param sacct_frequency: Frequency in seconds that job updates will
-        be requested from sacct
-        :param sbatch: path to the sbatch binary if not on PATH
+        :param sacct_frequency: Shortest time in seconds between job
+        updates from squeue/sacct, the interval adapts to the jobs that are
+        being tracked (see schedule_check)
+        :param sacct_max_staleness: Longest time in seconds that a job goes
+        without an update, even while jobs are being submitted
+        :param sacct_backoff: Jobs are checked again after this fraction of
+        the time they have been running (or queued), or of their expected
+        remaining time when it is known
+        :param sacct_latency_factor: Polls are at least this many times the
+        duration of the last polls apart, so that a slow slurmdbd is not
+        kept busy
+        :param sbatch_delay: Seconds between submissions, used for the
+        submission rate when sbatch_rate is not given
+        :param sbatch_executable: path to the sbatch binary if not on PATH,
+        the sacct, squeue, scancel, sacctmgr and sinfo executables can be
+        given the same way (see jetstream.fakeslurm)
+        :param max_pending: The queue is considered saturated when this many
+        jobs are waiting to start, None means it is never saturated
+        :param sbatch_rate: Submissions per second
+        :param sbatch_burst: Submissions allowed at once after an idle period
+        :param sbatch_parallel: sbatch processes running at once
+        :param sbatch_retries: Retries for a failed submission, with
+        exponential backoff up to sbatch_max_retry_delay seconds
+        :param max_submit_jobs: Jobs from this run allowed in the queue at
+        once, None uses the MaxSubmitJobs limit of the user (see SubmitQueue)
+        :param array_max_size: Largest job array for tasks with the same
+        resources, 0 or None submits every task as its own job
+        :param array_delay: Seconds that tasks are collected for an array
+        before it is submitted
+        :param sacct_starttime_margin: sacct only searches jobs that started
+        after the earliest submission being looked up, less this many
+        seconds for clock differences
+        :param submit_ahead: Tasks are submitted while their predecessors
+        are still in the queue, up to this many levels ahead, with
+        --dependency=afterok on the predecessor jobs. 0 waits for
+        predecessors to complete.
+        :param spool: Jobs write an exit record when their cmd finishes, and
+        tasks are completed as soon as it appears (see jetstream.spool)
+        instead of at the next sacct poll
+        :param spool_dir: Directory for exit records of tasks that are not
+        in a project, tasks in a project use <project>/jetstream/spool. It
+        has to be on a filesystem shared with the compute nodes.
+        :param spool_scan_interval: Seconds between scans of the spool
+        directories, for records that inotify does not report (NFS)
+        :param spool_reconcile_frequency: Frequency in seconds of sacct polls
+        while every job in the queue writes an exit record. These find the
+        jobs that ended without one (cancelled, timed out, node failures).
+        :param sizing: Request mem and walltime from the runtime history of
+        the tasks instead of their directives, which become the upper limits
+        (see jetstream.sizing). Jobs that hit a sized limit are submitted
+        again with the limit multiplied by sizing_escalation.
+        :param sizing_percentile: Percentile of previous runs requested
+        :param sizing_margin: Fraction added to the percentile
+        :param sizing_min_count: Previous runs needed to size a task
+        :param sizing_min_mem: Smallest sized mem request
+        :param sizing_min_walltime: Smallest sized walltime request
+        :param partitions: Candidate partitions, in order of preference. Each
+        job is submitted to the one where it is expected to start soonest
+        (see jetstream.routing), unless its sbatch_args give a partition.
+        None submits every job to the partition in its sbatch_args, or the
+        default partition.
+        :param partition_refresh: Seconds between sinfo/squeue snapshots of
+        the candidate partitions
         """
         super(SlurmBackend, self).__init__()
         self.sbatch_executable = sbatch_executable
         self.sacct_frequency = sacct_frequency
-        self.sacct_fields = sacct_fields
         self.sbatch_delay = sbatch_delay
         self.job_monitor_max_fails = job_monitor_max_fails
+        self.max_pending = max_pending
+        self.array_max_size = array_max_size
+        self.array_delay = array_delay
+        self.sacct_executable = sacct_executable or 'sacct'
+        self.squeue_executable = squeue_executable or 'squeue'
+        self.scancel_executable = scancel_executable or 'scancel'
+        self.sinfo_executable = sinfo_executable or 'sinfo'
+        self.sacct_starttime_margin = sacct_starttime_margin
+        self.submit_ahead = submit_ahead or 0
+        self.spool = spool
+        self.spool_dir = spool_dir
+        self.spool_scan_interval = spool_scan_interval
+        self.spool_reconcile_frequency = spool_reconcile_frequency
+        self.sacct_max_staleness = sacct_max_staleness
+        self.sacct_backoff = sacct_backoff
+        self.sacct_latency_factor = sacct_latency_factor
+        self.sizing = sizing
+        self.sizing_params = dict(
+            percentile=sizing_percentile,
+            margin=sizing_margin,
+            min_count=sizing_min_count,
+            escalation=sizing_escalation,
+            min_mem=sizing_min_mem,
+            min_walltime=sizing_min_walltime,
+        )
+
+        if isinstance(partitions, str):
+            partitions = partitions.split(',')
+
+        if partitions:
+            self.router = PartitionRouter(partitions, partition_refresh)
+        else:
+            self.router = None
+
+        if sizing:
+            # Usage of previous runs comes from the saved sacct fields
+            sacct_fields = tuple(dict.fromkeys(
+                tuple(sacct_fields or ()) + ('ElapsedRaw', 'MaxRSS')))
+
+        self.sacct_fields = sacct_fields
+        self.sacct_query_fields = tuple(dict.fromkeys(
+            SACCT_REQUIRED_FIELDS + tuple(sacct_fields or ())))
         self.jobs = dict()
+        self._arrays = dict()
+        self._watchers = dict()
+        self._records = dict()
+
+        if sbatch_rate is None and sbatch_delay:
+            sbatch_rate = 1 / sbatch_delay
+
+        self.submit_queue = SubmitQueue(
+            rate=sbatch_rate,
+            burst=sbatch_burst,
+            parallel=sbatch_parallel,
+            retries=sbatch_retries,
+            max_retry_delay=sbatch_max_retry_delay,
+            max_submit_jobs=max_submit_jobs,
+            sacctmgr_executable=sacctmgr_executable or 'sacctmgr'
+        )
 
         self.coroutines = (self.job_monitor,)
-        self._next_update = datetime.now()
+        self._next_update = time.time()
+        self._last_poll = 0
+        self._latency = None
+        self._wakeup = None
+        self._estimator = None
+        self._sizing = None
+        self._routing = None
 
         if self.sbatch_executable is None:
             self.sbatch_executable = shutil.which('sbatch') or 'sbatch'
@@ -62,34 +211,179 @@ class SlurmBackend(BaseBackend):
 
         log.info('SlurmBackend initialized')
 
-    def _bump_next_update(self):
-        self._next_update = datetime.now() + timedelta(seconds=self.sacct_frequency)
-        log.debug(f'Next sacct update bumped to {self._next_update.isoformat()}')
+    def expected_runtime(self, task):
+        """Returns the seconds that a task is expected to run: the
+        expected_duration directive, or the median of its previous runs in
+        the runtime history. Returns None if neither is known."""
+        expected = task.directives.get('expected_duration')
+        expected = utils.parse_duration(expected)
+
+        if expected is not None:
+            return expected
+
+        history = getattr(self.runner, 'history', None)
+        if not history:
+            return None
+
+        if self._estimator is None:
+            try:
+                self._estimator = history.estimator()
+            except Exception:
+                log.exception(f'Failed to load runtime estimates: {history}')
+                self._estimator = lambda t: None
+
+        return self._estimator(task)
+
+    def sizing_policy(self):
+        """Returns the SizingPolicy for this run, or None if sizing is off
+        or there is no runtime history to size from"""
+        if not self.sizing:
+            return None
+
+        if self._sizing is None:
+            history = getattr(self.runner, 'history', None)
+
+            if not history:
+                log.warning('Sizing needs the runtime history, it is off')
+                self._sizing = False
+            else:
+                try:
+                    self._sizing = SizingPolicy.from_history(
+                        history, **self.sizing_params)
+                except Exception:
+                    log.exception(f'Failed to load sizing data: {history}')
+                    self._sizing = False
+
+        return self._sizing or None
+
+    def resources(self, task):
+        """Returns the mem and walltime to request for a task: the sized
+        values in its state, or its directives"""
+        sized = task.state.get('slurm_resources') or {}
+        return (sized.get('mem', task.directives.get('mem')),
+                sized.get('walltime', task.directives.get('walltime')))
+
+    async def route(self, task):
+        """Returns the partition to submit a task to, from the candidate
+        partitions. Returns None when routing is off, the sbatch_args of the
+        task give a partition, or no candidate can run the task."""
+        if self.router is None:
+            return None
+
+        args = as_list(task.directives.get('sbatch_args'))
+        if any(a.startswith(('-p', '--partition'))
+               for a in shlex.split(' '.join(args))):
+            return None
+
+        if self.router.is_stale():
+            if self._routing is None:
+                self._routing = asyncio.Lock()
+
+            async with self._routing:
+                if self.router.is_stale():
+                    self.router.update(await partition_states(
+                        self.router.candidates,
+                        sinfo_executable=self.sinfo_executable,
+                        squeue_executable=self.squeue_executable))
+
+        mem, walltime = self.resources(task)
+        partition = self.router.route(
+            cpus=task.directives.get('cpus') or 1,
+            mem=utils.parse_mem(mem),
+            walltime=utils.parse_walltime(walltime))
+
+        if partition is None:
+            log.warning(f'None of the partitions {self.router.candidates} '
+                        f'can run {task.name}')
+
+        return partition
+
+    def partition_args(self, task):
+        partition = task.state.get('slurm_partition')
+        return [f'--partition={partition}'] if partition else []
+
+    def schedule_check(self, job, now=None):
+        """Sets the time when a job is due to be checked again. A job is
+        checked again after sacct_backoff times the time it has been running
+        (queued, if it has not started), or sacct_backoff times its expected
+        remaining time when that is known, so young jobs are checked often
+        and long jobs rarely. A running job with a walltime is checked when
+        the walltime runs out. The wait is kept between sacct_frequency and
+        sacct_max_staleness. Jobs that write exit records are only checked
+        every spool_reconcile_frequency seconds."""
+        now = now or time.time()
+
+        if job.spool_dir is not None:
+            job.next_check = now + self.spool_reconcile_frequency
+            return
+
+        if job.started is None:
+            age = now - (job.submitted or now)
+            remaining = job.expected
+        else:
+            age = now - job.started
+            remaining = job.expected and job.expected - age
+
+        if remaining and remaining > 0:
+            wait = self.sacct_backoff * remaining
+        else:
+            wait = self.sacct_backoff * age
+
+        if job.started is not None and job.walltime:
+            wait = min(wait, job.started + job.walltime - now)
+
+        wait = min(max(wait, self.sacct_frequency), self.sacct_max_staleness)
+        job.next_check = now + wait
+
+    def next_poll(self):
+        """Returns the time of the next poll: when the first job is due, but
+        no sooner than sacct_frequency, or sacct_latency_factor times the
+        recent poll duration, after the last poll. Neither is allowed to
+        go past sacct_max_staleness."""
+        if self.jobs:
+            due = min(job.next_check for job in self.jobs.values())
+        else:
+            due = time.time() + self.sacct_max_staleness
+
+        floor = self.sacct_frequency
+        if self._latency is not None:
+            floor = max(floor, self._latency * self.sacct_latency_factor)
+        floor = min(floor, self.sacct_max_staleness)
+
+        return max(due, self._last_poll + floor)
 
     async def wait_for_next_update(self):
-        """This allows the wait time to be bumped up each time a job is
-        submitted. This means that sacct will never be checked immediately
-        after submitting jobs, and it protects against finding data from
-        old jobs with the same job ID in the database"""
-        while datetime.now() < self._next_update:
-            sleep_delta = self._next_update - datetime.now()
-            sleep_seconds = max(0, sleep_delta.total_seconds())
-            await asyncio.sleep(sleep_seconds)
+        """Sleeps until the next poll. Jobs that are added can move the
+        next poll earlier (never later), so submitting jobs does not hold
+        back updates for the jobs already in the queue."""
+        while 1:
+            delay = self._next_update - time.time()
+            if delay <= 0:
+                return
+
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
 
     async def job_monitor(self):
         """Request job data updates from sacct for each job in self.jobs."""
         log.info('Slurm job monitor started!')
+        self._wakeup = asyncio.Event(loop=self.runner.loop)
         failures = self.job_monitor_max_fails
         try:
             while 1:
+                self._next_update = self.next_poll()
                 await self.wait_for_next_update()
 
                 if not self.jobs:
                     log.debug('No current jobs to check')
-                    self._bump_next_update()
                     continue
+
+                start = time.time()
                 try:
-                    sacct_data = sacct(*self.jobs, return_data=True)
+                    sacct_data = await self.poll()
                 except Exception:
                     if failures <= 0:
                         raise
@@ -101,7 +395,14 @@ class SlurmBackend(BaseBackend):
                     continue
 
                 failures = self.job_monitor_max_fails
-                self._bump_next_update()
+                now = time.time()
+                latency = now - start
+
+                if self._latency is None:
+                    self._latency = latency
+                else:
+                    self._latency = 0.7 * self._latency + 0.3 * latency
+                self._last_poll = now
 
                 for jid, data in sacct_data.items():
                     if jid in self.jobs:
@@ -110,10 +411,81 @@ class SlurmBackend(BaseBackend):
 
                         if job.is_done() and job.event is not None:
                             job.event.set()
-                            self.jobs.pop(jid)
+                            self.untrack(jid)
+
+                # Missed twice, in case sacct was still catching up
+                for jid, job in list(self.jobs.items()):
+                    if job.misses >= 2:
+                        log.warning(f'Job {jid} is no longer known to Slurm')
+                        job.lost = True
+                        job.event.set()
+                        self.untrack(jid)
+
+                for job in self.jobs.values():
+                    self.schedule_check(job, now)
+
+                log.debug(f'Polled {len(self.jobs)} jobs in {latency:.2f}s')
         finally:
             log.info('Slurm job monitor stopped!')
 
+    async def poll(self):
+        """Returns sacct data for the jobs that have left the queue. squeue
+        (answered by slurmctld) lists the jobs that are still queued, their
+        state is updated from it. Only the others are looked up with sacct,
+        which asks slurmdbd, and only for the sacct fields that are used.
+        If squeue fails, every job is looked up with sacct."""
+        active = await squeue(squeue_executable=self.squeue_executable)
+
+        if active is None:
+            finished = list(self.jobs)
+        else:
+            finished = []
+            for jid, job in self.jobs.items():
+                state = active.get(jid)
+                if state is None:
+                    finished.append(jid)
+                elif not job.job_data or job.job_data.get('State') != state:
+                    job.job_data = {'JobID': jid, 'State': state,
+                                    '_steps': []}
+
+                    if state == 'RUNNING' and job.started is None:
+                        job.started = time.time()
+
+        if not finished:
+            return {}
+
+        # Array elements are found by asking for the whole array
+        job_ids = {jid.partition('_')[0] for jid in finished}
+        submitted = [self.jobs[jid].submitted for jid in finished]
+
+        if None in submitted:
+            starttime = None
+        else:
+            starttime = min(submitted) - self.sacct_starttime_margin
+
+        data = await query_sacct(
+            *job_ids,
+            fields=self.sacct_query_fields,
+            starttime=starttime,
+            sacct_executable=self.sacct_executable
+        )
+        data.update(array_elements(data))
+
+        # Reattached jobs may be gone from the queue and from sacct
+        if active is not None:
+            for jid in finished:
+                if self.jobs[jid].reattached and jid not in data:
+                    self.jobs[jid].misses += 1
+
+        return data
+
+    def is_saturated(self):
+        if self.max_pending is None:
+            return False
+
+        pending = sum(1 for j in self.jobs.values() if j.is_pending())
+        return pending >= self.max_pending
+
     def slurm_job_name(self, task):
         """The slurm backend gives each job a name that is
         <run_id>.<job number>
@@ -148,54 +520,420 @@ class SlurmBackend(BaseBackend):
         if self.jobs:
             jobs = list(self.jobs.keys())
             log.info(f'Requesting scancel for {len(jobs)} slurm jobs')
-            subprocess.run(['scancel'] + jobs)
+            subprocess.run([self.scancel_executable] + jobs)
 
-    async def spawn(self, task):
-        log.debug(f'Spawn: {task.name}')
+    def close(self):
+        for watcher in self._watchers.values():
+            watcher.close()
+        self._watchers.clear()
 
-        if not task.directives.get('cmd'):
-            return task.complete()
+    def track(self, job):
+        """Adds a job to the jobs checked by the job monitor, and moves the
+        next poll earlier if the job is due before it"""
+        self.jobs[job.jid] = job
+        self.schedule_check(job)
+
+        if job.next_check < self._next_update:
+            self._next_update = job.next_check
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+    def untrack(self, jid):
+        """Removes a job that is done, and gives back its place in the
+        submit queue. Reattached jobs were not submitted through it."""
+        job = self.jobs.pop(jid)
+        if not job.reattached:
+            self.submit_queue.release()
+
+    def get_spool_dir(self, task):
+        """Returns the directory where the job of a task writes its exit
+        record, or None if it does not write one. The directory is watched
+        from the first time it is used."""
+        if not self.spool or task.directives['cmd'].startswith('#!'):
+            return None
+
+        project = self.runner.get_project(task)
+        if project:
+            path = project.paths.spool_dir
+        elif self.spool_dir:
+            path = os.path.abspath(self.spool_dir)
+        else:
+            return None
+
+        if path not in self._watchers:
+            watcher = spool.SpoolWatcher(
+                path, self.exit_record, self.runner.loop,
+                scan_interval=self.spool_scan_interval)
+            watcher.start()
+            self._watchers[path] = watcher
+
+        return path
 
-        # sbatch breaks when called too frequently
-        time.sleep(self.sbatch_delay)
-        stdin, stdout, stderr = self.get_fd_paths(task)
+    def exit_record(self, jid, path):
+        """SpoolWatcher callback for a new exit record. Records can show up
+        before sbatch has returned the job id, they are kept until the job
+        is added by spawn."""
+        job = self.jobs.get(jid)
+
+        if job is None:
+            self._records[jid] = path
+        else:
+            self.complete_from_record(job, path)
 
-        job = sbatch(
-            cmd=task.directives['cmd'],
+    def complete_from_record(self, job, path):
+        """Sets the job data of a job from its exit record, and wakes its
+        spawn coroutine. Records that cannot be read are left for sacct."""
+        try:
+            record = spool.read_record(path)
+        except (OSError, ValueError) as e:
+            log.warning(f'Failed to read exit record {path}: {e}')
+            return
+
+        self.remove_record(job.jid, path)
+
+        # A record left by an old job with the same id
+        if job.submitted is not None \
+                and record['End'] < job.submitted - self.sacct_starttime_margin:
+            log.debug(f'Ignored stale exit record: {path}')
+            return
+
+        job.job_data = spool.job_data(job.jid, record)
+        job.event.set()
+        self.untrack(job.jid)
+
+    def remove_record(self, jid, path):
+        self._records.pop(jid, None)
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log.warning(f'Failed to remove exit record {path}: {e}')
+
+        watcher = self._watchers.get(os.path.dirname(path))
+        if watcher is not None:
+            watcher.forget(jid)
+
+    def watch(self, task, job):
+        """Tracks the job of a task until it is done, its event is set then.
+        The exit record of the job may already be waiting."""
+        job.event = asyncio.Event(loop=self.runner.loop)
+        job.expected = self.expected_runtime(task)
+        job.walltime = utils.parse_walltime(task.directives.get('walltime'))
+        self.track(job)
+
+        if job.jid in self._records:
+            self.complete_from_record(job, self._records[job.jid])
+
+    def reattach(self, task):
+        """Returns the job that a previous runner submitted for a task that
+        was interrupted (see Workflow.reset_interrupted), and tracks it like
+        a job that was just submitted. The job monitor finds it in the queue,
+        or finds out how it ended from sacct. If the job is in neither, it
+        is marked as lost and the task is submitted again. Returns None if
+        the task has no job to reattach to."""
+        previous = task.state.pop('interrupted', None)
+
+        if not previous or not previous.get('slurm_job_id'):
+            return None
+        elif previous.get('identity') != task.identity:
+            log.info(f'Not reattaching to a job for a different version of '
+                     f'the task: {task.name}')
+            return None
+
+        job = SlurmBatchJob(previous['slurm_job_id'])
+        job.reattached = True
+        job.submitted = previous.get('slurm_submitted')
+
+        if job.submitted is None:
+            try:
+                job.submitted = datetime.strptime(
+                    previous['start_time'], '%Y-%m-%dT%H:%M:%S.%f').timestamp()
+            except (KeyError, TypeError, ValueError):
+                pass
+
+        keys = ('label', 'stdout_path', 'stderr_path', 'slurm_job_id',
+                'slurm_submitted', 'slurm_cmd', 'slurm_dependencies')
+        task.state.update((k, previous[k]) for k in keys if k in previous)
+
+        log.info(f'SlurmBackend reattached({job.jid}): {task.name}')
+        self.watch(task, job)
+        return job
+
+    def is_submitted(self, task):
+        return task.state.get('slurm_job_id') in self.jobs
+
+    def dependencies(self, task):
+        """Returns the job ids that a task submitted ahead has to wait for,
+        or None if one of its unfinished predecessors has no job in the
+        queue (it failed, or is waiting to be retried)"""
+        if not task.state.get('submit_ahead'):
+            return []
+
+        graph = self.runner.get_workflow(task).graph
+        job_ids = []
+
+        for dep in graph.predecessors(task):
+            if dep.is_complete():
+                continue
+            elif not self.is_submitted(dep):
+                return None
+
+            job_ids.append(dep.state['slurm_job_id'])
+
+        return sorted(job_ids)
+
+    def dependency_failed(self, task):
+        """Handles a task submitted ahead whose predecessors will not
+        complete. If a predecessor failed, the runner has already skipped
+        the task. Otherwise a predecessor is being retried (or has just
+        left the queue), and the task goes back to new to be started again
+        when the predecessor is ready."""
+        if task.is_done():
+            log.info(f'Skipped: {task.name}')
+        else:
+            log.info(f'Predecessor is not in the queue: {task.name}')
+            task.reset(clear_state=False)
+            task.state.pop('submit_ahead', None)
+
+        return task
+
+    def dependency_args(self, task):
+        """sbatch arguments that hold a job until the jobs of its
+        predecessors complete, and cancel it if any of them fail"""
+        job_ids = task.state.get('slurm_dependencies')
+
+        if job_ids:
+            return [f'--dependency=afterok:{":".join(job_ids)}',
+                    '--kill-on-invalid-dep=yes']
+        return []
+
+    async def submit(self, task, fd_paths):
+        """Submits a task as its own job, returns the SlurmBatchJob"""
+        stdin, stdout, stderr = fd_paths
+        spool_dir = self.get_spool_dir(task)
+        cmd = task.directives['cmd']
+
+        if spool_dir is not None:
+            cmd = '\n'.join(['#!/bin/bash', spool.record_start(), '(', cmd,
+                             ')'] + spool.record_script(spool_dir)) + '\n'
+
+        mem, walltime = self.resources(task)
+        args, script = sbatch_args(
+            cmd=cmd,
             name=task.name,
             stdin=stdin,
             stdout=stdout,
             stderr=stderr,
             comment=self.slurm_job_comment(task),
             cpus_per_task=task.directives.get('cpus'),
-            mem=task.directives.get('mem'),
-            walltime=task.directives.get('walltime'),
-            additional_args=task.directives.get('sbatch_args'),
-            sbatch_executable=self.sbatch_executable
+            mem=mem,
+            walltime=walltime,
+            additional_args=self.partition_args(task)
+                            + self.dependency_args(task)
+                            + as_list(task.directives.get('sbatch_args')),
+            sbatch_executable=self.sbatch_executable,
+            cwd=self.get_cwd(task)
         )
 
-        task.state.update(
-            label=f'Slurm({job.jid})',
-            stdout_path=stdout,
-            stderr_path=stderr,
-            slurm_job_id=job.jid,
-            slurm_cmd=' '.join(shlex.quote(a) for a in job.args)
-        )
+        jid = await self.submit_queue.submit(
+            args, script, env=self.get_env(task))
+
+        job = SlurmBatchJob(jid)
+        job.args = args
+        job.script = script
+        job.spool_dir = spool_dir
+        return job
+
+    def can_array(self, task):
+        """Tasks can be run as array elements unless arrays are disabled or
+        the cmd is a script for another interpreter"""
+        return bool(self.array_max_size) \
+            and not task.directives['cmd'].startswith('#!')
+
+    def array_key(self, task):
+        """Tasks with the same key can share an array submission"""
+        d = task.directives
+        return json.dumps([
+            d.get('cpus'),
+            self.resources(task),
+            d.get('sbatch_args'),
+            self.get_cwd(task),
+            self.get_spool_dir(task),
+            task.state.get('slurm_partition'),
+            task.state.get('slurm_dependencies'),
+        ], sort_keys=True)
+
+    async def submit_array_element(self, task, fd_paths):
+        """Adds a task to the array being collected for tasks with the same
+        resources. The array is submitted when it is full, or array_delay
+        seconds after its first task. Returns a SlurmBatchJob for the array
+        element of this task."""
+        key = self.array_key(task)
+        batch = self._arrays.get(key)
+
+        if batch is None:
+            batch = ArrayBatch(self.runner.loop)
+            self._arrays[key] = batch
+            batch.timer = self.runner.loop.call_later(
+                self.array_delay, self._flush_array, key)
+
+        index = batch.add(task, fd_paths)
+
+        if len(batch) >= self.array_max_size \
+                or len(batch) >= self.submit_queue.limit.value:
+            batch.timer.cancel()
+            self._flush_array(key)
+
+        jobs = await asyncio.shield(batch.future)
+        return jobs[index]
+
+    def _flush_array(self, key):
+        batch = self._arrays.pop(key, None)
+
+        if batch is not None:
+            self.runner.loop.create_task(self._submit_array(batch))
+
+    async def _submit_array(self, batch):
+        try:
+            if len(batch) == 1:
+                job = await self.submit(batch.tasks[0], batch.fd_paths[0])
+                batch.future.set_result([job])
+                return
+
+            first = batch.tasks[0]
+            spool_dir = self.get_spool_dir(first)
+            mem, walltime = self.resources(first)
+            args, script = sbatch_args(
+                cmd=array_script(batch.tasks, batch.fd_paths, spool_dir),
+                name=f'{first.name}+{len(batch) - 1}',
+                # Output of each element is redirected by the script
+                stdout='/dev/null' if all(p[1] for p in batch.fd_paths)
+                else None,
+                cpus_per_task=first.directives.get('cpus'),
+                mem=mem,
+                walltime=walltime,
+                additional_args=[f'--array=0-{len(batch) - 1}']
+                                + self.partition_args(first)
+                                + self.dependency_args(first)
+                                + as_list(first.directives.get('sbatch_args')),
+                sbatch_executable=self.sbatch_executable,
+                cwd=self.get_cwd(first)
+            )
 
-        self._bump_next_update()
-        log.info(f'SlurmBackend submitted({job.jid}): {task.name}')
+            jid = await self.submit_queue.submit(
+                args, script, env=self.get_env(first), count=len(batch))
+            log.info(f'SlurmBackend submitted array({jid}) of {len(batch)} '
+                     f'tasks')
 
-        job.event = asyncio.Event(loop=self.runner.loop)
-        self.jobs[job.jid] = job
+            jobs = []
+            for i in range(len(batch)):
+                job = SlurmBatchJob(f'{jid}_{i}')
+                job.args = args
+                job.script = script
+                job.spool_dir = spool_dir
+                jobs.append(job)
+
+            batch.future.set_result(jobs)
+        except Exception as e:
+            batch.future.set_exception(e)
+
+    async def spawn(self, task):
+        log.debug(f'Spawn: {task.name}')
+
+        if not task.directives.get('cmd'):
+            return task.complete()
+
+        job = self.reattach(task)
+
+        if job is not None:
+            await job.event.wait()
+
+            if job.lost or (task.state.get('slurm_dependencies')
+                            and not job.is_ok()):
+                log.info(f'Job {job.jid} will not complete, submitting '
+                         f'again: {task.name}')
+                job = None
+
+        if job is None:
+            policy = self.sizing_policy()
+            if policy is not None and 'slurm_resources' not in task.state:
+                task.state['slurm_resources'] = policy.size(task)
+
+            partition = await self.route(task)
+            if partition is not None:
+                task.state['slurm_partition'] = partition
+            else:
+                task.state.pop('slurm_partition', None)
+
+            dependencies = self.dependencies(task)
+            if dependencies is None:
+                return self.dependency_failed(task)
+            elif dependencies:
+                task.state['slurm_dependencies'] = dependencies
+            else:
+                task.state.pop('slurm_dependencies', None)
+
+            fd_paths = self.get_fd_paths(task)
+            stdin, stdout, stderr = fd_paths
+
+            try:
+                if self.can_array(task):
+                    job = await self.submit_array_element(task, fd_paths)
+                else:
+                    job = await self.submit(task, fd_paths)
+            except subprocess.CalledProcessError as e:
+                log.error(f'Failed to submit {task.name}: {e.stderr.strip()}')
+                task.state['err'] = f'sbatch failed: {e.stderr.strip()}'
+                return task.fail(-1)
+
+            job.submitted = time.time()
+            task.state.update(
+                label=f'Slurm({job.jid})',
+                stdout_path=stdout,
+                stderr_path=stderr,
+                slurm_job_id=job.jid,
+                slurm_submitted=job.submitted,
+                slurm_cmd=' '.join(shlex.quote(a) for a in job.args)
+            )
+
+            log.info(f'SlurmBackend submitted({job.jid}): {task.name}')
+            self.watch(task, job)
+
+            if self.submit_ahead:
+                self.runner.task_submitted(task)
+
+            await job.event.wait()
 
-        await job.event.wait()
         log.debug(f'{task.name}: job info was updated')
 
+        if job.jid in self._records:
+            # Found by sacct first, the record is no longer needed
+            self.remove_record(job.jid, self._records[job.jid])
+
+        if task.state.get('slurm_dependencies') and not job.is_ok() \
+                and self.dependencies(task) != []:
+            return self.dependency_failed(task)
+
         if self.sacct_fields:
             job_info = {k: v for k, v in job.job_data.items() if
                         k in self.sacct_fields}
+
+            # Usage is reported for the steps of a job, not the job itself
+            if 'MaxRSS' in self.sacct_fields and not job_info.get('MaxRSS'):
+                rss = max_rss(job.job_data)
+                if rss:
+                    job_info['MaxRSS'] = rss
+
             task.state['slurm_sacct'] = job_info
 
+        if not job.is_ok():
+            policy = self.sizing_policy()
+            if policy is not None \
+                    and policy.escalate(task, job.job_data.get('State')):
+                return await self.spawn(task)
+
         if job.is_ok():
             log.info(f'Complete: {task.name}')
             task.complete(job.returncode())
@@ -207,6 +945,113 @@ class SlurmBackend(BaseBackend):
         return task
 
 
+class ArrayBatch:
+    """Tasks collected for one job array submission. The future is set to
+    the list of SlurmBatchJobs for the elements when it is submitted."""
+    def __init__(self, loop):
+        self.tasks = []
+        self.fd_paths = []
+        self.future = loop.create_future()
+        self.timer = None
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def add(self, task, fd_paths):
+        """Adds a task, returns its array index"""
+        self.tasks.append(task)
+        self.fd_paths.append(fd_paths)
+        return len(self.tasks) - 1
+
+
+def as_list(args):
+    """sbatch_args directives may be a string or a list"""
+    if not args:
+        return []
+    elif isinstance(args, str):
+        return [args]
+    else:
+        return list(args)
+
+
+def array_script(tasks, fd_paths, spool_dir=None):
+    """Returns a batch script that runs the cmd of one task, chosen by
+    SLURM_ARRAY_TASK_ID, in a subshell with its own stdin/stdout/stderr.
+    With a spool_dir, each element writes an exit record there."""
+    lines = ['#!/bin/bash']
+
+    if spool_dir is not None:
+        lines.append(spool.record_start())
+
+    lines.append('case "$SLURM_ARRAY_TASK_ID" in')
+
+    for i, (task, paths) in enumerate(zip(tasks, fd_paths)):
+        lines += [
+            f'{i})',
+            f'# {task.name}',
+            '(',
+            task.directives['cmd'],
+            f') {redirects(*paths)}',
+            ';;',
+        ]
+
+    lines += [
+        '*)',
+        'echo "Unknown array index: $SLURM_ARRAY_TASK_ID" >&2',
+        'exit 1',
+        ';;',
+        'esac',
+    ]
+
+    if spool_dir is not None:
+        lines += spool.record_script(spool_dir)
+
+    return '\n'.join(lines) + '\n'
+
+
+def max_rss(data):
+    """Returns the largest MaxRSS of a job in parsed sacct data and its
+    steps, or None"""
+    values = []
+
+    for row in [data] + data.get('_steps', []):
+        try:
+            mem = utils.parse_mem(row.get('MaxRSS'))
+        except ValueError:
+            continue
+
+        if mem is not None:
+            values.append((mem, row['MaxRSS']))
+
+    return max(values)[1] if values else None
+
+
+def array_elements(data):
+    """Returns {"<jobid>_<index>": data} for the array elements in parsed
+    sacct data. Elements are rows in the "_steps" of the array job, and the
+    steps of each element (batch, extern) are added to its own "_steps"."""
+    elements = {}
+
+    for jid, job in data.items():
+        for row in job.get('_steps', []):
+            match = job_id_pattern.match(row['JobID'])
+            groups = match.groupdict()
+            index = groups['arraystepid']
+
+            if index is None or not index.isdigit():
+                continue
+
+            element = elements.setdefault(f'{jid}_{index}', {'_steps': []})
+
+            if groups['stepid']:
+                element['_steps'].append(row)
+            else:
+                element.update(row, _steps=element['_steps'])
+
+    # Elements that only have step rows so far are not reported
+    return {k: v for k, v in elements.items() if 'State' in v}
+
+
 class SlurmBatchJob(object):
     states = {
         'BOOT_FAIL': 'Job terminated due to launch failure, typically due to a '
@@ -253,6 +1098,15 @@ class SlurmBatchJob(object):
 
     def __init__(self, jid=None, data=None):
         self.args = None
+        self.submitted = None
+        self.started = None
+        self.expected = None
+        self.walltime = None
+        self.next_check = None
+        self.spool_dir = None
+        self.reattached = False
+        self.misses = 0
+        self.lost = False
         self._job_data = None
 
         if data:
@@ -314,6 +1168,13 @@ class SlurmBatchJob(object):
         cmd_args = ('scancel', self.jid)
         return subprocess.call(cmd_args)
 
+    def is_pending(self):
+        """Jobs are pending until sacct reports another state"""
+        if self._job_data:
+            return self._job_data.get('State') == 'PENDING'
+
+        return True
+
     def is_done(self):
         if self._job_data:
             state = self._job_data.get('State')
@@ -333,6 +1194,280 @@ class SlurmBatchJob(object):
             return False
 
 
+class SubmitQueue:
+    """Submits batch jobs with sbatch in asyncio subprocesses, so the runner
+    keeps handling completions and autosaves while thousands of jobs are
+    being submitted.
+
+    Submissions start at most rate per second (a token bucket that allows
+    bursts of burst submissions), and at most parallel sbatch processes run
+    at once. Failed submissions are retried with exponential backoff, the
+    waiting is done with asyncio.sleep.
+
+    Jobs that were submitted and have not finished count against the
+    MaxSubmitJobs limit of the user, each element of a job array counts as a
+    job. When the limit is reached, or sbatch reports it (jobs from other
+    runs count too), new submissions are held until jobs leave the queue
+    instead of failing. Jobs must be given back with release when they are
+    done.
+
+    :param rate: Submissions per second, None for no limit
+    :param burst: Submissions allowed at once after an idle period
+    :param parallel: sbatch processes running at once
+    :param retries: Retries for a failed submission before giving up
+    :param retry_delay: Seconds before the first retry, doubled each time
+    :param max_retry_delay: Longest wait between retries
+    :param max_submit_jobs: Limit on jobs in the queue. None looks up the
+        MaxSubmitJobs of the user's associations with sacctmgr.
+    :param sacctmgr_executable: Path to sacctmgr if not on PATH
+    """
+    def __init__(self, rate=10, burst=10, parallel=4, retries=10,
+                 retry_delay=1, max_retry_delay=60, max_submit_jobs=None,
+                 sacctmgr_executable='sacctmgr'):
+        self.bucket = TokenBucket(rate, burst)
+        self.parallel = asyncio.Semaphore(parallel)
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_submit_jobs = max_submit_jobs
+        self.sacctmgr_executable = sacctmgr_executable
+        self.limit = ConcurrencyLimit(max_submit_jobs or sys.maxsize)
+        self.submitted = 0
+        self.failures = 0
+        self.holds = 0
+        self._detected = max_submit_jobs is not None
+        self._acquiring = asyncio.Lock()
+
+    def __repr__(self):
+        return f'<SubmitQueue {self.submitted} submitted, {self.limit}>'
+
+    async def _detect_limit(self):
+        """Looks up MaxSubmitJobs once, before the first submission"""
+        self._detected = True
+        limit = await max_submit_jobs(
+            sacctmgr_executable=self.sacctmgr_executable)
+
+        if limit is not None:
+            log.info(f'Slurm MaxSubmitJobs for this user: {limit}')
+            self.max_submit_jobs = limit
+            self.limit.resize(limit)
+
+    def _delay(self, attempt):
+        return min(self.max_retry_delay, self.retry_delay * 2 ** attempt)
+
+    async def _acquire(self, count):
+        # Only one submission takes slots at a time, so that two arrays
+        # cannot each hold part of what the other one needs
+        async with self._acquiring:
+            for i in range(count):
+                await self.limit.acquire()
+
+    def _release(self, count):
+        for i in range(count):
+            self.limit.release()
+
+    async def submit(self, args, script, env=None, count=1):
+        """Submits a job and returns its job id. The script is given to sbatch
+        on stdin. count is the number of jobs in the submission (array
+        elements). Raises CalledProcessError when every retry has failed."""
+        if not self._detected:
+            await self._detect_limit()
+
+        count = min(count, self.limit.value)
+        await self._acquire(count)
+
+        try:
+            return await self._submit(args, script, env, count)
+        except BaseException:
+            self._release(count)
+            raise
+
+    async def _submit(self, args, script, env, count):
+        attempt = 0
+        held = 0
+
+        while 1:
+            async with self.parallel:
+                await self.bucket.take()
+                rc, out, err = await communicate(args, script, env)
+
+            if rc == 0:
+                self.submitted += 1
+                self._grow()
+                # --parsable prints "<job id>[;<cluster>]"
+                return out.strip().split(';')[0]
+
+            if submit_limit_pattern.search(err):
+                # Hold this job until others leave the queue. Our own slot is
+                # given back while waiting, and the limit is lowered to the
+                # jobs we have in the queue.
+                self.holds += 1
+                self._release(count)
+                self.limit.resize(max(count, self.limit.in_use))
+                delay = self._delay(held)
+                held += 1
+                log.warning(f'Slurm submit limit reached with '
+                            f'{self.limit.in_use} jobs from this run, holding '
+                            f'submissions ({delay}s): {err.strip()}')
+                await asyncio.sleep(delay)
+                await self._acquire(count)
+                continue
+
+            self.failures += 1
+
+            if attempt >= self.retries:
+                raise subprocess.CalledProcessError(rc, args, out, err)
+
+            delay = self._delay(attempt)
+            attempt += 1
+            log.warning(f'sbatch failed ({rc}), retry {attempt}/{self.retries} '
+                        f'in {delay}s: {err.strip()}')
+            await asyncio.sleep(delay)
+
+    def _grow(self):
+        """Raises a limit that was lowered by submit limit errors by one job
+        each time the queue is full and a submission succeeds, in case the
+        jobs that filled the queue were from other runs"""
+        ceiling = self.max_submit_jobs or sys.maxsize
+
+        if self.limit.value < ceiling and self.limit.locked():
+            self.limit.resize(self.limit.value + 1)
+
+    def release(self):
+        """Called when a submitted job has left the Slurm queue"""
+        # Arrays larger than the limit only took the slots there were
+        if self.limit.in_use > 0:
+            self.limit.release()
+
+
+async def max_submit_jobs(user=None, sacctmgr_executable='sacctmgr'):
+    """Returns the smallest MaxSubmitJobs limit of the associations of a user,
+    or None if there is no limit or it cannot be found"""
+    user = user or getpass.getuser()
+    args = [sacctmgr_executable, '-nP', 'show', 'assoc', 'where',
+            f'user={user}', 'format=MaxSubmit']
+
+    try:
+        p = await asyncio.create_subprocess_exec(
+            *args, stdout=PIPE, stderr=subprocess.DEVNULL)
+        out, _ = await p.communicate()
+    except OSError as e:
+        log.debug(f'Failed to look up MaxSubmitJobs: {e}')
+        return None
+
+    if p.returncode != 0:
+        return None
+
+    limits = [int(v) for v in out.decode().split() if v.isdigit()]
+    return min(limits) if limits else None
+
+
+async def communicate(args, input=None, env=None):
+    """Runs a command in an asyncio subprocess, returns (returncode, stdout,
+    stderr). Failures to start the command are returned as returncode -1."""
+    try:
+        p = await asyncio.create_subprocess_exec(
+            *args, stdin=PIPE if input is not None else subprocess.DEVNULL,
+            stdout=PIPE, stderr=PIPE, env=env)
+    except OSError as e:
+        return -1, '', str(e)
+
+    out, err = await p.communicate(input.encode() if input else None)
+    return p.returncode, out.decode(), err.decode()
+
+
+async def squeue(user=None, squeue_executable='squeue'):
+    """Returns {job id: state} for the queued jobs of a user, with one entry
+    for each array element. Returns None if squeue fails."""
+    user = user or getpass.getuser()
+    args = [squeue_executable, '-h', '-r', '-u', user, '-o', '%i %T']
+    rc, out, err = await communicate(args)
+
+    if rc != 0:
+        log.warning(f'squeue failed ({rc}): {err.strip()}')
+        return None
+
+    return parse_squeue(out)
+
+
+async def partition_states(partitions, sinfo_executable='sinfo',
+                           squeue_executable='squeue'):
+    """Returns {name: routing.Partition} with the state of partitions from
+    sinfo, and the cpus of the jobs pending in them (of every user) from
+    squeue. Returns None if either command fails."""
+    names = ','.join(partitions)
+    (rc, out, err), (squeue_rc, pending, squeue_err) = await asyncio.gather(
+        communicate([sinfo_executable, '-h', '-p', names,
+                     '-o', routing.SINFO_FORMAT]),
+        communicate([squeue_executable, '-h', '-r', '-t', 'PENDING',
+                     '-p', names, '-o', routing.PENDING_FORMAT])
+    )
+
+    if rc != 0:
+        log.warning(f'sinfo failed ({rc}): {err.strip()}')
+        return None
+    elif squeue_rc != 0:
+        log.warning(f'squeue failed ({squeue_rc}): {squeue_err.strip()}')
+        return None
+
+    return routing.parse_pending(pending, routing.parse_sinfo(out))
+
+
+def parse_squeue(data):
+    """Parses squeue -o '%i %T' output into {job id: state}"""
+    jobs = {}
+
+    for line in data.splitlines():
+        jid, _, state = line.strip().partition(' ')
+        if jid:
+            jobs[jid] = state.strip()
+
+    return jobs
+
+
+def sacct_args(job_ids, fields=None, starttime=None, delimiter=sacct_delimiter,
+               sacct_executable='sacct'):
+    """Returns the arguments for a sacct query. fields=None asks for every
+    field (--format all)."""
+    args = [sacct_executable, '-P', '--delimiter={}'.format(delimiter)]
+    args.extend(['--format', ','.join(fields) if fields else 'all'])
+
+    if starttime is not None:
+        start = datetime.fromtimestamp(starttime).strftime('%Y-%m-%dT%H:%M:%S')
+        args.extend(['--starttime', start])
+
+    args.extend(['-j', ','.join(str(jid) for jid in job_ids)])
+    return args
+
+
+async def query_sacct(*job_ids, fields=None, starttime=None, chunk_size=1000,
+                      sacct_executable='sacct'):
+    """Asynchronous sacct query, returns the parsed data like
+    sacct(return_data=True). Only the given fields are requested, and only
+    jobs that started after starttime (a timestamp) are searched when it is
+    given. Raises CalledProcessError if sacct fails."""
+    job_ids = [str(jid) for jid in job_ids]
+    data = {}
+
+    for i in range(0, len(job_ids), chunk_size):
+        args = sacct_args(
+            job_ids[i: i + chunk_size],
+            fields=fields,
+            starttime=starttime,
+            sacct_executable=sacct_executable
+        )
+        log.debug(f'Launching: {" ".join(shlex.quote(a) for a in args)}')
+        rc, out, err = await communicate(args)
+
+        if rc != 0:
+            raise subprocess.CalledProcessError(rc, args, out, err)
+
+        data.update(parse_sacct(out))
+
+    log.debug(f'Status updates for {len(data)} jobs')
+    return data
+
+
 def wait(*job_ids, update_frequency=10):
     """Wait for one or more slurm batch jobs to complete"""
     while 1:
@@ -381,7 +1516,8 @@ def sacct(*job_ids, chunk_size=1000, strict=False, return_data=False):
     return jobs
 
 
-def launch_sacct(*job_ids, delimiter=sacct_delimiter, raw=False):
+def launch_sacct(*job_ids, delimiter=sacct_delimiter, raw=False, fields=None,
+                 starttime=None):
     """Launch sacct command and return stdout data
 
     This function returns raw query results, sacct() will be more
@@ -390,13 +1526,13 @@ def launch_sacct(*job_ids, delimiter=sacct_delimiter, raw=False):
     :param job_ids: Job ids to include in the query
     :param delimiter: Delimiter to separate parsable results data
     :param raw: Return raw stdout instead of parsed
+    :param fields: Fields to request, None requests all of them
+    :param starttime: Only search jobs that started after this timestamp
     :return: Dict or Bytes
     """
     log.debug('Sacct request for {} jobs...'.format(len(job_ids)))
-    args = ['sacct', '-P', '--format', 'all', '--delimiter={}'.format(delimiter)]
-
-    for jid in job_ids:
-        args.extend(['-j', str(jid)])
+    args = sacct_args(
+        job_ids, fields=fields, starttime=starttime, delimiter=delimiter)
 
     log.debug('Launching: {}'.format(' '.join([shlex.quote(r) for r in args])))
     p = subprocess.run(args, stdout=PIPE, check=True)
@@ -411,7 +1547,11 @@ def parse_sacct(data, delimiter=sacct_delimiter, id_pattern=job_id_pattern):
     """Parse stdout from sacct to a dictionary of job ids and data."""
     jobs = dict()
     lines = iter(data.strip().splitlines())
-    header = next(lines).strip().split(delimiter)
+
+    try:
+        header = next(lines).strip().split(delimiter)
+    except StopIteration:
+        return jobs
 
     for line in lines:
         row = dict(zip(header, line.strip().split(delimiter)))
@@ -448,9 +1588,13 @@ def parse_sacct(data, delimiter=sacct_delimiter, id_pattern=job_id_pattern):
     return jobs
 
 
-def sbatch(cmd, name=None, stdin=None, stdout=None, stderr=None, tasks=None,
-           cpus_per_task=None, mem=None, walltime=None, comment=None,
-           additional_args=None, sbatch_executable=None, retry=10):
+def sbatch_args(cmd, name=None, stdin=None, stdout=None, stderr=None,
+                tasks=None, cpus_per_task=None, mem=None, walltime=None,
+                comment=None, additional_args=None, sbatch_executable=None,
+                cwd=None):
+    """Returns the sbatch arguments and the batch script for a job. The
+    script path is not included, sbatch reads the script from stdin when it
+    is left out."""
     if sbatch_executable is None:
         sbatch_executable = 'sbatch'
 
@@ -466,7 +1610,7 @@ def sbatch(cmd, name=None, stdin=None, stdout=None, stderr=None, tasks=None,
         args.extend(['-o', stdout])
 
     if stderr:
-        args.extend(['-e', stdout])
+        args.extend(['-e', stderr])
 
     if tasks:
         args.extend(['-n', tasks])
@@ -483,6 +1627,9 @@ def sbatch(cmd, name=None, stdin=None, stdout=None, stderr=None, tasks=None,
     if comment:
         args.extend(['--comment', comment])
 
+    if cwd:
+        args.extend(['-D', cwd])
+
     if additional_args:
         if isinstance(additional_args, str):
             args.append(additional_args)
@@ -494,17 +1641,44 @@ def sbatch(cmd, name=None, stdin=None, stdout=None, stderr=None, tasks=None,
     else:
         script = '#!/bin/bash\n{}'.format(cmd)
 
+    return [str(r) for r in args], script
+
+
+def sbatch(cmd, name=None, stdin=None, stdout=None, stderr=None, tasks=None,
+           cpus_per_task=None, mem=None, walltime=None, comment=None,
+           additional_args=None, sbatch_executable=None, retry=10, cwd=None,
+           env=None):
+    """Submit a batch job script with sbatch. The job inherits the environment
+    given by env (or the current environment) because sbatch exports the
+    submission environment to the job by default. This blocks until the job
+    is submitted, the SlurmBackend uses a SubmitQueue instead.
+    """
+    args, script = sbatch_args(
+        cmd,
+        name=name,
+        stdin=stdin,
+        stdout=stdout,
+        stderr=stderr,
+        tasks=tasks,
+        cpus_per_task=cpus_per_task,
+        mem=mem,
+        walltime=walltime,
+        comment=comment,
+        additional_args=additional_args,
+        sbatch_executable=sbatch_executable,
+        cwd=cwd
+    )
+
     temp = tempfile.NamedTemporaryFile()
     with open(temp.name, 'w') as fp:
         fp.write(script)
 
     args.append(temp.name)
-    args = [str(r) for r in args]
 
     remaining_tries = int(retry)
     while 1:
         try:
-            p = subprocess.run(args, stdout=subprocess.PIPE, check=True)
+            p = subprocess.run(args, stdout=subprocess.PIPE, env=env, check=True)
             break
         except subprocess.CalledProcessError:
             if remaining_tries > 0:
@@ -0,0 +1,250 @@
+"""Detection of the cpus, memory and processes available to this process
+
+multiprocessing.cpu_count() counts every cpu on the machine, but inside a
+Slurm allocation or a container the runner may only be allowed to use a few
+of them. Here the capacity comes from the limits that actually apply to this
+process:
+
+- cpus: the cpu affinity mask, and the cpu quota of its cgroup (cgroup v2
+  cpu.max, or cgroup v1 cpu.cfs_quota_us / cpu.cfs_period_us). A quota of
+  2.5 cpus counts as 2.
+- mem: physical memory, and the cgroup memory limit (v2 memory.max, or v1
+  memory.limit_in_bytes).
+- procs: the RLIMIT_NPROC soft limit, and the cgroup pids.max.
+
+Cgroup limits are read from the cgroup of this process and each of its
+parents, the smallest one applies. Anything that cannot be read is treated
+as unlimited. `detect` caches the result, it is used for the LocalBackend
+cpus and mem and the runner max_concurrency defaults (see
+utils.guess_local_cpus and utils.guess_max_forks).
+"""
+import functools
+import logging
+import math
+import os
+from jetstream import isolation
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+log = logging.getLogger(__name__)
+
+
+class Capacity:
+    """Resources available to this process. Values are None when there is no
+    limit that could be detected.
+
+    :param cpus: Number of cpus
+    :param mem: Memory in megabytes
+    :param procs: Max number of processes for this user
+    """
+    def __init__(self, cpus=None, mem=None, procs=None):
+        self.cpus = cpus
+        self.mem = mem
+        self.procs = procs
+
+    def __repr__(self):
+        return f'<Capacity cpus={self.cpus} mem={self.mem} procs={self.procs}>'
+
+    def to_dict(self):
+        return {'cpus': self.cpus, 'mem': self.mem, 'procs': self.procs}
+
+
+def _read(path):
+    try:
+        with open(path) as fp:
+            return fp.read().strip()
+    except OSError:
+        return None
+
+
+def _min(*values):
+    values = [v for v in values if v is not None]
+    return min(values) if values else None
+
+
+def cgroup_v1_dirs(mountinfo_path='/proc/self/mountinfo',
+                   cgroup_path='/proc/self/cgroup'):
+    """Returns {controller: (mount point, directory)} for the cgroup v1
+    hierarchies this process is in. Mounts inside containers often start
+    below the root of the hierarchy, so the mount root is removed from the
+    cgroup path."""
+    mounts = {}
+    dirs = {}
+
+    try:
+        with open(mountinfo_path) as fp:
+            for line in fp:
+                pre, _, post = line.partition(' - ')
+                pre = pre.split()
+                post = post.split()
+                if len(pre) < 5 or len(post) < 3 or post[0] != 'cgroup':
+                    continue
+
+                for option in post[2].split(','):
+                    mounts[option] = (pre[3], pre[4])
+
+        with open(cgroup_path) as fp:
+            for line in fp:
+                parts = line.strip().split(':', 2)
+                if len(parts) != 3 or not parts[1]:
+                    continue
+
+                for controller in parts[1].split(','):
+                    if controller not in mounts:
+                        continue
+
+                    root, mount = mounts[controller]
+                    path = parts[2]
+                    if root != '/' and path.startswith(root):
+                        path = path[len(root):]
+                    directory = os.path.join(mount, path.lstrip('/'))
+                    dirs[controller] = (mount, directory)
+    except OSError:
+        return {}
+
+    return dirs
+
+
+def _limits(mount, directory, names, parse):
+    """Returns the smallest limit set in a cgroup directory or any of its
+    parents up to the mount point. parse gets the contents of the files in
+    names, directories where they cannot be read are skipped."""
+    limits = []
+    directory = os.path.normpath(directory)
+    mount = os.path.normpath(mount)
+
+    while directory.startswith(mount):
+        values = [_read(os.path.join(directory, n)) for n in names]
+
+        if None not in values:
+            limits.append(parse(*values))
+
+        if directory == mount:
+            break
+
+        directory = os.path.dirname(directory)
+
+    return _min(*limits)
+
+
+def _cgroup_limit(v2_name, v1_controller, v1_names, parse_v2, parse_v1):
+    """Returns the cgroup v2 limit, or the cgroup v1 limit if there is no
+    v2 limit"""
+    mount = isolation.cgroup2_mount()
+    limit = None
+
+    if mount is not None:
+        directory = isolation.current_cgroup()
+        if directory is not None:
+            limit = _limits(mount, directory, (v2_name,), parse_v2)
+
+    if limit is None:
+        v1 = cgroup_v1_dirs().get(v1_controller)
+        if v1 is not None:
+            limit = _limits(v1[0], v1[1], v1_names, parse_v1)
+
+    return limit
+
+
+def _parse_cpu_max(value):
+    quota, _, period = value.partition(' ')
+    if quota == 'max':
+        return None
+    return int(quota) / int(period or isolation.CPU_PERIOD)
+
+
+def _parse_cfs(quota, period):
+    if int(quota) < 0:
+        return None
+    return int(quota) / int(period)
+
+
+def _parse_bytes(value):
+    if value == 'max':
+        return None
+
+    value = int(value)
+    # cgroup v1 "unlimited" is the largest multiple of the page size
+    if value >= 2 ** 62:
+        return None
+    return value
+
+
+def _parse_count(value):
+    return None if value == 'max' else int(value)
+
+
+def cgroup_cpu_quota():
+    """Returns the cpu quota of this process, in cpus, or None if there is no
+    quota"""
+    try:
+        return _cgroup_limit(
+            'cpu.max', 'cpu', ('cpu.cfs_quota_us', 'cpu.cfs_period_us'),
+            _parse_cpu_max, _parse_cfs)
+    except ValueError as e:
+        log.debug(f'Failed to read the cgroup cpu quota: {e}')
+        return None
+
+
+def cgroup_mem_limit():
+    """Returns the cgroup memory limit of this process in bytes, or None if
+    there is no limit"""
+    try:
+        return _cgroup_limit(
+            'memory.max', 'memory', ('memory.limit_in_bytes',),
+            _parse_bytes, _parse_bytes)
+    except ValueError as e:
+        log.debug(f'Failed to read the cgroup memory limit: {e}')
+        return None
+
+
+def cgroup_pids_limit():
+    """Returns the cgroup pids limit of this process, or None"""
+    try:
+        return _cgroup_limit(
+            'pids.max', 'pids', ('pids.max',), _parse_count, _parse_count)
+    except ValueError as e:
+        log.debug(f'Failed to read the cgroup pids limit: {e}')
+        return None
+
+
+def physical_mem():
+    """Returns the physical memory of the machine in bytes, or None"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def nproc_limit():
+    """Returns the RLIMIT_NPROC soft limit, or None if it is unlimited"""
+    if resource is None or not hasattr(resource, 'RLIMIT_NPROC'):
+        return None
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NPROC)
+    if soft == resource.RLIM_INFINITY:
+        return None
+    return soft
+
+
+@functools.lru_cache()
+def detect():
+    """Returns the Capacity of this process. The result is cached, call
+    detect.cache_clear() to detect it again."""
+    cpus = len(isolation.available_cpus())
+    quota = cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, max(1, math.floor(quota)))
+
+    mem = _min(physical_mem(), cgroup_mem_limit())
+    if mem is not None:
+        mem = mem // 2 ** 20
+
+    procs = _min(nproc_limit(), cgroup_pids_limit())
+
+    capacity = Capacity(cpus=cpus, mem=mem, procs=procs)
+    log.debug(f'Detected {capacity}')
+    return capacity
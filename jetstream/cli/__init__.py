@@ -28,6 +28,9 @@ _subcommands = OrderedDict(
     project='jetstream.cli.subcommands.project',
     pipelines='jetstream.cli.subcommands.pipelines',
     settings='jetstream.cli.subcommands.settings',
+    daemon='jetstream.cli.subcommands.daemon',
+    simulate='jetstream.cli.subcommands.simulate',
+    history='jetstream.cli.subcommands.history',
 )
 
 
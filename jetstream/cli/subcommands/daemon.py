@@ -0,0 +1,88 @@
+"""Start, stop, or submit runs to a long-lived runner daemon
+
+The daemon keeps a backend and event loop running, and accepts runs over a
+Unix domain socket. Small incremental runs can start right away instead of
+paying for backend startup every time:
+
+    jetstream daemon start &
+    jetstream build sample.jst -o new.pickle
+    jetstream daemon submit -p <project> -w new.pickle
+    jetstream daemon status
+    jetstream daemon stop
+"""
+import logging
+import os
+import jetstream
+from jetstream import daemon
+
+log = logging.getLogger('jetstream.cli')
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        'action',
+        choices=('start', 'submit', 'status', 'stop'),
+        help='start the daemon, or send it a request'
+    )
+
+    parser.add_argument(
+        '--socket',
+        default=None,
+        help='path to the daemon socket [settings daemon.socket]'
+    )
+
+    parser.add_argument(
+        '-w', '--workflow',
+        help='workflow file to submit, it will be merged into the project '
+             'workflow if a project is also given'
+    )
+
+    parser.add_argument(
+        '--backend',
+        choices=jetstream.settings['backends'].get(dict),
+        default=jetstream.settings['backend'].get(str),
+        help='runner backend used by the daemon [%(default)s]'
+    )
+
+    parser.add_argument(
+        '--reset-method',
+        choices=['retry', 'resume', 'reset'],
+        default='retry',
+        help='controls which tasks are reset prior to starting the run '
+             '[%(default)s]'
+    )
+
+
+def main(args):
+    log.debug(f'{__name__} {args}')
+
+    if args.action == 'start':
+        jetstream.launcher.prestart()
+        d = daemon.Daemon(backend=args.backend, socket_path=args.socket)
+        d.serve()
+        return
+
+    if args.action == 'submit':
+        if not (args.project or args.workflow):
+            err = 'No project or workflow given! Must be run inside a ' \
+                  'project, or use -p/--project or -w/--workflow'
+            raise ValueError(err)
+
+        message = {
+            'action': 'run',
+            'reset_method': args.reset_method,
+        }
+
+        if args.project:
+            message['project'] = args.project.path
+
+        if args.workflow:
+            message['workflow'] = os.path.abspath(args.workflow)
+    else:
+        message = {'action': args.action}
+
+    response = daemon.request(message, socket_path=args.socket)
+    response.pop('ok')
+
+    if response:
+        print(jetstream.utils.dumps_yaml(response))
@@ -0,0 +1,97 @@
+"""Query the runtime history of finished tasks
+
+Every runner records finished tasks in a database shared by all projects
+(settings history.path). Tasks are selected by name pattern, identity, or
+tag, and percentiles are reported for run time (seconds) or memory (MB):
+
+    jetstream history 'bwa_mem_*'
+    jetstream history 'bwa_mem_*' --field max_rss -q 50 -q 99
+    jetstream history --tag alignment --list
+"""
+import logging
+import jetstream
+
+log = logging.getLogger('jetstream.cli')
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        'pattern',
+        nargs='?',
+        default=None,
+        help='glob pattern for task names [all tasks]'
+    )
+
+    parser.add_argument(
+        '--identity',
+        default=None,
+        help='only include tasks with this identity'
+    )
+
+    parser.add_argument(
+        '--tag',
+        default=None,
+        help='only include tasks with this tag'
+    )
+
+    parser.add_argument(
+        '--field',
+        choices=jetstream.history.NUMERIC_FIELDS,
+        default='elapsed',
+        help='field used for percentiles [%(default)s]'
+    )
+
+    parser.add_argument(
+        '-q', '--percentile',
+        action='append',
+        type=float,
+        default=None,
+        help='percentiles to report, can be used multiple times '
+             '[50, 90, 95, 99]'
+    )
+
+    parser.add_argument(
+        '--limit',
+        type=int,
+        default=1000,
+        help='only use the most recent records [%(default)s]'
+    )
+
+    parser.add_argument(
+        '--list',
+        action='store_true',
+        help='list the matching records instead of percentiles'
+    )
+
+    parser.add_argument(
+        '--path',
+        default=None,
+        help='path to the history database [settings history.path]'
+    )
+
+
+def main(args):
+    log.debug(f'{__name__} {args}')
+    history = jetstream.history.History(args.path)
+
+    if args.list:
+        records = history.query(
+            args.pattern,
+            identity=args.identity,
+            tag=args.tag,
+            status=None,
+            limit=args.limit
+        )
+
+        for r in records:
+            print(jetstream.utils.dumps_yaml([r]), end='')
+    else:
+        result = history.percentiles(
+            args.pattern,
+            identity=args.identity,
+            tag=args.tag,
+            field=args.field,
+            qs=args.percentile or (50, 90, 95, 99),
+            limit=args.limit
+        )
+        print(jetstream.utils.dumps_yaml(result))
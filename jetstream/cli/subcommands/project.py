@@ -13,6 +13,13 @@ def add_arguments(parser):
         action='store_true'
     )
 
+    parser.add_argument(
+        '--archive-logs',
+        action='store_true',
+        help='pack the compressed logs of finished tasks into archive '
+             'segments (see jetstream.logstore)'
+    )
+
 
 def project_summary(project):
     wf = project.load_workflow()
@@ -33,7 +40,10 @@ def main(args):
         if os.path.exists(lock_file):
             print(f'Warning! Run currently pending: {lock_file}')
 
-        if args.history:
+        if args.archive_logs:
+            with args.project.lock:
+                args.project.log_store.archive()
+        elif args.history:
             for item in args.project.history_iter():
                 print(jetstream.utils.dumps_yaml(item))
         else:
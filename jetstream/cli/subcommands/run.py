@@ -56,6 +56,9 @@ def check_for_failures(wf, limit=5):
 
 
 def template(template, args):
+    if args.projects:
+        return multi_project(template, args)
+
     render = jetstream.templates.render_template(
         template,
         project=args.project,
@@ -74,6 +77,9 @@ def template(template, args):
 
     wf = jetstream.templates.load_workflow(render)
 
+    if args.fuse:
+        jetstream.fusion.fuse_from_settings(wf)
+
     if args.build_only:
         if args.out:
             wf.save(args.out)
@@ -83,6 +89,51 @@ def template(template, args):
     run(wf, args)
 
 
+def multi_project(template, args):
+    """Renders the template once for each project given with --projects, then
+    runs all of the workflows together with a MultiRunner. Each workflow is
+    mashed with, and saved to, its own project workflow."""
+    if args.render_only or args.build_only or args.out:
+        err = '--projects cannot be used with -r/--render-only, ' \
+              '-b/--build-only, or -o/--out'
+        raise ValueError(err)
+
+    runs = []
+    for path in args.projects:
+        project = jetstream.Project(path)
+        render = jetstream.templates.render_template(
+            template,
+            project=project,
+            pipeline=args.pipeline,
+            command_args=args.config,
+            other_args={'backend': args.backend}
+        )
+
+        wf = jetstream.templates.load_workflow(render)
+        ewf = project.load_workflow()
+        wf = jetstream.workflows.mash(ewf, wf)
+        wf.path = ewf.path
+        wf.reset(args.reset_method)
+
+        if args.fuse:
+            jetstream.fusion.fuse_from_settings(wf)
+
+        runs.append((wf, project))
+
+    if args.pipeline:
+        args.pipeline.set_environment_variables()
+
+    args.runner = jetstream.MultiRunner(backend=args.backend)
+
+    try:
+        args.runner.start(runs)
+    finally:
+        errs = [check_for_failures(wf) for wf, project in runs]
+        if any(errs):
+            log.critical('There were errors during the run.')
+            raise SystemExit(1)
+
+
 def workflow(args):
     wf = jetstream.load_workflow(args.file)
     run(wf, args)
@@ -117,6 +168,10 @@ def run(wf, args):
 
     wf.reset(args.reset_method)
 
+    if args.fuse:
+        # Chains are found again, mashing may have changed the workflow
+        jetstream.fusion.fuse_from_settings(wf)
+
     try:
         args.runner.start(
             workflow=wf,
@@ -136,6 +191,10 @@ def main(args):
     if not (args.pipeline or args.file):
         raise ValueError('Must give file path if pipeline is not set')
 
+    if not (args.render_only or args.build_only):
+        # Forked before the workflow is loaded, while this process is small
+        jetstream.launcher.prestart()
+
     if args.pipeline:
         t = args.pipeline.load_template()
         template(t, args)
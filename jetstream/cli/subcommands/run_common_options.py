@@ -43,6 +43,22 @@ def add_arguments(parser):
              'all [%(default)s]'
     )
 
+    group.add_argument(
+        '--fuse',
+        action='store_true',
+        default=jetstream.settings['fusion']['enabled'].get(bool),
+        help='run linear chains of tasks as single backend submissions, '
+             'limits are in the fusion settings'
+    )
+
+    group.add_argument(
+        '--projects',
+        nargs='+',
+        metavar='PATH',
+        help='run the template for each of these project directories in a '
+             'single runner that shares the backend between them'
+    )
+
     group.add_argument(
         '-w', '--existing-workflow',
         help='path to an existing workflow file that will be merged into run '
@@ -0,0 +1,177 @@
+"""Predict the makespan of a workflow on a modeled backend
+
+This is a dry run, no commands are executed. Tasks are scheduled in the same
+order the runner would start them, using the cpus and mem directives as
+resource requests. Durations come from the "expected_duration" directive
+(seconds or a walltime string), then the runtime history if --history is
+used, then the "walltime" directive, then --default-duration. The report
+includes the predicted makespan, the cpu utilisation curve, the critical
+path, and which resource requests waited the longest.
+
+    jetstream simulate -w workflow.pickle --cpus 32
+    jetstream simulate --model slurm --nodes 10 --node-cpus 48 --node-mem 180G
+"""
+import logging
+import jetstream
+from jetstream import simulation
+
+log = logging.getLogger('jetstream.cli')
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        '-w', '--workflow',
+        default=None,
+        help='path to a Jetstream workflow file [project workflow]'
+    )
+
+    parser.add_argument(
+        '--model',
+        choices=('local', 'slurm'),
+        default='local',
+        help='backend to model [%(default)s]'
+    )
+
+    parser.add_argument(
+        '--reset-method',
+        choices=['retry', 'resume', 'reset', 'none'],
+        default='retry',
+        help='tasks reset before the simulation, like "jetstream run". Complete '
+             'tasks are not simulated [%(default)s]'
+    )
+
+    parser.add_argument(
+        '--default-duration',
+        type=float,
+        default=60,
+        help='seconds used for tasks without an expected_duration or walltime '
+             'directive [%(default)s]'
+    )
+
+    parser.add_argument(
+        '--history',
+        action='store_true',
+        help='estimate durations from the median run time of previous runs '
+             '(see "jetstream history")'
+    )
+
+    parser.add_argument(
+        '--bins',
+        type=int,
+        default=50,
+        help='number of points in the utilisation curve [%(default)s]'
+    )
+
+    parser.add_argument(
+        '--full',
+        action='store_true',
+        help='print the full critical path and utilisation curve'
+    )
+
+    local = parser.add_argument_group('local model')
+
+    local.add_argument(
+        '--cpus',
+        type=int,
+        default=None,
+        help='cpus available [cpus on this machine]'
+    )
+
+    local.add_argument(
+        '--mem',
+        default=None,
+        help='memory available, same format as the mem directive [no limit]'
+    )
+
+    local.add_argument(
+        '--max-concurrency',
+        type=int,
+        default=None,
+        help='limit on tasks running at once [no limit]'
+    )
+
+    slurm = parser.add_argument_group('slurm model')
+
+    slurm.add_argument(
+        '--nodes',
+        type=int,
+        default=1,
+        help='number of nodes in the partition [%(default)s]'
+    )
+
+    slurm.add_argument(
+        '--node-cpus',
+        type=int,
+        default=None,
+        help='cpus on each node [cpus on this machine]'
+    )
+
+    slurm.add_argument(
+        '--node-mem',
+        default=None,
+        help='memory on each node, same format as the mem directive '
+             '[no limit]'
+    )
+
+    slurm.add_argument(
+        '--queue-delay',
+        type=float,
+        default=0,
+        help='seconds each job waits in the queue before it can start '
+             '[%(default)s]'
+    )
+
+
+def main(args):
+    log.debug(f'{__name__} {args}')
+
+    if args.workflow:
+        log.debug(f'Workflow given by arguments, loading {args.workflow}')
+        workflow = jetstream.load_workflow(args.workflow)
+    elif args.project:
+        log.debug(f'Workflow not given, loading project {args.project}')
+        workflow = args.project.load_workflow()
+    else:
+        err = 'No workflow found. Must be run inside a project, or use ' \
+              'options -p/--project -w/--workflow'
+        raise FileNotFoundError(err)
+
+    if args.reset_method == 'reset':
+        workflow.reset('all')
+    elif args.reset_method != 'none':
+        workflow.reset(args.reset_method)
+
+    if args.model == 'slurm':
+        model = simulation.slurm_model(
+            nodes=args.nodes,
+            node_cpus=args.node_cpus or jetstream.utils.guess_local_cpus(),
+            node_mem=jetstream.utils.parse_mem(args.node_mem),
+            queue_delay=args.queue_delay
+        )
+    else:
+        model = simulation.local_model(
+            cpus=args.cpus,
+            mem=jetstream.utils.parse_mem(args.mem),
+            max_concurrency=args.max_concurrency
+        )
+
+    if args.history:
+        history = jetstream.history.History().estimator()
+    else:
+        history = None
+
+    def estimate(task):
+        return simulation.estimate_duration(
+            task, args.default_duration, history)
+
+    report = simulation.simulate(workflow, model, estimate, bins=args.bins)
+
+    if not args.full:
+        path = report['critical_path']['tasks']
+        if len(path) > 20:
+            report['critical_path']['tasks'] = \
+                path[:10] + [f'... {len(path) - 20} more ...'] + path[-10:]
+
+        report['utilisation'].pop('curve')
+
+    print(jetstream.utils.dumps_yaml(report))
@@ -166,7 +166,10 @@ def _search_workflow(args, wf):
                 yield task
 
 
-def get_details(task, include_logs=True, env=jetstream.templates.environment()):
+def get_details(task, include_logs=True, env=jetstream.templates.environment(),
+                log_store=None):
+    """Renders the task details. Logs are read through the project log store
+    when one is given, so compressed and archived logs are found too."""
     if not include_logs or task.is_new():
         logs = None
     else:
@@ -175,8 +178,10 @@ def get_details(task, include_logs=True, env=jetstream.templates.environment()):
             logs = f'Could not determine log file path.'
         else:
             try:
-                with open(stdout_path, 'r') as fp:
-                    logs = fp.read()
+                if log_store is not None:
+                    logs = log_store.read(stdout_path)
+                else:
+                    logs = jetstream.logstore.read_file(stdout_path)
             except FileNotFoundError:
                 logs = f'Could not find log file: {stdout_path}'
 
@@ -211,8 +216,10 @@ def main(args):
         tasks = [t for t in tasks if t.status in args.status]
 
     if args.action == 'verbose':
+        log_store = args.project.log_store if args.project else None
         for task in tasks:
-            print(get_details(task, include_logs=args.include_logs))
+            print(get_details(task, include_logs=args.include_logs,
+                              log_store=log_store))
     elif args.action == 'remove':
         for task in tasks:
             workflow.pop(task.name)
@@ -0,0 +1,346 @@
+"""Limits on the number of tasks the runner keeps in flight
+
+The runner uses a ConcurrencyLimit instead of a plain semaphore, so that the
+limit can be changed while tasks are running. When the adaptive controller is
+enabled (runner.concurrency.adaptive setting), AdaptiveConcurrency adjusts the
+limit with additive-increase/multiplicative-decrease (AIMD) based on what it
+observes on the host:
+
+- load average per cpu
+- available memory
+- fork failures (BlockingIOError/EAGAIN) reported by the backend
+- the task completion rate
+
+Each decision is recorded in AdaptiveConcurrency.metrics, and changes to the
+limit are logged.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+import jetstream
+
+log = logging.getLogger(__name__)
+
+
+def load_per_cpu(cpus=None):
+    """Returns the 1-minute load average divided by the number of cpus, or None
+    if the load average is not available on this platform."""
+    cpus = cpus or jetstream.utils.guess_local_cpus()
+
+    try:
+        return os.getloadavg()[0] / cpus
+    except (AttributeError, OSError):
+        return None
+
+
+def mem_available(meminfo_path='/proc/meminfo'):
+    """Returns the fraction of memory that is available, or None if it cannot
+    be read from /proc/meminfo."""
+    values = {}
+
+    try:
+        with open(meminfo_path) as fp:
+            for line in fp:
+                key, _, value = line.partition(':')
+                if key in ('MemTotal', 'MemAvailable'):
+                    values[key] = int(value.split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+    try:
+        return values['MemAvailable'] / values['MemTotal']
+    except (KeyError, ZeroDivisionError):
+        return None
+
+
+class ConcurrencyLimit:
+    """A semaphore for tasks in flight with a limit that can be resized. If the
+    limit is lowered below the number in use, new acquires wait until enough
+    tasks have been released."""
+    def __init__(self, value):
+        self.value = int(value)
+        self.in_use = 0
+        self._waiters = deque()
+
+    def __repr__(self):
+        return f'<ConcurrencyLimit {self.in_use}/{self.value}>'
+
+    def _wake_waiters(self):
+        available = self.value - self.in_use
+        while self._waiters and available > 0:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                available -= 1
+
+    async def acquire(self):
+        while self.in_use >= self.value:
+            fut = asyncio.get_event_loop().create_future()
+            self._waiters.append(fut)
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut in self._waiters:
+                    self._waiters.remove(fut)
+                self._wake_waiters()
+                raise
+
+        self.in_use += 1
+        return True
+
+    def locked(self):
+        return self.in_use >= self.value
+
+    def release(self):
+        if self.in_use <= 0:
+            raise ValueError('ConcurrencyLimit released too many times')
+
+        self.in_use -= 1
+        self._wake_waiters()
+
+    def resize(self, value):
+        self.value = max(1, int(value))
+        self._wake_waiters()
+
+
+class MemoryLimit:
+    """Megabytes of memory reserved by running tasks. Tasks wait in the
+    order they asked until their memory fits, so a large task is not passed
+    over forever by smaller ones behind it. Requests larger than the limit
+    are reduced to the limit, so they run alone instead of never running."""
+    def __init__(self, value):
+        self.value = value
+        self.in_use = 0
+        self._waiters = deque()
+
+    def __repr__(self):
+        return f'<MemoryLimit {self.in_use}/{self.value}>'
+
+    def _wake_waiters(self):
+        while self._waiters:
+            fut, mem = self._waiters[0]
+
+            if fut.done():
+                self._waiters.popleft()
+                continue
+
+            if self.in_use + mem > self.value:
+                break
+
+            self._waiters.popleft()
+            self.in_use += mem
+            fut.set_result(None)
+
+    async def acquire(self, mem):
+        """Waits until mem is available and reserves it. Returns the amount
+        reserved, which should be given to release."""
+        mem = min(mem, self.value)
+
+        if not self._waiters and self.in_use + mem <= self.value:
+            self.in_use += mem
+            return mem
+
+        fut = asyncio.get_event_loop().create_future()
+        self._waiters.append((fut, mem))
+
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # Memory was reserved just before the cancel arrived
+                self.in_use -= mem
+            self._waiters = deque(w for w in self._waiters if w[0] is not fut)
+            self._wake_waiters()
+            raise
+
+        return mem
+
+    def locked(self):
+        return bool(self._waiters) or self.in_use >= self.value
+
+    def release(self, mem):
+        self.in_use -= mem
+        self._wake_waiters()
+
+
+class TokenBucket:
+    """Limits the rate of an operation. Tokens are added at rate per second,
+    up to burst, and each operation takes one. Waiting happens with
+    asyncio.sleep so the event loop keeps running."""
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self._updated = time.monotonic()
+
+    def __repr__(self):
+        return f'<TokenBucket {self.rate}/s burst={self.burst}>'
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def take(self):
+        if not self.rate:
+            return
+
+        while 1:
+            self._refill()
+
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AdaptiveConcurrency:
+    """Adjusts a ConcurrencyLimit with AIMD rules.
+
+    Every interval seconds, the limit is multiplied by `decrease` if the host
+    looks overloaded: load per cpu above max_load, available memory below
+    min_mem_available, or any fork failures since the last check. Otherwise,
+    if the limit is saturated (tasks are waiting for it), it is increased by
+    `increase`, unless the completion rate fell below `rate_drop` times the
+    rate before the last increase, which is also a decrease. The limit is
+    always kept between minimum and maximum.
+
+    Fork failures also cause an immediate decrease, at most once per interval,
+    because waiting for the next check lets the backend keep failing."""
+    def __init__(self, limit, maximum, minimum=1, initial=None, interval=5,
+                 increase=None, decrease=0.5, rate_drop=0.5, max_load=1.5,
+                 min_mem_available=0.05, history=1000):
+        cpus = jetstream.utils.guess_local_cpus()
+        self.limit = limit
+        self.maximum = maximum
+        self.minimum = max(1, minimum)
+        self.interval = interval
+        self.increase = increase or cpus
+        self.decrease = decrease
+        self.rate_drop = rate_drop
+        self.max_load = max_load
+        self.min_mem_available = min_mem_available
+        self.cpus = cpus
+        self.metrics = deque(maxlen=history)
+
+        initial = initial or min(maximum, 4 * cpus)
+        self.limit.resize(max(self.minimum, min(maximum, initial)))
+
+        self._completed = 0
+        self._fork_failures = 0
+        self._last_decrease = float('-inf')
+        self._last_rate = None
+        self._last_action = None
+
+    def fork_failed(self):
+        """Called by backends when the system refuses to start a process"""
+        self._fork_failures += 1
+        now = time.monotonic()
+
+        if now - self._last_decrease >= self.interval:
+            self._set_limit(self.limit.value * self.decrease, 'fork failure')
+
+    def task_done(self):
+        """Called by the runner each time a task future returns"""
+        self._completed += 1
+
+    def _set_limit(self, value, reason):
+        value = int(max(self.minimum, min(self.maximum, value)))
+        previous = self.limit.value
+
+        if value < previous:
+            self._last_decrease = time.monotonic()
+
+        if value != previous:
+            log.info(f'Concurrency limit {previous} -> {value} ({reason})')
+            self.limit.resize(value)
+
+        return value - previous
+
+    def check(self, elapsed):
+        """Makes one AIMD decision and records it. Returns the record."""
+        load = load_per_cpu(self.cpus)
+        mem = mem_available()
+        rate = self._completed / elapsed if elapsed > 0 else 0.0
+        forks = self._fork_failures
+        saturated = self.limit.in_use >= self.limit.value
+        decreased = time.monotonic() - self._last_decrease < self.interval
+
+        if forks and decreased:
+            # fork_failed already decreased the limit for these
+            action = 'hold'
+            reason = f'{forks} fork failures, already decreased'
+        elif forks:
+            action, reason = 'decrease', f'{forks} fork failures'
+        elif load is not None and load > self.max_load:
+            action, reason = 'decrease', f'load per cpu {load:.2f}'
+        elif mem is not None and mem < self.min_mem_available:
+            action, reason = 'decrease', f'memory available {mem:.1%}'
+        elif not saturated:
+            action, reason = 'hold', 'limit not reached'
+        elif self._last_action == 'increase' and self._last_rate \
+                and rate < self._last_rate * self.rate_drop:
+            action, reason = 'decrease', f'completion rate fell to {rate:.2f}/s'
+        else:
+            action, reason = 'increase', 'limit reached'
+
+        if action == 'decrease':
+            change = self._set_limit(self.limit.value * self.decrease, reason)
+        elif action == 'increase':
+            change = self._set_limit(self.limit.value + self.increase, reason)
+        else:
+            change = 0
+
+        record = {
+            'time': time.time(),
+            'limit': self.limit.value,
+            'change': change,
+            'in_flight': self.limit.in_use,
+            'load_per_cpu': load,
+            'mem_available': mem,
+            'fork_failures': forks,
+            'completion_rate': rate,
+            'action': action,
+            'reason': reason,
+        }
+        self.metrics.append(record)
+        log.debug(f'Concurrency check: {record}')
+
+        self._completed = 0
+        self._fork_failures = 0
+        self._last_rate = rate
+        self._last_action = action
+        return record
+
+    async def coro(self):
+        """Coroutine that checks the host and adjusts the limit every
+        interval seconds while the runner is running"""
+        log.debug('Adaptive concurrency started!')
+        last = time.monotonic()
+
+        try:
+            while 1:
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                self.check(now - last)
+                last = now
+        except asyncio.CancelledError:
+            pass
+        finally:
+            log.debug('Adaptive concurrency stopped!')
+
+    def summary(self):
+        """Returns a summary of the decisions made during the run"""
+        limits = [r['limit'] for r in self.metrics]
+        return {
+            'checks': len(self.metrics),
+            'increases': sum(1 for r in self.metrics if r['change'] > 0),
+            'decreases': sum(1 for r in self.metrics if r['change'] < 0),
+            'min_limit': min(limits, default=self.limit.value),
+            'max_limit': max(limits, default=self.limit.value),
+            'final_limit': self.limit.value,
+        }
@@ -0,0 +1,213 @@
+"""Long-lived runner that accepts work over a Unix domain socket
+
+Starting a run has a fixed cost: Python startup, loading settings, starting
+the backend (the SlurmBackend even runs `sbatch --version`), and a fresh
+event loop. The daemon pays this once. It keeps a MultiRunner alive with a
+warm backend and event loop, and clients submit projects or workflows to it
+over a Unix domain socket.
+
+The protocol is one JSON object per line in each direction. Requests have an
+"action" key, responses always have an "ok" key:
+
+    {"action": "run", "project": "/path/to/project"}
+    {"action": "run", "project": "/path/to/project", "workflow": "new.pickle"}
+    {"action": "run", "workflow": "/path/to/workflow.pickle"}
+    {"action": "status"}
+    {"action": "stop"}
+
+Run requests with a project use the project workflow. If a workflow path is
+also given, it is mashed into the project workflow first, just like
+`jetstream run`. Project locks are held by the daemon while the project is
+running, and workflows are autosaved by the runner.
+"""
+import asyncio
+import json
+import logging
+import os
+import socket
+from collections import deque
+from datetime import datetime
+import filelock
+import jetstream
+from jetstream.runner import MultiRunner
+
+log = logging.getLogger(__name__)
+
+
+def default_socket_path():
+    path = jetstream.settings['daemon']['socket'].get(str)
+    return os.path.abspath(os.path.expanduser(path))
+
+
+class Daemon(MultiRunner):
+    """MultiRunner that runs until it is asked to stop, and accepts new runs
+    from clients connected to a Unix domain socket."""
+    def __init__(self, *args, socket_path=None, history_size=100, **kwargs):
+        super(Daemon, self).__init__(*args, **kwargs)
+        self.socket_path = socket_path or default_socket_path()
+        self.finished_runs = deque(maxlen=history_size)
+        self.keep_alive = True
+        self._server = None
+        self._serve_task = None
+
+    def _finish_run(self, run):
+        super(Daemon, self)._finish_run(run)
+        self._runs.remove(run)
+        self.finished_runs.append(self.run_status(run))
+
+    async def _handle_client(self, reader, writer):
+        try:
+            while 1:
+                line = await reader.readline()
+
+                if not line:
+                    break
+
+                try:
+                    request = json.loads(line.decode())
+                    response = self.handle_request(request)
+                except Exception as e:
+                    log.exception('Daemon request failed')
+                    response = {'ok': False, 'error': str(e)}
+
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def _serve(self):
+        try:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+            self._server = await asyncio.start_unix_server(
+                self._handle_client,
+                path=self.socket_path
+            )
+            log.info(f'Daemon listening on {self.socket_path}')
+            await asyncio.Event().wait()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if self._server is not None:
+                self._server.close()
+
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+
+            log.info('Daemon stopped listening')
+
+    def handle_request(self, request):
+        """Dispatches a request message and returns the response message"""
+        action = request.get('action')
+
+        if action == 'run':
+            run = self.submit(
+                project=request.get('project'),
+                workflow=request.get('workflow'),
+                reset_method=request.get('reset_method', 'retry')
+            )
+            return {'ok': True, 'run': self.run_status(run)}
+        elif action == 'status':
+            runs = [self.run_status(r) for r in self._runs]
+            history = list(self.finished_runs)
+            return {'ok': True, 'runs': runs, 'history': history}
+        elif action == 'stop':
+            log.info('Daemon stop requested, finishing active runs')
+            self.keep_alive = False
+            self.notify_waiters()
+            return {'ok': True}
+        else:
+            raise ValueError(f'Unrecognized daemon action: {action}')
+
+    def preflight(self):
+        super(Daemon, self).preflight()
+        # Keep a reference, the loop only holds weak references to tasks
+        self._serve_task = self.loop.create_task(self._serve())
+
+    def run_status(self, run):
+        return {
+            'project': run.project.path if run.project else None,
+            'workflow': run.workflow.path,
+            'done': run.done,
+            'summary': run.workflow.summary(),
+        }
+
+    def serve(self):
+        """Starts the daemon. This returns after a stop request, once all of
+        the active runs are done."""
+        self._runs = []
+        self._task_runs = {}
+
+        try:
+            self._run()
+        finally:
+            for run in self._runs:
+                if run.project and run.project.lock.is_locked:
+                    run.project.lock.release()
+
+    def submit(self, project=None, workflow=None, reset_method='retry'):
+        """Adds a new run for a project, a workflow file, or both. Locks are
+        acquired without waiting, since waiting would block the event loop."""
+        if not (project or workflow):
+            raise ValueError('Run requests need a project or workflow path')
+
+        if not self.keep_alive:
+            raise RuntimeError('Daemon is shutting down')
+
+        if project:
+            project = jetstream.Project(project)
+
+            for run in self._runs:
+                if run.project and run.project.path == project.path:
+                    raise RuntimeError(f'Already running: {project}')
+
+            try:
+                project.lock.acquire(timeout=0)
+            except filelock.Timeout:
+                err = f'Failed to acquire project lock: {project.paths.pid_path}'
+                raise TimeoutError(err) from None
+
+            try:
+                wf = project.load_workflow()
+
+                if workflow:
+                    new = jetstream.load_workflow(workflow)
+                    wf = jetstream.workflows.mash(wf, new)
+                    wf.path = project.paths.workflow_path
+            except Exception:
+                project.lock.release()
+                raise
+        else:
+            wf = jetstream.load_workflow(workflow)
+
+        wf.reset(reset_method)
+        log.info(f'Daemon received run: {project or wf.path}')
+        return self.add_run(wf, project)
+
+
+def request(message, socket_path=None, timeout=None):
+    """Sends a single request to the daemon and returns the response. Raises
+    a RuntimeError if the daemon reports an error."""
+    socket_path = socket_path or default_socket_path()
+    started = datetime.now()
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(message).encode() + b'\n')
+
+        with sock.makefile('rb') as fp:
+            line = fp.readline()
+
+    log.debug(f'Daemon responded after {datetime.now() - started}')
+
+    if not line:
+        raise RuntimeError('Daemon closed the connection without a response')
+
+    response = json.loads(line.decode())
+
+    if not response.get('ok'):
+        raise RuntimeError(f'Daemon error: {response.get("error")}')
+
+    return response
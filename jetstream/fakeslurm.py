@@ -0,0 +1,1651 @@
+"""Fake Slurm cluster for tests and benchmarks
+
+The SlurmBackend can only be run against a Slurm cluster. This module is a
+small stand-in that runs on one machine: `sbatch`, `squeue`, `sacct`,
+`scancel`, `sacctmgr` and `sinfo` commands that talk to a scheduler daemon over a Unix
+domain socket. The daemon runs jobs as local processes, or pretends to run
+them for a fixed time, and answers queries in the same formats as Slurm:
+
+    python jetstream/fakeslurm.py serve --dir /tmp/slurm --cpus 8 \\
+        --queue-delay 1 &
+    PATH=/tmp/slurm/bin:$PATH jetstream run -b slurm ...
+
+Or from Python, with the commands given to the backend:
+
+    with FakeSlurm('/tmp/slurm', cpus=8) as cluster:
+        backend = SlurmBackend(**cluster.executables())
+
+Supported:
+
+- sbatch: scripts from a file, stdin or --wrap, #SBATCH lines, -J -o -e -i
+  -c -n --mem -t -D -p --comment --parsable, --array (ranges, steps and a %
+  limit), --dependency (after, afterok, afternotok, afterany) and
+  --kill-on-invalid-dep. Other options are accepted and ignored.
+- squeue: -h -r -u -j -t -p and -o formats with the common % fields.
+  Pending array elements are collapsed into <id>_[<indices>] unless -r.
+- sacct: -P -p --delimiter -o/--format -j -S -X -n -s, with job lines,
+  batch and extern steps, and compressed pending array elements.
+- scancel: job ids, array elements, -u and -n.
+- sacctmgr: the MaxSubmit lookup done by the SlurmBackend.
+- sinfo: -h -p and -o formats with the common % fields, one line for each
+  partition.
+
+The cluster has one partition, or the ones given by --partitions as
+name[:cpus[:mem[:minutes]]] separated by commas, e.g. short:4::30,long:16.
+Each partition is one node with its own cpus and memory, jobs without a
+time limit get the limit of their partition and jobs over it are rejected.
+Scheduling is first in, first out in each partition, with backfill over the
+jobs that fit in the free cpus and memory. Options of the daemon make it misbehave like a
+busy cluster: a queue delay (with jitter) before jobs can start, a rate of
+jobs ending with NODE_FAIL, sbatch and sacct failures, a MaxSubmitJobs
+limit, and an accounting delay (sacct reports the state each job had that
+many seconds ago, like a slow slurmdbd). Jobs that go over their time limit
+end with TIMEOUT, and jobs whose max RSS was over --mem end with
+OUT_OF_MEMORY after they exit.
+
+This module only uses the standard library, the commands load it from its
+file without importing jetstream, so that they start quickly. asyncio is
+only imported by the daemon for the same reason.
+"""
+import argparse
+import getpass
+import heapq
+import json
+import logging
+import os
+import random
+import re
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import time
+from collections import defaultdict, deque
+from datetime import datetime
+
+log = logging.getLogger('jetstream.fakeslurm')
+
+COMMANDS = ('sbatch', 'squeue', 'sacct', 'scancel', 'sacctmgr', 'sinfo')
+VERSION = 'slurm 20.11.9'
+SOCKET_NAME = 'slurmctld.sock'
+FIRST_JOB_ID = 1000
+# SLURM_ARRAY_TASK_ID of jobs that are not array elements (NO_VAL)
+NO_VAL = 4294967294
+
+COMMAND_TEMPLATE = '''#!{python}
+import importlib.util
+import sys
+spec = importlib.util.spec_from_file_location('fakeslurm', {module!r})
+fakeslurm = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(fakeslurm)
+sys.exit(fakeslurm.client({command!r}, sys.argv[1:], {socket_path!r}))
+'''
+
+SHORT_STATES = {
+    'PENDING': 'PD',
+    'RUNNING': 'R',
+    'COMPLETED': 'CD',
+    'FAILED': 'F',
+    'CANCELLED': 'CA',
+    'TIMEOUT': 'TO',
+    'NODE_FAIL': 'NF',
+    'OUT_OF_MEMORY': 'OOM',
+}
+
+SACCT_FIELDS = (
+    'JobID', 'JobIDRaw', 'JobName', 'Partition', 'Account', 'User',
+    'AllocCPUS', 'ReqCPUS', 'ReqMem', 'State', 'ExitCode', 'DerivedExitCode',
+    'Submit', 'Eligible', 'Start', 'End', 'Elapsed', 'ElapsedRaw',
+    'Timelimit', 'NodeList', 'Comment', 'WorkDir', 'MaxRSS', 'TotalCPU',
+    'UserCPU', 'SystemCPU', 'Reason',
+)
+SACCT_DEFAULT_FORMAT = ('JobID', 'JobName', 'Partition', 'Account',
+                        'AllocCPUS', 'State', 'ExitCode')
+
+SQUEUE_DEFAULT_FORMAT = '%.18i %.9P %.8j %.8u %.2t %.10M %.6D %R'
+SQUEUE_HEADERS = {
+    'i': 'JOBID', 'A': 'JOBID', 'F': 'ARRAY_JOB_ID', 'K': 'ARRAY_TASK_ID',
+    'j': 'NAME', 'u': 'USER', 'T': 'STATE', 't': 'ST', 'P': 'PARTITION',
+    'M': 'TIME', 'l': 'TIME_LIMIT', 'C': 'CPUS', 'm': 'MIN_MEMORY',
+    'D': 'NODES', 'R': 'NODELIST(REASON)', 'r': 'REASON', 'Z': 'WORK_DIR',
+    'k': 'COMMENT', 'V': 'SUBMIT_TIME', 'S': 'START_TIME',
+}
+squeue_field_pattern = re.compile(r'%(\.?)(\d*)([a-zA-Z%])')
+
+SINFO_DEFAULT_FORMAT = '%9P %.5a %.10l %.6D %.6t %N'
+SINFO_HEADERS = {
+    'P': 'PARTITION', 'R': 'PARTITION', 'a': 'AVAIL', 'l': 'TIMELIMIT',
+    'D': 'NODES', 't': 'STATE', 'T': 'STATE', 'C': 'CPUS(A/I/O/T)',
+    'c': 'CPUS', 'm': 'MEMORY', 'N': 'NODELIST',
+}
+
+# Errors printed by the real commands
+SUBMIT_TIMEOUT = 'sbatch: error: Batch job submission failed: Socket timed ' \
+                 'out on send/recv operation'
+SUBMIT_LIMIT = 'sbatch: error: QOSMaxSubmitJobPerUserLimit\n' \
+               'sbatch: error: Batch job submission failed: Job violates ' \
+               'accounting/QOS policy (job submit limit, user\'s size and/or ' \
+               'time limits)'
+SUBMIT_CONFIG = 'sbatch: error: Batch job submission failed: Requested node ' \
+                'configuration is not available'
+SUBMIT_PARTITION = 'sbatch: error: invalid partition specified: {}\n' \
+                   'sbatch: error: Batch job submission failed: Invalid ' \
+                   'partition name specified'
+SUBMIT_TIME_LIMIT = 'sbatch: error: Batch job submission failed: Requested ' \
+                    'time limit is invalid (missing or exceeds some limit)'
+SUBMIT_DEPENDENCY = 'sbatch: error: Batch job submission failed: Job ' \
+                    'dependency problem'
+SACCT_TIMEOUT = 'sacct: error: slurmdbd: Getting response to message type: ' \
+                'DBD_GET_JOBS_COND\nsacct: error: Problem talking to the ' \
+                'database: Socket timed out on send/recv operation'
+NOT_A_SCRIPT = 'sbatch: error: This does not look like a batch script.  The ' \
+               'first\nsbatch: error: line must start with #! followed by ' \
+               'the path to an interpreter.'
+
+
+class SlurmError(Exception):
+    """Makes a command exit with code 1 and print the message on stderr"""
+
+
+class ArgumentParser(argparse.ArgumentParser):
+    def error(self, message):
+        raise SlurmError(f'{self.prog}: error: {message}')
+
+
+def parse_time(value):
+    """Returns the seconds in a Slurm time: M, M:S, H:M:S, D-H, D-H:M, or
+    D-H:M:S. Returns None for UNLIMITED."""
+    if value is None or value.upper() in ('UNLIMITED', 'INFINITE', '-1'):
+        return None
+
+    try:
+        days = 0
+        if '-' in value:
+            d, value = value.split('-', 1)
+            days = int(d)
+            parts = [int(p) for p in value.split(':')]
+            h, m, s = (parts + [0, 0])[:3]
+        else:
+            parts = [int(p) for p in value.split(':')]
+            if len(parts) == 1:
+                h, m, s = 0, parts[0], 0
+            elif len(parts) == 2:
+                h, m, s = 0, parts[0], parts[1]
+            else:
+                h, m, s = parts[:3]
+    except ValueError:
+        raise SlurmError('sbatch: error: Invalid time limit specification')
+
+    return ((days * 24 + h) * 60 + m) * 60 + s
+
+
+def parse_mem(value):
+    """Returns megabytes for a Slurm memory size, megabytes by default"""
+    match = re.match(r'^(\d+(?:\.\d+)?)([KMGT]?)B?$', str(value).upper())
+
+    if not match:
+        raise SlurmError('sbatch: error: Invalid --mem specification')
+
+    number, unit = match.groups()
+    scale = {'K': 1 / 1024, '': 1, 'M': 1, 'G': 1024, 'T': 1024 ** 2}[unit]
+    return int(float(number) * scale)
+
+
+def parse_partitions(value, cpus, mem=None):
+    """Returns {name: Partition} for a --partitions value, missing cpus and
+    mem are the given defaults"""
+    partitions = {}
+
+    for spec in value.split(','):
+        name, *fields = spec.strip().split(':')
+        fields += [''] * (3 - len(fields))
+
+        if not name or len(fields) > 3:
+            raise ValueError(f'Invalid partition: {spec}')
+
+        partitions[name] = Partition(
+            name,
+            cpus=int(fields[0]) if fields[0] else cpus,
+            mem=parse_mem(fields[1]) if fields[1] else mem,
+            max_time=parse_time(fields[2]) if fields[2] else None
+        )
+
+    return partitions
+
+
+def parse_array(value):
+    """Returns (indices, limit) for an --array specification like
+    0-9:2,15%4"""
+    spec, _, limit = value.partition('%')
+    indices = []
+
+    try:
+        for part in spec.split(','):
+            rng, _, step = part.partition(':')
+            first, _, last = rng.partition('-')
+            first = int(first)
+            last = int(last) if last else first
+            indices.extend(range(first, last + 1, int(step or 1)))
+
+        limit = int(limit) if limit else None
+    except ValueError:
+        raise SlurmError('sbatch: error: Invalid job array specification')
+
+    if not indices:
+        raise SlurmError('sbatch: error: Invalid job array specification')
+
+    return sorted(set(indices)), limit
+
+
+def parse_dependency(value):
+    """Returns [(type, [job ids]), ...] for a --dependency specification.
+    All of them must be satisfied (the "," form)."""
+    dependencies = []
+
+    for part in value.split(','):
+        kind, *ids = part.split(':')
+
+        if kind not in ('after', 'afterok', 'afternotok', 'afterany') \
+                or not ids:
+            raise SlurmError(SUBMIT_DEPENDENCY)
+
+        dependencies.append((kind, ids))
+
+    return dependencies
+
+
+def compress_indices(indices):
+    """Formats array indices like Slurm: 0-3,7,9-10"""
+    ranges = []
+
+    for i in sorted(indices):
+        if ranges and ranges[-1][1] == i - 1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+
+    return ','.join(str(a) if a == b else f'{a}-{b}' for a, b in ranges)
+
+
+def format_elapsed(seconds):
+    """Formats seconds like Slurm elapsed times: [D-]HH:MM:SS"""
+    seconds = int(seconds)
+    m, s = divmod(seconds, 60)
+    h, m = divmod(m, 60)
+    d, h = divmod(h, 24)
+    value = f'{h:02d}:{m:02d}:{s:02d}'
+    return f'{d}-{value}' if d else value
+
+
+def format_time_limit(seconds):
+    """Formats a time limit like sinfo: [D-][HH:]MM:SS, or infinite"""
+    if seconds is None:
+        return 'infinite'
+
+    value = format_elapsed(seconds)
+    return value[3:] if value.startswith('00:') else value
+
+
+def format_cpu_time(seconds):
+    """Formats cpu seconds like sacct: [D-][HH:]MM:SS.mmm"""
+    ms = int(round(seconds * 1000))
+    s, ms = divmod(ms, 1000)
+    m, s = divmod(s, 60)
+    h, m = divmod(m, 60)
+    d, h = divmod(h, 24)
+
+    if d:
+        return f'{d}-{h:02d}:{m:02d}:{s:02d}'
+    elif h:
+        return f'{h:02d}:{m:02d}:{s:02d}'
+    return f'{m:02d}:{s:02d}.{ms:03d}'
+
+
+def format_timestamp(t):
+    if t is None:
+        return 'Unknown'
+    return datetime.fromtimestamp(t).strftime('%Y-%m-%dT%H:%M:%S')
+
+
+def parse_timestamp(value):
+    """Returns the epoch time of a sacct --starttime value"""
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d',
+                '%m/%d/%y', '%m/%d'):
+        try:
+            return datetime.strptime(value, fmt).timestamp()
+        except ValueError:
+            continue
+
+    raise SlurmError(f'sacct: error: Invalid time specification: {value}')
+
+
+class Partition:
+    """A partition of the fake cluster, one node with cpus and memory (MB,
+    None for no limit). max_time is the time limit in seconds."""
+    def __init__(self, name, cpus, mem=None, max_time=None):
+        self.name = name
+        self.cpus = cpus
+        self.mem = mem
+        self.max_time = max_time
+        self.free_cpus = cpus
+        self.free_mem = mem
+        self.ready = deque()
+
+    def __repr__(self):
+        return f'<Partition {self.name} {self.free_cpus}/{self.cpus} cpus>'
+
+    def fits(self, sub):
+        """True if a job could ever run here"""
+        return sub.cpus <= self.cpus \
+            and (self.mem is None or (sub.mem or 0) <= self.mem)
+
+    def can_start(self, sub):
+        return sub.cpus <= self.free_cpus \
+            and (self.free_mem is None or (sub.mem or 0) <= self.free_mem)
+
+    def allocate(self, sub, sign=1):
+        self.free_cpus -= sign * sub.cpus
+        if self.free_mem is not None:
+            self.free_mem -= sign * (sub.mem or 0)
+
+
+class Submission:
+    """Options and script of one sbatch call, shared by the elements of a
+    job array"""
+    def __init__(self, options, script, env, user):
+        self.name = options.job_name or 'sbatch'
+        self.output = options.output
+        self.error = options.error
+        self.input = options.input
+        self.cpus = (options.cpus_per_task or 1) * (options.ntasks or 1)
+        self.mem = parse_mem(options.mem) if options.mem else None
+        self.time_limit = parse_time(options.time)
+        self.workdir = options.chdir
+        self.comment = options.comment or ''
+        self.partition = options.partition
+        self.dependencies = parse_dependency(options.dependency) \
+            if options.dependency else []
+        self.kill_on_invalid_dep = options.kill_on_invalid_dep == 'yes'
+        self.array_limit = None
+        self.script = script
+        self.script_path = None
+        self.env = env
+        self.user = user
+
+
+class Job:
+    """One job, or one element of a job array"""
+    def __init__(self, job_id, raw_id, submission, array_id=None,
+                 array_index=None):
+        self.job_id = job_id
+        self.raw_id = raw_id
+        self.submission = submission
+        self.array_id = array_id
+        self.array_index = array_index
+        self.state = 'PENDING'
+        self.reason = 'None'
+        self.exit_code = '0:0'
+        self.submit_time = time.time()
+        self.eligible_time = self.submit_time
+        self.start_time = None
+        self.end_time = None
+        self.process = None
+        self.rusage = None
+        self.timed_out = False
+        self.cancelled_by = None
+        self.history = [(self.submit_time, 'PENDING')]
+
+    def __repr__(self):
+        return f'<Job {self.job_id} {self.state}>'
+
+    def __lt__(self, other):
+        return self.raw_id < other.raw_id
+
+    @property
+    def base_id(self):
+        return self.array_id or self.job_id
+
+    def set_state(self, state, t=None):
+        self.state = state
+        self.history.append((t or time.time(), state))
+
+    def state_at(self, t):
+        """Returns the state this job had at time t, or None if it had not
+        been submitted"""
+        for when, state in reversed(self.history):
+            if when <= t:
+                return state
+        return None
+
+    def expand_path(self, path):
+        """Replaces the filename patterns of -o/-e/-i paths"""
+        sub = self.submission
+        replacements = {
+            '%': '%',
+            'j': str(self.raw_id),
+            'A': str(self.array_id or self.raw_id),
+            'a': str(self.array_index if self.array_index is not None
+                     else NO_VAL),
+            'x': sub.name,
+            'u': sub.user,
+            'N': 'localhost',
+        }
+        path = re.sub(r'%([%jAaxuN])', lambda m: replacements[m.group(1)],
+                      path)
+        return os.path.join(sub.workdir, path)
+
+
+class Scheduler:
+    """The fake Slurm controller and accounting database.
+
+    :param directory: Directory for the socket, scripts and logs
+    :param cpus: Cpus that jobs can use at once, defaults to the cpus here
+    :param mem: Memory (MB) that jobs can use at once, None for no limit
+    :param partitions: Partitions as name[:cpus[:mem[:minutes]]] separated
+        by commas, cpus and mem default to the cpus and mem options. None is
+        one partition named by the partition option.
+    :param queue_delay: Seconds a job waits before it can start
+    :param queue_jitter: Up to this many seconds are added to the queue
+        delay at random
+    :param runtime: If set, jobs are not run, each one completes after this
+        many seconds (and uses no cpu time or memory)
+    :param fail_rate: Fraction of jobs that end with NODE_FAIL when started
+    :param submit_fail_rate: Fraction of sbatch calls that time out
+    :param sacct_fail_rate: Fraction of sacct calls that time out
+    :param accounting_delay: sacct reports the state of jobs this many
+        seconds ago
+    :param max_submit_jobs: Limit on the pending and running jobs of a user,
+        reported by sacctmgr and enforced by sbatch
+    :param partition: Default partition name, the first of the partitions
+        if it is not one of them
+    :param sched_depth: Pending jobs looked at by each scheduling pass
+    :param interval: Seconds between scheduling passes
+    :param seed: Seed for the random failures and jitter
+    """
+    def __init__(self, directory, cpus=None, mem=None, queue_delay=0,
+                 queue_jitter=0, runtime=None, fail_rate=0,
+                 submit_fail_rate=0, sacct_fail_rate=0, accounting_delay=0,
+                 max_submit_jobs=None, partition='debug', partitions=None,
+                 sched_depth=1000, interval=0.05, seed=None):
+        self.directory = os.path.abspath(directory)
+        self.socket_path = os.path.join(self.directory, SOCKET_NAME)
+        self.scripts_dir = os.path.join(self.directory, 'scripts')
+        self.cpus = cpus or os.cpu_count() or 1
+        self.mem = mem
+        self.queue_delay = queue_delay
+        self.queue_jitter = queue_jitter
+        self.runtime = runtime
+        self.fail_rate = fail_rate
+        self.submit_fail_rate = submit_fail_rate
+        self.sacct_fail_rate = sacct_fail_rate
+        self.accounting_delay = accounting_delay
+        self.max_submit_jobs = max_submit_jobs
+        self.sched_depth = sched_depth
+        self.interval = interval
+        self.random = random.Random(seed)
+
+        self.jobs = {}
+        self.arrays = {}
+        self.active = {}
+        self._next_id = FIRST_JOB_ID
+        self._waiting = []
+        self._held = defaultdict(list)
+        self._simulated = []
+        self._pids = {}
+        self._array_running = defaultdict(int)
+        self._stopped = None
+
+        if partitions:
+            self.partitions = parse_partitions(partitions, self.cpus, mem)
+        else:
+            self.partitions = {partition: Partition(partition, self.cpus, mem)}
+
+        if partition not in self.partitions:
+            partition = next(iter(self.partitions))
+        self.partition = partition
+
+        os.makedirs(self.scripts_dir, exist_ok=True)
+
+    def __repr__(self):
+        return f'<Scheduler {len(self.active)} active, ' \
+               f'{len(self.jobs)} jobs>'
+
+    # Jobs
+    def find(self, job_id):
+        """Returns the jobs for an id: a job, an array element, or every
+        element of an array"""
+        if job_id in self.arrays:
+            return self.arrays[job_id]
+        elif job_id in self.jobs:
+            return [self.jobs[job_id]]
+        return []
+
+    def dependency_status(self, job):
+        """Returns "ok" if a job's dependencies are satisfied, "wait" if
+        they may still be, or "never" """
+        waiting = False
+
+        for kind, ids in job.submission.dependencies:
+            for jid in ids:
+                for dep in self.find(jid):
+                    if kind == 'after':
+                        if dep.start_time is None and dep.end_time is None:
+                            waiting = True
+                    elif dep.end_time is None:
+                        waiting = True
+                    elif kind == 'afterok' and dep.state != 'COMPLETED':
+                        return 'never'
+                    elif kind == 'afternotok' and dep.state == 'COMPLETED':
+                        return 'never'
+
+        return 'wait' if waiting else 'ok'
+
+    def enqueue(self, job):
+        """Queues a job that has become eligible to start, or holds it until
+        its dependencies are satisfied"""
+        status = self.dependency_status(job)
+
+        if status == 'ok':
+            job.reason = 'Priority'
+            self.partitions[job.submission.partition].ready.append(job)
+        elif status == 'wait':
+            job.reason = 'Dependency'
+            for kind, ids in job.submission.dependencies:
+                for jid in ids:
+                    self._held[jid].append(job)
+        elif job.submission.kill_on_invalid_dep:
+            job.reason = 'DependencyNeverSatisfied'
+            self.finish(job, 'CANCELLED')
+        else:
+            job.reason = 'DependencyNeverSatisfied'
+
+    def start(self, job):
+        sub = job.submission
+        job.start_time = time.time()
+        job.set_state('RUNNING', job.start_time)
+        job.reason = 'None'
+        self.partitions[sub.partition].allocate(sub)
+        if job.array_id:
+            self._array_running[job.array_id] += 1
+
+        if self.fail_rate and self.random.random() < self.fail_rate:
+            self.finish(job, 'NODE_FAIL')
+        elif self.runtime is not None:
+            end = job.start_time + self.runtime
+            if sub.time_limit is not None and self.runtime > sub.time_limit:
+                job.timed_out = True
+                end = job.start_time + sub.time_limit
+            heapq.heappush(self._simulated, (end, job))
+        else:
+            try:
+                self.launch(job)
+            except OSError as e:
+                log.error(f'Failed to start job {job.job_id}: {e}')
+                self.finish(job, 'FAILED', '1:0')
+
+    def launch(self, job):
+        """Runs the batch script of a job in its own session"""
+        sub = job.submission
+        env = dict(sub.env or os.environ)
+        env.update(
+            SLURM_JOB_ID=str(job.raw_id),
+            SLURM_JOBID=str(job.raw_id),
+            SLURM_JOB_NAME=sub.name,
+            SLURM_JOB_PARTITION=sub.partition,
+            SLURM_CPUS_PER_TASK=str(sub.cpus),
+            SLURM_SUBMIT_DIR=sub.workdir,
+            SLURM_CLUSTER_NAME='fake',
+        )
+
+        if job.array_id:
+            env.update(SLURM_ARRAY_JOB_ID=job.array_id,
+                       SLURM_ARRAY_TASK_ID=str(job.array_index))
+
+        if job.array_id:
+            default_output = 'slurm-%A_%a.out'
+        else:
+            default_output = 'slurm-%j.out'
+
+        stdout_path = job.expand_path(sub.output or default_output)
+        stderr_path = job.expand_path(sub.error) if sub.error else None
+        stdin = open(job.expand_path(sub.input), 'rb') if sub.input \
+            else subprocess.DEVNULL
+        stdout = stderr = None
+
+        try:
+            stdout = open(stdout_path, 'wb')
+            if stderr_path and stderr_path != stdout_path:
+                stderr = open(stderr_path, 'wb')
+
+            job.process = subprocess.Popen(
+                [sub.script_path],
+                cwd=sub.workdir,
+                env=env,
+                stdin=stdin,
+                stdout=stdout,
+                stderr=stderr or stdout,
+                start_new_session=True
+            )
+            self._pids[job.process.pid] = job
+        finally:
+            for fp in (stdin, stdout, stderr):
+                if fp not in (None, subprocess.DEVNULL):
+                    fp.close()
+
+    def finish(self, job, state, exit_code='0:0'):
+        """Ends a job, frees its resources and releases the jobs that
+        depend on it"""
+        was_running = job.state == 'RUNNING'
+        job.end_time = time.time()
+        job.exit_code = exit_code
+        job.set_state(state, job.end_time)
+        self.active.pop(job.job_id, None)
+
+        if was_running:
+            self.partitions[job.submission.partition].allocate(
+                job.submission, -1)
+            if job.array_id:
+                self._array_running[job.array_id] -= 1
+
+        for key in (job.job_id, job.array_id):
+            if key is None:
+                continue
+
+            for dependent in self._held.pop(key, ()):
+                if dependent.state == 'PENDING' \
+                        and dependent.reason == 'Dependency':
+                    self.enqueue(dependent)
+
+    def cancel(self, job, uid=None):
+        """Cancels a pending job, or signals a running one"""
+        state = 'CANCELLED' if uid is None else f'CANCELLED by {uid}'
+
+        if job.state == 'PENDING':
+            self.finish(job, state)
+        elif job.state == 'RUNNING':
+            job.cancelled_by = state
+
+            if job.process is not None:
+                try:
+                    os.killpg(job.process.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            else:
+                self.finish(job, state, '0:15')
+
+    def reap(self):
+        """Collects the exit status and rusage of finished job processes"""
+        while self._pids:
+            try:
+                pid, status, ru = os.wait4(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+
+            if pid == 0:
+                return
+
+            job = self._pids.pop(pid, None)
+            if job is None:
+                continue
+
+            job.rusage = ru
+            job.process.returncode = status
+
+            if os.WIFSIGNALED(status):
+                exit_code = f'0:{os.WTERMSIG(status)}'
+                rc = -1
+            else:
+                rc = os.WEXITSTATUS(status)
+                exit_code = f'{rc}:0'
+
+            mem = job.submission.mem
+            if job.timed_out:
+                state = 'TIMEOUT'
+            elif job.cancelled_by:
+                state = job.cancelled_by
+            elif mem and ru.ru_maxrss / 1024 > mem:
+                state, exit_code = 'OUT_OF_MEMORY', '0:125'
+            elif rc == 0:
+                state = 'COMPLETED'
+            else:
+                state = 'FAILED'
+
+            self.finish(job, state, exit_code)
+
+    def tick(self):
+        """One scheduling pass"""
+        now = time.time()
+        self.reap()
+
+        # Time limits
+        for job in list(self.active.values()):
+            limit = job.submission.time_limit
+            if job.process is not None and limit is not None \
+                    and not job.timed_out and now - job.start_time > limit:
+                job.timed_out = True
+                try:
+                    os.killpg(job.process.pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+        # Jobs with a simulated runtime
+        while self._simulated and self._simulated[0][0] <= now:
+            end, job = heapq.heappop(self._simulated)
+            if job.state != 'RUNNING':
+                continue
+            if job.timed_out:
+                self.finish(job, 'TIMEOUT')
+            elif job.cancelled_by:
+                self.finish(job, job.cancelled_by, '0:15')
+            else:
+                self.finish(job, 'COMPLETED')
+
+        while self._waiting and self._waiting[0][0] <= now:
+            eligible, job = heapq.heappop(self._waiting)
+            if job.state == 'PENDING':
+                self.enqueue(job)
+
+        self.schedule()
+
+    def schedule(self):
+        """Starts the ready jobs that fit, in order, looking at up to
+        sched_depth of them in each partition"""
+        for partition in self.partitions.values():
+            kept = deque()
+            looked = 0
+
+            while partition.ready and looked < self.sched_depth \
+                    and partition.free_cpus:
+                job = partition.ready.popleft()
+                if job.state != 'PENDING':
+                    continue
+
+                looked += 1
+                sub = job.submission
+
+                if job.array_id and sub.array_limit is not None \
+                        and self._array_running[job.array_id] \
+                        >= sub.array_limit:
+                    job.reason = 'JobArrayTaskLimit'
+                    kept.append(job)
+                elif partition.can_start(sub):
+                    self.start(job)
+                else:
+                    job.reason = 'Resources'
+                    kept.append(job)
+
+            kept.extend(partition.ready)
+            partition.ready = kept
+
+    # Commands
+    def sbatch_parser(self):
+        parser = ArgumentParser(prog='sbatch', add_help=False,
+                                allow_abbrev=False)
+        parser.add_argument('-J', '--job-name')
+        parser.add_argument('-o', '--output')
+        parser.add_argument('-e', '--error')
+        parser.add_argument('-i', '--input')
+        parser.add_argument('-c', '--cpus-per-task', type=int)
+        parser.add_argument('-n', '--ntasks', type=int)
+        parser.add_argument('--mem')
+        parser.add_argument('-t', '--time')
+        parser.add_argument('-D', '--chdir')
+        parser.add_argument('-p', '--partition')
+        parser.add_argument('--comment')
+        parser.add_argument('-a', '--array')
+        parser.add_argument('-d', '--dependency')
+        parser.add_argument('--kill-on-invalid-dep', choices=('yes', 'no'))
+        parser.add_argument('--parsable', action='store_true')
+        parser.add_argument('--wrap')
+        parser.add_argument('script', nargs='?')
+        parser.add_argument('script_args', nargs=argparse.REMAINDER)
+        return parser
+
+    def needs_stdin(self, args):
+        """True if sbatch reads the script from stdin"""
+        try:
+            options, _ = self.sbatch_parser().parse_known_args(args)
+        except SlurmError:
+            return False
+        return not (options.script or options.wrap)
+
+    def sbatch(self, args, cwd, env=None, user=None, stdin=None):
+        parser = self.sbatch_parser()
+        options, _ = parser.parse_known_args(args)
+
+        if options.wrap:
+            script = f'#!/bin/sh\n{options.wrap}\n'
+        elif options.script:
+            try:
+                with open(os.path.join(cwd, options.script)) as fp:
+                    script = fp.read()
+            except OSError as e:
+                raise SlurmError(f'sbatch: error: Unable to open file '
+                                 f'{options.script}: {e.strerror}')
+        else:
+            script = stdin or ''
+
+        if not script.startswith('#!'):
+            raise SlurmError(NOT_A_SCRIPT)
+
+        # #SBATCH lines before the first command, options given on the
+        # command line take precedence
+        directives = []
+        for line in script.splitlines()[1:]:
+            line = line.strip()
+            if line.startswith('#SBATCH'):
+                directives.extend(shlex.split(line[len('#SBATCH'):]))
+            elif line and not line.startswith('#'):
+                break
+
+        if directives:
+            options, _ = parser.parse_known_args(directives + list(args))
+
+        options.chdir = os.path.join(cwd, options.chdir or '')
+        options.partition = options.partition or self.partition
+        user = user or getpass.getuser()
+
+        partition = self.partitions.get(options.partition)
+        if partition is None:
+            raise SlurmError(SUBMIT_PARTITION.format(options.partition))
+
+        sub = Submission(options, script, env, user)
+
+        if sub.time_limit is None:
+            sub.time_limit = partition.max_time
+        elif partition.max_time is not None \
+                and sub.time_limit > partition.max_time:
+            raise SlurmError(SUBMIT_TIME_LIMIT)
+
+        if options.array:
+            indices, sub.array_limit = parse_array(options.array)
+        else:
+            indices = None
+
+        if self.submit_fail_rate \
+                and self.random.random() < self.submit_fail_rate:
+            raise SlurmError(SUBMIT_TIMEOUT)
+
+        if not partition.fits(sub):
+            raise SlurmError(SUBMIT_CONFIG)
+
+        for kind, ids in sub.dependencies:
+            for jid in ids:
+                if not self.find(jid):
+                    raise SlurmError(SUBMIT_DEPENDENCY)
+
+        count = len(indices) if indices else 1
+        if self.max_submit_jobs is not None:
+            queued = sum(1 for j in self.active.values()
+                         if j.submission.user == user)
+            if queued + count > self.max_submit_jobs:
+                raise SlurmError(SUBMIT_LIMIT)
+
+        base = self._next_id
+        self._next_id += count
+        sub.script_path = os.path.join(self.scripts_dir, f'{base}.sh')
+
+        if self.runtime is None:
+            with open(sub.script_path, 'w') as fp:
+                fp.write(script)
+            os.chmod(sub.script_path, 0o755)
+
+        if indices is None:
+            jobs = [Job(str(base), base, sub)]
+        else:
+            jobs = [Job(f'{base}_{index}', base + i, sub, str(base), index)
+                    for i, index in enumerate(indices)]
+            self.arrays[str(base)] = jobs
+
+        for job in jobs:
+            self.jobs[job.job_id] = job
+            self.active[job.job_id] = job
+            delay = self.queue_delay
+            if self.queue_jitter:
+                delay += self.random.uniform(0, self.queue_jitter)
+            job.eligible_time = job.submit_time + delay
+            heapq.heappush(self._waiting, (job.eligible_time, job))
+
+        log.info(f'Submitted {base} ({count} jobs): {sub.name}')
+
+        if options.parsable:
+            return f'{base}\n'
+        return f'Submitted batch job {base}\n'
+
+    def squeue(self, args, user=None):
+        parser = ArgumentParser(prog='squeue', add_help=False,
+                                allow_abbrev=False)
+        parser.add_argument('-h', '--noheader', action='store_true')
+        parser.add_argument('-r', '--array', action='store_true')
+        parser.add_argument('-u', '--user')
+        parser.add_argument('-j', '--jobs')
+        parser.add_argument('-t', '--states')
+        parser.add_argument('-p', '--partition')
+        parser.add_argument('-o', '--format', default=SQUEUE_DEFAULT_FORMAT)
+        options, _ = parser.parse_known_args(args)
+
+        if options.jobs:
+            jobs = []
+            for jid in options.jobs.split(','):
+                jobs.extend(j for j in self.find(jid) if j.end_time is None)
+        else:
+            jobs = list(self.active.values())
+
+        if options.user:
+            users = options.user.split(',')
+            jobs = [j for j in jobs if j.submission.user in users]
+
+        if options.states:
+            states = {s.upper() for s in options.states.split(',')}
+            jobs = [j for j in jobs
+                    if j.state in states or SHORT_STATES[j.state] in states]
+
+        if options.partition:
+            partitions = options.partition.split(',')
+            jobs = [j for j in jobs if j.submission.partition in partitions]
+
+        rows = []
+        collapsed = {}
+        for job in jobs:
+            if not options.array and job.array_id and job.state == 'PENDING':
+                if job.array_id in collapsed:
+                    collapsed[job.array_id].append(job.array_index)
+                    continue
+                collapsed[job.array_id] = [job.array_index]
+            rows.append(job)
+
+        fields = squeue_field_pattern.findall(options.format)
+        literals = squeue_field_pattern.split(options.format)[::4]
+        lines = []
+
+        if not options.noheader:
+            values = [SQUEUE_HEADERS.get(f[2], f[2].upper()) for f in fields]
+            lines.append(self._format_row(literals, fields, values))
+
+        now = time.time()
+        for job in rows:
+            if job.array_id in collapsed and job.state == 'PENDING':
+                indices = compress_indices(collapsed[job.array_id])
+                job_id = f'{job.array_id}_[{indices}]'
+            else:
+                job_id = job.job_id
+
+            values = [self.squeue_value(job, f[2], job_id, now)
+                      for f in fields]
+            lines.append(self._format_row(literals, fields, values))
+
+        return ''.join(line + '\n' for line in lines)
+
+    def _format_row(self, literals, fields, values):
+        out = [literals[0]]
+
+        for (right, width, _), value, literal in zip(fields, values,
+                                                     literals[1:]):
+            value = str(value)
+            if width:
+                width = int(width)
+                value = value[:width]
+                value = value.rjust(width) if right else value.ljust(width)
+            out.append(value)
+            out.append(literal)
+
+        return ''.join(out)
+
+    def squeue_value(self, job, field, job_id, now):
+        sub = job.submission
+        running = job.state == 'RUNNING'
+
+        if field == 'i':
+            return job_id
+        elif field == 'A':
+            return job.raw_id
+        elif field == 'F':
+            return job.array_id or job.raw_id
+        elif field == 'K':
+            return job.array_index if job.array_id else 'N/A'
+        elif field == 'j':
+            return sub.name
+        elif field == 'u':
+            return sub.user
+        elif field == 'T':
+            return job.state
+        elif field == 't':
+            return SHORT_STATES.get(job.state, job.state)
+        elif field == 'P':
+            return sub.partition
+        elif field == 'M':
+            return format_elapsed(now - job.start_time) if running \
+                else '0:00'
+        elif field == 'l':
+            return format_elapsed(sub.time_limit) \
+                if sub.time_limit is not None else 'UNLIMITED'
+        elif field == 'C':
+            return sub.cpus
+        elif field == 'm':
+            return f'{sub.mem}M' if sub.mem else '0'
+        elif field == 'D':
+            return 1
+        elif field == 'R':
+            return 'localhost' if running else f'({job.reason})'
+        elif field == 'r':
+            return job.reason
+        elif field == 'Z':
+            return sub.workdir
+        elif field == 'k':
+            return sub.comment
+        elif field == 'V':
+            return format_timestamp(job.submit_time)
+        elif field == 'S':
+            return format_timestamp(job.start_time) if running else 'N/A'
+        elif field == '%':
+            return '%'
+        return ''
+
+    def sacct(self, args, user=None):
+        parser = ArgumentParser(prog='sacct', add_help=False,
+                                allow_abbrev=False)
+        parser.add_argument('-P', '--parsable2', action='store_true')
+        parser.add_argument('-p', '--parsable', action='store_true')
+        parser.add_argument('--delimiter', default='|')
+        parser.add_argument('-o', '--format')
+        parser.add_argument('-j', '--jobs')
+        parser.add_argument('-S', '--starttime')
+        parser.add_argument('-X', '--allocations', action='store_true')
+        parser.add_argument('-n', '--noheader', action='store_true')
+        parser.add_argument('-s', '--state')
+        parser.add_argument('-u', '--user')
+        parser.add_argument('--name')
+        options, _ = parser.parse_known_args(args)
+
+        if self.sacct_fail_rate \
+                and self.random.random() < self.sacct_fail_rate:
+            raise SlurmError(SACCT_TIMEOUT)
+
+        if options.format is None:
+            fields = SACCT_DEFAULT_FORMAT
+        elif options.format.lower() == 'all':
+            fields = SACCT_FIELDS
+        else:
+            fields = []
+            lookup = {f.lower(): f for f in SACCT_FIELDS}
+            for name in options.format.split(','):
+                name = name.partition('%')[0]
+                if name.lower() not in lookup:
+                    raise SlurmError(f'sacct: error: Invalid field '
+                                     f'requested: "{name}"')
+                fields.append(lookup[name.lower()])
+
+        # What slurmdbd knows so far
+        t = time.time() - self.accounting_delay
+
+        # Pending array elements are shown as one line, unless they were
+        # asked for by their own ids
+        if options.jobs:
+            jobs = []
+            arrays = set()
+            for jid in options.jobs.split(','):
+                jobs.extend(self.find(jid))
+                if jid in self.arrays:
+                    arrays.add(jid)
+        else:
+            jobs = list(self.jobs.values())
+            arrays = set(self.arrays)
+
+        starttime = parse_timestamp(options.starttime) \
+            if options.starttime else None
+        users = options.user.split(',') if options.user else None
+        states = {s.upper() for s in options.state.split(',')} \
+            if options.state else None
+
+        rows = []
+        collapsed = {}
+        for job in jobs:
+            state = job.state_at(t)
+            if state is None:
+                continue
+
+            end = job.end_time if job.end_time is not None \
+                and job.end_time <= t else None
+            if starttime is not None and end is not None and end < starttime:
+                continue
+            if users and job.submission.user not in users:
+                continue
+            if options.name and job.submission.name != options.name:
+                continue
+            if states and state not in states \
+                    and SHORT_STATES.get(state) not in states:
+                continue
+
+            if job.array_id in arrays and state == 'PENDING':
+                if job.array_id in collapsed:
+                    collapsed[job.array_id].append(job.array_index)
+                    continue
+                collapsed[job.array_id] = [job.array_index]
+
+            rows.append((job, state))
+
+        parsable = options.parsable or options.parsable2
+        delimiter = options.delimiter if parsable else ' '
+        lines = []
+
+        def add(values):
+            if parsable:
+                line = delimiter.join(values)
+                if options.parsable:
+                    line += delimiter
+            else:
+                line = ' '.join(fit(v) for v in values)
+            lines.append(line)
+
+        def fit(value):
+            return value.rjust(10) if len(value) <= 10 else value[:9] + '+'
+
+        if not options.noheader:
+            add(list(fields))
+            if not parsable:
+                lines.append(' '.join('-' * 10 for f in fields))
+
+        for job, state in rows:
+            if job.array_id in collapsed and state == 'PENDING':
+                indices = compress_indices(collapsed[job.array_id])
+                job_id = f'{job.array_id}_[{indices}]'
+            else:
+                job_id = job.job_id
+
+            add([self.sacct_value(job, f, state, t, job_id) for f in fields])
+
+            if options.allocations or state == 'PENDING' \
+                    or job.start_time is None:
+                continue
+
+            for step in ('batch', 'extern'):
+                add([self.sacct_value(job, f, state, t, job_id, step)
+                     for f in fields])
+
+        return ''.join(line + '\n' for line in lines)
+
+    def sacct_value(self, job, field, state, t, job_id, step=None):
+        sub = job.submission
+        started = job.start_time is not None and job.start_time <= t
+        ended = job.end_time is not None and job.end_time <= t
+        suffix = f'.{step}' if step else ''
+
+        if step:
+            if state.startswith('CANCELLED') or state == 'TIMEOUT':
+                state = 'CANCELLED' if step == 'batch' else 'COMPLETED'
+            elif step == 'extern' and ended:
+                state = 'COMPLETED'
+
+        if field == 'JobID':
+            return job_id + suffix
+        elif field == 'JobIDRaw':
+            return str(job.raw_id) + suffix
+        elif field == 'JobName':
+            return step or sub.name
+        elif field == 'Partition':
+            return '' if step else sub.partition
+        elif field == 'Account':
+            return 'fake'
+        elif field == 'User':
+            return '' if step else sub.user
+        elif field == 'AllocCPUS':
+            return str(sub.cpus if started else 0)
+        elif field == 'ReqCPUS':
+            return str(sub.cpus)
+        elif field == 'ReqMem':
+            return f'{sub.mem}M' if sub.mem else '0'
+        elif field == 'State':
+            return state
+        elif field == 'ExitCode':
+            if not ended or (step == 'extern'):
+                return '0:0'
+            return job.exit_code
+        elif field == 'DerivedExitCode':
+            return '0:0'
+        elif field == 'Submit':
+            return format_timestamp(job.submit_time)
+        elif field == 'Eligible':
+            return format_timestamp(job.eligible_time)
+        elif field == 'Start':
+            return format_timestamp(job.start_time if started else None)
+        elif field == 'End':
+            return format_timestamp(job.end_time if ended else None)
+        elif field in ('Elapsed', 'ElapsedRaw'):
+            if not started:
+                elapsed = 0
+            else:
+                elapsed = (job.end_time if ended else t) - job.start_time
+            return format_elapsed(elapsed) if field == 'Elapsed' \
+                else str(int(elapsed))
+        elif field == 'Timelimit':
+            if step:
+                return ''
+            return format_elapsed(sub.time_limit) \
+                if sub.time_limit is not None else 'UNLIMITED'
+        elif field == 'NodeList':
+            return 'localhost' if started else 'None assigned'
+        elif field == 'Comment':
+            return '' if step else sub.comment
+        elif field == 'WorkDir':
+            return '' if step else sub.workdir
+        elif field == 'MaxRSS':
+            # Usage is only reported for steps
+            if step == 'batch' and ended and job.rusage is not None:
+                return f'{job.rusage.ru_maxrss}K'
+            return ''
+        elif field in ('TotalCPU', 'UserCPU', 'SystemCPU'):
+            if step == 'extern' or not ended or job.rusage is None:
+                return format_cpu_time(0)
+            ru = job.rusage
+            seconds = {
+                'TotalCPU': ru.ru_utime + ru.ru_stime,
+                'UserCPU': ru.ru_utime,
+                'SystemCPU': ru.ru_stime,
+            }[field]
+            return format_cpu_time(seconds)
+        elif field == 'Reason':
+            return job.reason
+        return ''
+
+    def scancel(self, args, user=None):
+        parser = ArgumentParser(prog='scancel', add_help=False,
+                                allow_abbrev=False)
+        parser.add_argument('-u', '--user')
+        parser.add_argument('-n', '--name')
+        parser.add_argument('job_ids', nargs='*')
+        options, _ = parser.parse_known_args(args)
+        uid = os.getuid()
+        errors = []
+
+        if options.job_ids:
+            jobs = []
+            for jid in options.job_ids:
+                found = self.find(jid)
+                if not found:
+                    errors.append(f'scancel: error: Kill job error on job '
+                                  f'id {jid}: Invalid job id specified')
+                jobs.extend(found)
+        elif options.user or options.name:
+            jobs = list(self.active.values())
+        else:
+            raise SlurmError('scancel: error: No job identification provided')
+
+        if options.user:
+            jobs = [j for j in jobs if j.submission.user == options.user]
+        if options.name:
+            jobs = [j for j in jobs if j.submission.name == options.name]
+
+        for job in jobs:
+            self.cancel(job, uid)
+
+        if errors:
+            raise SlurmError('\n'.join(errors))
+        return ''
+
+    def sacctmgr(self, args, user=None):
+        if 'show' in args and any(a.lower() == 'format=maxsubmit'
+                                  for a in args):
+            limit = self.max_submit_jobs
+            return f'{limit if limit is not None else ""}\n'
+        return ''
+
+    def sinfo(self, args, user=None):
+        parser = ArgumentParser(prog='sinfo', add_help=False,
+                                allow_abbrev=False)
+        parser.add_argument('-h', '--noheader', action='store_true')
+        parser.add_argument('-p', '--partition')
+        parser.add_argument('-o', '--format', default=SINFO_DEFAULT_FORMAT)
+        options, _ = parser.parse_known_args(args)
+
+        partitions = list(self.partitions.values())
+        if options.partition:
+            names = options.partition.split(',')
+            partitions = [p for p in partitions if p.name in names]
+
+        fields = squeue_field_pattern.findall(options.format)
+        literals = squeue_field_pattern.split(options.format)[::4]
+        lines = []
+
+        if not options.noheader:
+            values = [SINFO_HEADERS.get(f[2], f[2].upper()) for f in fields]
+            lines.append(self._format_row(literals, fields, values))
+
+        for partition in partitions:
+            values = [self.sinfo_value(partition, f[2]) for f in fields]
+            lines.append(self._format_row(literals, fields, values))
+
+        return ''.join(line + '\n' for line in lines)
+
+    def sinfo_value(self, partition, field):
+        allocated = partition.cpus - partition.free_cpus
+
+        if field == 'P':
+            default = partition.name == self.partition
+            return partition.name + ('*' if default else '')
+        elif field == 'R':
+            return partition.name
+        elif field == 'a':
+            return 'up'
+        elif field == 'l':
+            return format_time_limit(partition.max_time)
+        elif field == 'D':
+            return 1
+        elif field in ('t', 'T'):
+            if not allocated:
+                state = 'idle'
+            elif partition.free_cpus:
+                state = 'mix' if field == 't' else 'mixed'
+            else:
+                state = 'alloc' if field == 't' else 'allocated'
+            return state
+        elif field == 'C':
+            return f'{allocated}/{partition.free_cpus}/0/{partition.cpus}'
+        elif field == 'c':
+            return partition.cpus
+        elif field == 'm':
+            if partition.mem is not None:
+                return partition.mem
+            return os.sysconf('SC_PAGE_SIZE') \
+                * os.sysconf('SC_PHYS_PAGES') // 1024 ** 2
+        elif field == 'N':
+            return 'localhost'
+        elif field == '%':
+            return '%'
+        return ''
+
+    def handle(self, request):
+        """Runs a command for a client and returns the response message"""
+        command = request.get('command')
+        args = request.get('args') or []
+
+        try:
+            if command == 'sbatch':
+                out = self.sbatch(args, request.get('cwd') or os.getcwd(),
+                                  env=request.get('env'),
+                                  user=request.get('user'),
+                                  stdin=request.get('stdin'))
+            elif command in ('squeue', 'sacct', 'scancel', 'sacctmgr',
+                             'sinfo'):
+                out = getattr(self, command)(args, user=request.get('user'))
+            elif command == 'ping':
+                out = ''
+            elif command == 'shutdown':
+                self.stop()
+                out = ''
+            else:
+                raise SlurmError(f'Unknown command: {command}')
+        except SlurmError as e:
+            return {'returncode': 1, 'stdout': '', 'stderr': f'{e}\n'}
+
+        return {'returncode': 0, 'stdout': out, 'stderr': ''}
+
+    # Daemon
+    async def _handle_client(self, reader, writer):
+        try:
+            line = await reader.readline()
+            if not line:
+                return
+
+            try:
+                request = json.loads(line.decode())
+
+                if request.get('command') == 'sbatch' \
+                        and 'stdin' not in request \
+                        and self.needs_stdin(request.get('args') or []):
+                    writer.write(b'{"stdin": true}\n')
+                    await writer.drain()
+                    line = await reader.readline()
+                    request['stdin'] = json.loads(line.decode())['stdin']
+
+                response = self.handle(request)
+            except Exception as e:
+                log.exception('Request failed')
+                response = {'returncode': 1, 'stdout': '',
+                            'stderr': f'slurm_error: {e}\n'}
+
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+        finally:
+            writer.close()
+
+    def stop(self):
+        if self._stopped is not None:
+            self._stopped.set()
+
+    async def serve(self):
+        """Runs the scheduler and answers commands until stop is called.
+        Jobs that are still running are cancelled."""
+        import asyncio
+        self._stopped = asyncio.Event()
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        server = await asyncio.start_unix_server(
+            self._handle_client, path=self.socket_path)
+        log.info(f'Fake Slurm listening on {self.socket_path}, '
+                 f'partitions: {list(self.partitions.values())}')
+
+        try:
+            while not self._stopped.is_set():
+                self.tick()
+                try:
+                    await asyncio.wait_for(self._stopped.wait(),
+                                           self.interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            server.close()
+            for job in list(self.active.values()):
+                self.cancel(job)
+            for job in list(self._pids.values()):
+                try:
+                    job.process.wait(5)
+                except subprocess.TimeoutExpired:
+                    os.killpg(job.process.pid, signal.SIGKILL)
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            log.info('Fake Slurm stopped')
+
+
+def install(bin_dir, socket_path):
+    """Writes the Slurm commands into bin_dir, they send requests to the
+    daemon at socket_path"""
+    os.makedirs(bin_dir, exist_ok=True)
+    paths = {}
+
+    for command in COMMANDS:
+        path = os.path.join(bin_dir, command)
+        with open(path, 'w') as fp:
+            fp.write(COMMAND_TEMPLATE.format(
+                python=sys.executable,
+                module=os.path.abspath(__file__),
+                command=command,
+                socket_path=socket_path
+            ))
+        os.chmod(path, 0o755)
+        paths[command] = path
+
+    return paths
+
+
+def request(socket_path, message, timeout=None):
+    """Sends a request to the daemon and returns the response"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+
+        with sock.makefile('rwb') as fp:
+            fp.write(json.dumps(message).encode() + b'\n')
+            fp.flush()
+            response = json.loads(fp.readline().decode())
+
+            if response.get('stdin'):
+                data = sys.stdin.read()
+                fp.write(json.dumps({'stdin': data}).encode() + b'\n')
+                fp.flush()
+                response = json.loads(fp.readline().decode())
+
+    return response
+
+
+def client(command, argv, socket_path):
+    """Main function of the installed commands, returns the exit code"""
+    if argv and argv[0] in ('--version', '-V'):
+        print(VERSION)
+        return 0
+
+    message = {
+        'command': command,
+        'args': argv,
+        'cwd': os.getcwd(),
+        'user': getpass.getuser(),
+    }
+
+    if command == 'sbatch':
+        # sbatch exports the submission environment to the job
+        message['env'] = dict(os.environ)
+
+    try:
+        response = request(socket_path, message)
+    except OSError:
+        print(f'{command}: error: Unable to contact slurm controller '
+              f'(connect failure)', file=sys.stderr)
+        return 1
+
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    return response['returncode']
+
+
+class FakeSlurm:
+    """Starts a fake Slurm daemon in a subprocess, with its commands
+    installed in <directory>/bin. Keyword arguments are Scheduler options.
+    Use it as a context manager, or call start and stop."""
+    def __init__(self, directory, **options):
+        self.directory = os.path.abspath(directory)
+        self.bin_dir = os.path.join(self.directory, 'bin')
+        self.socket_path = os.path.join(self.directory, SOCKET_NAME)
+        self.log_path = os.path.join(self.directory, 'slurmctld.log')
+        self.options = options
+        self.process = None
+
+    def __repr__(self):
+        return f'<FakeSlurm {self.directory}>'
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def executables(self):
+        """SlurmBackend parameters for the fake commands"""
+        return {
+            f'{command}_executable': os.path.join(self.bin_dir, command)
+            for command in COMMANDS
+        }
+
+    def env(self):
+        """Environment with the fake commands first on the PATH"""
+        path = os.environ.get('PATH', '')
+        return dict(os.environ, PATH=f'{self.bin_dir}{os.pathsep}{path}')
+
+    def start(self, timeout=10):
+        os.makedirs(self.directory, exist_ok=True)
+        install(self.bin_dir, self.socket_path)
+        args = [sys.executable, '-I', os.path.abspath(__file__), 'serve',
+                '--dir', self.directory]
+
+        for key, value in self.options.items():
+            if value is not None:
+                args.extend([f'--{key.replace("_", "-")}', str(value)])
+
+        with open(self.log_path, 'ab') as fp:
+            self.process = subprocess.Popen(
+                args, stdin=subprocess.DEVNULL, stdout=fp, stderr=fp)
+
+        deadline = time.monotonic() + timeout
+        while 1:
+            try:
+                request(self.socket_path, {'command': 'ping'}, timeout=1)
+                return
+            except OSError:
+                if self.process.poll() is not None \
+                        or time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError(
+                        f'Fake Slurm did not start, see {self.log_path}')
+                time.sleep(0.05)
+
+    def stop(self, timeout=10):
+        if self.process is None:
+            return
+
+        try:
+            request(self.socket_path, {'command': 'shutdown'}, timeout=1)
+            self.process.wait(timeout)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+
+        self.process = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('action', choices=('serve', 'install'))
+    parser.add_argument('--dir', required=True,
+                        help='directory for the socket, commands and scripts')
+    parser.add_argument('--cpus', type=int)
+    parser.add_argument('--mem', type=int, help='megabytes')
+    parser.add_argument('--queue-delay', type=float, default=0)
+    parser.add_argument('--queue-jitter', type=float, default=0)
+    parser.add_argument('--runtime', type=float,
+                        help='pretend every job runs for this many seconds')
+    parser.add_argument('--fail-rate', type=float, default=0)
+    parser.add_argument('--submit-fail-rate', type=float, default=0)
+    parser.add_argument('--sacct-fail-rate', type=float, default=0)
+    parser.add_argument('--accounting-delay', type=float, default=0)
+    parser.add_argument('--max-submit-jobs', type=int)
+    parser.add_argument('--partition', default='debug')
+    parser.add_argument('--partitions',
+                        help='name[:cpus[:mem[:minutes]]] separated by commas')
+    parser.add_argument('--sched-depth', type=int, default=1000)
+    parser.add_argument('--interval', type=float, default=0.05)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args(argv)
+
+    directory = os.path.abspath(args.dir)
+    socket_path = os.path.join(directory, SOCKET_NAME)
+    install(os.path.join(directory, 'bin'), socket_path)
+
+    if args.action == 'install':
+        return
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s %(levelname)s: %(message)s'
+    )
+
+    options = vars(args)
+    for key in ('action', 'dir'):
+        options.pop(key)
+
+    import asyncio
+    scheduler = Scheduler(directory, **options)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.add_signal_handler(signal.SIGTERM, scheduler.stop)
+    loop.add_signal_handler(signal.SIGINT, scheduler.stop)
+
+    try:
+        loop.run_until_complete(scheduler.serve())
+    finally:
+        loop.close()
+
+
+if __name__ == '__main__':
+    main()
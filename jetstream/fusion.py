@@ -0,0 +1,373 @@
+"""Task fusion: run linear chains of small tasks as one backend submission
+
+Templates often contain chains of tiny tasks where each task has exactly one
+parent and one child (index -> stats -> checksum). Each of them pays for a
+process spawn, a trip through the runner, and on Slurm a separate job with
+its own queue wait. `fuse` is an optional pass over a built workflow that
+finds these chains and marks the first task of each one with a "fused"
+directive listing the tasks that follow it.
+
+When the runner reaches a task with a "fused" directive, the chain is sent to
+the backend as a single FusedTask. Its cmd runs each step in order, in a
+subshell with that step's own stdin/stdout/stderr, and stops at the first
+failure. The exit status and start/end times of each step are written to a
+status file, and `report` copies them back onto the original tasks, so task
+states, logs, retries and the runtime history look the same as if the steps
+were run one at a time.
+
+Tasks are only fused when both have a cmd, neither has an exec directive,
+neither sets `fuse: false`, and they have the same backend and sbatch_args
+directives. Chains are split to stay within the cpus, mem, walltime and
+length limits (fusion settings). The fused submission asks for the largest
+cpus and mem of its steps, and the sum of their walltimes.
+"""
+import logging
+import os
+import shlex
+import tempfile
+from datetime import datetime, timedelta
+import jetstream
+from jetstream import utils
+from jetstream.tasks import Task
+
+log = logging.getLogger(__name__)
+
+# Directives that are copied from the first step to the fused submission
+SHARED_DIRECTIVES = ('backend', 'sbatch_args', 'tags')
+
+
+def can_fuse(task):
+    d = task.directives
+    return bool(d.get('cmd')) and not d.get('exec') \
+        and d.get('fuse', True) is not False
+
+
+def _linked(graph, u, v):
+    """True if v is the only child of u, u is the only parent of v, and both
+    tasks can be run in the same submission"""
+    G = graph.G
+    if len(G.succ[u]) != 1 or len(G.pred[v]) != 1:
+        return False
+
+    a = graph.workflow.tasks[u]
+    b = graph.workflow.tasks[v]
+
+    if not (can_fuse(a) and can_fuse(b)):
+        return False
+
+    return all(a.directives.get(d) == b.directives.get(d)
+               for d in ('backend', 'sbatch_args'))
+
+
+def find_chains(workflow, max_cpus=None, max_mem=None, max_walltime=None,
+                max_length=None):
+    """Returns lists of task names that can be fused, in the order they will
+    run. Only chains with at least two tasks are returned.
+
+    :param max_cpus: Largest cpus directive allowed in a chain
+    :param max_mem: Largest mem directive allowed in a chain
+    :param max_walltime: Limit on the sum of walltime directives in a chain,
+        steps without a walltime are not counted
+    :param max_length: Maximum number of tasks in a chain
+    """
+    graph = workflow.graph
+    G = graph.G
+    max_mem = utils.parse_mem(max_mem)
+    max_walltime = utils.parse_walltime(max_walltime)
+    chains = []
+
+    def fits(chain, task):
+        cpus = task.directives.get('cpus') or 0
+        mem = utils.parse_mem(task.directives.get('mem')) or 0
+        walltime = utils.parse_walltime(task.directives.get('walltime')) or 0
+
+        if max_length and len(chain['names']) >= max_length:
+            return False
+        if max_cpus is not None and cpus > max_cpus:
+            return False
+        if max_mem is not None and mem > max_mem:
+            return False
+        if max_walltime is not None \
+                and chain['walltime'] + walltime > max_walltime:
+            return False
+
+        chain['walltime'] += walltime
+        chain['names'].append(task.name)
+        return True
+
+    for name, task in workflow.tasks.items():
+        if not can_fuse(task):
+            continue
+
+        preds = G.pred[name]
+        if len(preds) == 1 and _linked(graph, next(iter(preds)), name):
+            # This task continues a chain that starts at an ancestor
+            continue
+
+        # Walk the whole linear path from here, splitting it into chains
+        # whenever a limit is reached
+        chain = {'names': [], 'walltime': 0}
+        current = name
+
+        while 1:
+            if not fits(chain, workflow.tasks[current]):
+                if len(chain['names']) > 1:
+                    chains.append(chain['names'])
+                chain = {'names': [], 'walltime': 0}
+
+                if not fits(chain, workflow.tasks[current]):
+                    # This task alone is over the limits
+                    chain = {'names': [], 'walltime': 0}
+
+            succs = G.succ[current]
+            if len(succs) != 1:
+                break
+
+            child = next(iter(succs))
+            if not _linked(graph, current, child):
+                break
+
+            current = child
+
+        if len(chain['names']) > 1:
+            chains.append(chain['names'])
+
+    return chains
+
+
+def fuse(workflow, max_cpus=None, max_mem=None, max_walltime=None,
+         max_length=None):
+    """Marks chains of tasks in the workflow to be run as single submissions,
+    see find_chains for the parameters. Any previous fusion is cleared first,
+    so this can be called again after workflows are mashed. Returns the
+    chains."""
+    for task in workflow.tasks.values():
+        task.directives.pop('fused', None)
+
+    chains = find_chains(
+        workflow,
+        max_cpus=max_cpus,
+        max_mem=max_mem,
+        max_walltime=max_walltime,
+        max_length=max_length
+    )
+
+    for chain in chains:
+        workflow.tasks[chain[0]].directives['fused'] = chain[1:]
+
+    fused = sum(len(c) for c in chains)
+    log.info(f'Fused {fused} tasks into {len(chains)} submissions')
+    return chains
+
+
+def fuse_from_settings(workflow):
+    """Calls fuse with the limits in the fusion settings"""
+    limits = jetstream.settings['fusion'].get(dict).copy()
+    limits.pop('enabled', None)
+    return fuse(workflow, **limits)
+
+
+def fused_steps(task, workflow):
+    """Returns the tasks that should run in the same submission as this one,
+    starting with the task itself. Steps are only included while they are new
+    and still follow the previous step, so a chain that was partly run
+    before is only fused from the task onwards."""
+    steps = [task]
+
+    for name in task.directives.get('fused') or []:
+        step = workflow.tasks.get(name)
+
+        if step is None or not step.is_new():
+            break
+
+        if set(workflow.graph.G.pred[name]) != {steps[-1].name}:
+            break
+
+        steps.append(step)
+
+    return steps
+
+
+def status_path(task, project=None):
+    """Returns the path where step statuses are written for a chain that
+    starts at this task. Slurm jobs need this to be on a shared filesystem,
+    so the project log store is used when there is a project."""
+    if project:
+        return project.log_store.path(task.name, suffix='.fused')
+    else:
+        fd, path = tempfile.mkstemp(prefix=f'{task.name}.', suffix='.fused')
+        os.close(fd)
+        return path
+
+
+def redirects(stdin, stdout, stderr):
+    """Returns the shell redirections for the stdin, stdout and stderr paths
+    of a task"""
+    args = []
+
+    if stdin:
+        args.append(f'< {shlex.quote(stdin)}')
+
+    if stdout:
+        args.append(f'> {shlex.quote(stdout)}')
+
+    if stderr:
+        if stderr == stdout:
+            args.append('2>&1')
+        else:
+            args.append(f'2> {shlex.quote(stderr)}')
+
+    return ' '.join(args)
+
+
+def fused_cmd(steps, fd_paths, path):
+    """Returns a bash script that runs each step in order and records the
+    exit status and start/end time of each step in the status file"""
+    lines = [
+        f'_js_status={shlex.quote(path)}',
+        ': > "$_js_status"',
+    ]
+
+    for step, paths in zip(steps, fd_paths):
+        lines += [
+            '',
+            f'# {step.name}',
+            '_js_start=$(date +%s.%N)',
+            '(',
+            step.directives['cmd'],
+            f') {redirects(*paths)}',
+            '_js_rc=$?',
+            f'echo "{step.name} $_js_rc $_js_start $(date +%s.%N)" '
+            f'>> "$_js_status"',
+            '[ $_js_rc -eq 0 ] || exit $_js_rc',
+        ]
+
+    return '\n'.join(lines) + '\n'
+
+
+class FusedTask(Task):
+    """A chain of tasks run as one backend submission. Backends spawn this
+    like any other task, then `report` updates the original tasks.
+
+    :param steps: Tasks in the chain, in order
+    :param fd_paths: (stdin, stdout, stderr) for each step
+    :param status_path: Where the status of each step is written
+    """
+    def __init__(self, steps, fd_paths, status_path):
+        self.steps = steps
+        self.head = steps[0]
+        self.fd_paths = fd_paths
+        self.status_path = status_path
+
+        mems = [s.directives.get('mem') for s in steps]
+        walltimes = [utils.parse_walltime(s.directives.get('walltime'))
+                     for s in steps]
+
+        directives = {
+            d: self.head.directives[d] for d in SHARED_DIRECTIVES
+            if d in self.head.directives
+        }
+        directives['cmd'] = fused_cmd(steps, fd_paths, status_path)
+        directives['cpus'] = max(s.directives.get('cpus') or 0 for s in steps)
+
+        if any(mems):
+            directives['mem'] = max(
+                (m for m in mems if m), key=utils.parse_mem)
+
+        if all(w is not None for w in walltimes):
+            directives['walltime'] = utils.format_walltime(sum(walltimes))
+
+        super(FusedTask, self).__init__(
+            name=f'{self.head.name}-fused',
+            **directives
+        )
+
+    def __repr__(self):
+        return f'<FusedTask({self.status}): {len(self.steps)} steps from ' \
+               f'{self.head.name}>'
+
+
+def read_status(path):
+    """Returns {step name: (returncode, start, end)} from a status file"""
+    results = {}
+
+    try:
+        with open(path) as fp:
+            for line in fp:
+                try:
+                    name, rc, start, end = line.split()
+                    results[name] = (int(rc), float(start), float(end))
+                except ValueError:
+                    log.warning(f'Bad line in fused status file: {line!r}')
+    except FileNotFoundError:
+        log.warning(f'Fused status file not found: {path}')
+
+    return results
+
+
+def report(fused, workflow):
+    """Copies the outcome of a fused submission back onto each step. Steps
+    after a failure are skipped, or reset to new if the failed step will be
+    retried. Returns the first step."""
+    results = read_status(fused.status_path)
+    failed = None
+
+    for step, (stdin, stdout, stderr) in zip(fused.steps, fused.fd_paths):
+        step.state.update(
+            stdout_path=stdout,
+            stderr_path=stderr,
+            fused=fused.name,
+        )
+
+        for key in ('backend', 'label', 'slurm_job_id'):
+            if key in fused.state:
+                step.state[key] = fused.state[key]
+
+        try:
+            rc, start, end = results[step.name]
+        except KeyError:
+            if fused.is_complete():
+                # The status file could not be read, but every step succeeded
+                step.complete(fused.state.get('returncode'))
+                continue
+
+            # The submission stopped during this step (killed, timed out)
+            failed = step
+            step.fail(fused.state.get('returncode'))
+            break
+
+        if rc == 0:
+            step.complete(rc)
+        else:
+            failed = step
+            step.fail(rc)
+
+        if step.is_done():
+            start_dt = datetime.fromtimestamp(start)
+            step.state.update(
+                start_time=start_dt.isoformat(),
+                done_time=datetime.fromtimestamp(end).isoformat(),
+                elapsed_time=str(timedelta(seconds=end - start)),
+            )
+
+        if failed:
+            break
+
+    if failed is not None:
+        remaining = fused.steps[fused.steps.index(failed) + 1:]
+
+        if failed.is_new():
+            # The failed step will be retried, so the rest of the chain is
+            # run again after it
+            for step in remaining:
+                step.reset(clear_state=False)
+        elif failed is not fused.head:
+            # The runner only skips the descendants of the first step
+            workflow.graph.skip_descendants(failed)
+
+    try:
+        os.remove(fused.status_path)
+    except FileNotFoundError:
+        pass
+
+    return fused.head
@@ -0,0 +1,331 @@
+"""Runtime history for finished tasks, shared across projects
+
+Elapsed times are saved in each workflow, but workflows cannot be queried
+together. The runner also appends a record for each finished task to a
+SQLite database (history.path setting), so that run times and resource
+usage can be looked up by task name pattern, identity, or tag across every
+project that has been run on this machine.
+
+Records are buffered in memory and written in one transaction each time the
+runner autosaves, and when the run ends. SQLite handles locking, so several
+runners can share the same database.
+
+    h = History()
+    h.percentiles('bwa_mem_*')
+    {'count': 42, 'p50': 1800.0, 'p90': 2400.0, 'p95': 2700.0, 'p99': 3300.0}
+"""
+import json
+import logging
+import os
+import sqlite3
+import time
+import jetstream
+from jetstream import utils
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    identity TEXT,
+    status TEXT,
+    returncode INTEGER,
+    backend TEXT,
+    project TEXT,
+    start_time TEXT,
+    done_time TEXT,
+    elapsed REAL,
+    cpus REAL,
+    mem REAL,
+    max_rss REAL,
+    slurm_state TEXT,
+    tags TEXT,
+    recorded REAL
+);
+CREATE INDEX IF NOT EXISTS tasks_name ON tasks (name);
+CREATE INDEX IF NOT EXISTS tasks_identity ON tasks (identity);
+CREATE TABLE IF NOT EXISTS task_tags (
+    task_id INTEGER NOT NULL REFERENCES tasks (id),
+    tag TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS task_tags_tag ON task_tags (tag);
+"""
+
+FIELDS = (
+    'name',
+    'identity',
+    'status',
+    'returncode',
+    'backend',
+    'project',
+    'start_time',
+    'done_time',
+    'elapsed',
+    'cpus',
+    'mem',
+    'max_rss',
+    'slurm_state',
+    'tags',
+    'recorded',
+)
+
+NUMERIC_FIELDS = ('elapsed', 'cpus', 'mem', 'max_rss')
+
+
+def default_history_path():
+    path = jetstream.settings['history']['path'].get(str)
+    return os.path.abspath(os.path.expanduser(path))
+
+
+def percentile(values, q):
+    """Returns the q-th percentile of sorted values with linear interpolation
+    between the closest ranks."""
+    if not values:
+        return None
+
+    k = (len(values) - 1) * q / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def task_record(task, backend=None, project=None):
+    """Returns the history record for a finished task. Slurm accounting data,
+    or the rusage of local tasks, is used when it is available."""
+    state = task.state
+    sacct = state.get('slurm_sacct') or state.get('rusage') or {}
+    tags = task.directives.get('tags') or []
+
+    if isinstance(tags, str):
+        tags = tags.split()
+
+    elapsed = sacct.get('ElapsedRaw')
+    try:
+        elapsed = float(elapsed)
+    except (TypeError, ValueError):
+        elapsed = utils.parse_elapsed(state.get('elapsed_time'))
+
+    try:
+        max_rss = utils.parse_mem(sacct.get('MaxRSS'))
+    except ValueError:
+        max_rss = None
+
+    try:
+        mem = utils.parse_mem(task.directives.get('mem'))
+    except ValueError:
+        mem = None
+
+    return {
+        'name': task.name,
+        'identity': task.identity,
+        'status': task.status,
+        'returncode': state.get('returncode'),
+        'backend': backend,
+        'project': project,
+        'start_time': state.get('start_time'),
+        'done_time': state.get('done_time'),
+        'elapsed': elapsed,
+        'cpus': task.directives.get('cpus'),
+        'mem': mem,
+        'max_rss': max_rss,
+        'slurm_state': (state.get('slurm_sacct') or {}).get('State'),
+        'tags': [str(t) for t in tags],
+        'recorded': time.time(),
+    }
+
+
+class History:
+    """SQLite store of finished task records.
+
+    :param path: Database path, defaults to the history.path setting
+    """
+    def __init__(self, path=None):
+        self.path = path or default_history_path()
+        self._conn = None
+        self._pending = []
+
+    def __repr__(self):
+        return f'<History {self.path}>'
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            log.debug(f'Opening task history: {self.path}')
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.executescript(SCHEMA)
+        return self._conn
+
+    def close(self):
+        self.flush()
+
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def record(self, task, backend=None, project=None):
+        """Adds a finished task to the history. Records are buffered until
+        flush is called."""
+        self._pending.append(task_record(task, backend, project))
+
+    def flush(self):
+        """Writes buffered records to the database in a single transaction"""
+        if not self._pending:
+            return 0
+
+        records, self._pending = self._pending, []
+        columns = ', '.join(FIELDS)
+        params = ', '.join('?' for f in FIELDS)
+        sql = f'INSERT INTO tasks ({columns}) VALUES ({params})'
+
+        with self.conn as conn:
+            for r in records:
+                values = [r[f] for f in FIELDS]
+                values[FIELDS.index('tags')] = json.dumps(r['tags'])
+                cur = conn.execute(sql, values)
+                conn.executemany(
+                    'INSERT INTO task_tags (task_id, tag) VALUES (?, ?)',
+                    [(cur.lastrowid, t) for t in r['tags']]
+                )
+
+        log.debug(f'Saved {len(records)} records to task history')
+        return len(records)
+
+    def query(self, pattern=None, identity=None, tag=None, status='complete',
+              limit=1000):
+        """Returns the most recent records, newest first, that match all of
+        the given filters.
+
+        :param pattern: Glob pattern for task names
+        :param identity: Task identity (hash of cmd and exec directives)
+        :param tag: Task tag
+        :param status: Task status, None to include all
+        :param limit: Maximum number of records returned
+        """
+        self.flush()
+        where = []
+        params = []
+
+        if pattern is not None:
+            where.append('name GLOB ?')
+            params.append(pattern)
+
+        if identity is not None:
+            where.append('identity = ?')
+            params.append(identity)
+
+        if tag is not None:
+            where.append('id IN (SELECT task_id FROM task_tags WHERE tag = ?)')
+            params.append(tag)
+
+        if status is not None:
+            where.append('status = ?')
+            params.append(status)
+
+        sql = 'SELECT * FROM tasks'
+
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+
+        sql += ' ORDER BY recorded DESC'
+
+        if limit:
+            sql += f' LIMIT {int(limit)}'
+
+        records = []
+        for row in self.conn.execute(sql, params):
+            r = dict(row)
+            r['tags'] = json.loads(r['tags'] or '[]')
+            records.append(r)
+
+        return records
+
+    def percentiles(self, pattern=None, identity=None, tag=None,
+                    field='elapsed', qs=(50, 90, 95, 99), limit=1000):
+        """Returns the count and percentiles of a numeric field for the
+        matching records. Only successful tasks are included."""
+        if field not in NUMERIC_FIELDS:
+            raise ValueError(f'Percentiles are only available for: '
+                             f'{", ".join(NUMERIC_FIELDS)}')
+
+        records = self.query(pattern, identity, tag, limit=limit)
+        values = sorted(r[field] for r in records if r[field] is not None)
+        result = {'count': len(values)}
+
+        for q in qs:
+            result[f'p{q:g}'] = percentile(values, q)
+
+        return result
+
+    def estimate(self, task, field='elapsed', q=50, min_count=1):
+        """Returns the q-th percentile of a field for previous runs of this
+        task. Runs with the same identity are used first, then runs with the
+        same name. Returns None if there are not enough records."""
+        for kwargs in ({'identity': task.identity}, {'pattern': task.name}):
+            result = self.percentiles(field=field, qs=(q,), **kwargs)
+
+            if result['count'] >= min_count:
+                return result[f'p{q:g}']
+
+        return None
+
+    def estimator(self, field='elapsed', q=50, limit=100000, min_count=1,
+                  tags=False):
+        """Returns a function that is equivalent to `estimate`, but loads the
+        most recent records in a single query. Use this when estimating
+        every task in a large workflow. With tags=True, tasks that have no
+        runs with the same identity or name are estimated from the runs of
+        tasks with the same tag (the first of their tags that has enough
+        runs)."""
+        if field not in NUMERIC_FIELDS:
+            raise ValueError(f'Estimates are only available for: '
+                             f'{", ".join(NUMERIC_FIELDS)}')
+
+        self.flush()
+        by_identity = {}
+        by_name = {}
+        by_tag = {}
+        sql = f'SELECT name, identity, tags, {field} FROM tasks ' \
+              f'WHERE status = ? AND {field} IS NOT NULL ' \
+              f'ORDER BY recorded DESC LIMIT {int(limit)}'
+
+        for name, identity, task_tags, value in self.conn.execute(
+                sql, ('complete',)):
+            by_identity.setdefault(identity, []).append(value)
+            by_name.setdefault(name, []).append(value)
+
+            if tags:
+                for tag in json.loads(task_tags or '[]'):
+                    by_tag.setdefault(tag, []).append(value)
+
+        for values in (by_identity, by_name, by_tag):
+            for key, v in list(values.items()):
+                if len(v) < min_count:
+                    del values[key]
+                else:
+                    values[key] = percentile(sorted(v), q)
+
+        def fn(task):
+            try:
+                return by_identity[task.identity]
+            except KeyError:
+                pass
+
+            try:
+                return by_name[task.name]
+            except KeyError:
+                pass
+
+            task_tags = task.directives.get('tags') or []
+            if isinstance(task_tags, str):
+                task_tags = task_tags.split()
+
+            for tag in task_tags:
+                if str(tag) in by_tag:
+                    return by_tag[str(tag)]
+
+            return None
+
+        return fn
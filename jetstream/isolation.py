@@ -0,0 +1,203 @@
+"""CPU pinning and cgroup v2 limits for local tasks
+
+The LocalBackend only counts cpus, so a task that asks for 4 cpus can still
+spread across every core and slow down its neighbours. With the `isolate`
+option, each task is given its own set of cpus and its process is pinned to
+them with sched_setaffinity before the command starts. Children of the
+command inherit the affinity.
+
+Where cgroup v2 is mounted and writable, each task also gets a cgroup with
+cpu.max and memory.max set from its cpus and mem directives. Task cgroups
+are created inside a group for the run (`jetstream-<pid>`), made in the
+runner's own cgroup, or in the `cgroup_root` given to the backend. Cgroups
+are skipped, with a warning, when the cpu and memory controllers are not
+available there.
+
+The function that enters the cpu set and cgroup runs in the child process
+between fork and exec. This module only imports the standard library, so
+that the process launcher helper can use it too.
+"""
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+CPU_PERIOD = 100000
+
+
+def available_cpus():
+    """Returns the cpu ids this process is allowed to run on"""
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:
+        return list(range(os.cpu_count() or 1))
+
+
+def cgroup2_mount():
+    """Returns the mount point of cgroup v2, or None if it is not mounted"""
+    try:
+        with open('/proc/self/mounts') as fp:
+            for line in fp:
+                fields = line.split()
+                if len(fields) > 2 and fields[2] == 'cgroup2':
+                    return fields[1]
+    except OSError:
+        return None
+
+
+def current_cgroup():
+    """Returns the cgroup v2 directory of this process, or None if cgroup v2
+    is not mounted"""
+    mount = cgroup2_mount()
+
+    if mount is None:
+        return None
+
+    try:
+        with open('/proc/self/cgroup') as fp:
+            for line in fp:
+                if line.startswith('0::'):
+                    path = line[3:].strip().lstrip('/')
+                    return os.path.join(mount, path)
+    except OSError:
+        return None
+
+
+def enter(affinity=None, cgroup=None):
+    """Moves the calling process into a cgroup and pins it to a set of cpus.
+    This is used as a preexec_fn, so it runs in the child before exec."""
+    if cgroup:
+        with open(os.path.join(cgroup, 'cgroup.procs'), 'w') as fp:
+            fp.write(str(os.getpid()))
+
+    if affinity:
+        os.sched_setaffinity(0, affinity)
+
+
+class CpuAllocator:
+    """Hands out cpu ids to tasks. Each task gets the least used cpus, so
+    that tasks only share cpus when more cpus are requested than there are
+    (when the backend cpus setting is larger than the machine).
+
+    :param cpus: Cpu ids to use, defaults to the ones this process can use
+    """
+    def __init__(self, cpus=None):
+        self.cpus = sorted(cpus or available_cpus())
+        self.usage = {c: 0 for c in self.cpus}
+
+    def __repr__(self):
+        return f'<CpuAllocator {len(self.cpus)} cpus>'
+
+    def acquire(self, n):
+        """Returns a list of n cpu ids, or fewer if there are only fewer cpus
+        available in total"""
+        n = min(n, len(self.cpus))
+        chosen = sorted(self.cpus, key=lambda c: (self.usage[c], c))[:n]
+
+        for c in chosen:
+            self.usage[c] += 1
+
+        return sorted(chosen)
+
+    def release(self, cpus):
+        for c in cpus:
+            self.usage[c] -= 1
+
+
+class Cgroups:
+    """Creates a cgroup v2 for each task inside a group for the run.
+
+    :param root: Cgroup directory where the run group is created, defaults
+        to the cgroup of this process
+    """
+    controllers = ('cpu', 'memory')
+
+    def __init__(self, root=None):
+        self.root = root or current_cgroup()
+        self.path = None
+        self.enabled = ()
+        self._count = 0
+
+    def __repr__(self):
+        return f'<Cgroups {self.path}>'
+
+    def setup(self):
+        """Creates the run group and enables the cpu and memory controllers
+        for its children. Returns False if cgroups cannot be used here."""
+        if self.root is None:
+            log.warning('Cgroup v2 is not mounted, tasks will only be pinned '
+                        'to cpus')
+            return False
+
+        path = os.path.join(self.root, f'jetstream-{os.getpid()}')
+
+        try:
+            os.makedirs(path, exist_ok=True)
+
+            with open(os.path.join(path, 'cgroup.controllers')) as fp:
+                available = fp.read().split()
+
+            enabled = tuple(c for c in self.controllers if c in available)
+
+            if enabled:
+                with open(os.path.join(path, 'cgroup.subtree_control'),
+                          'w') as fp:
+                    fp.write(' '.join(f'+{c}' for c in enabled))
+        except OSError as e:
+            log.warning(f'Cgroups are not writable in {self.root}, tasks '
+                        f'will only be pinned to cpus: {e}')
+            self._rmdir(path)
+            return False
+
+        if not enabled:
+            log.warning(f'No cpu or memory controller available in '
+                        f'{self.root}, tasks will only be pinned to cpus')
+            self._rmdir(path)
+            return False
+
+        self.path = path
+        self.enabled = enabled
+        log.info(f'Task cgroups in {path} ({", ".join(enabled)})')
+        return True
+
+    def create(self, name, cpus=None, mem=None):
+        """Returns the path of a new cgroup for a task, with cpu.max set to
+        the cpus and memory.max set to mem (bytes). Limits that are not given
+        are left unlimited."""
+        while 1:
+            # Groups left behind by an earlier backend may use the same name
+            self._count += 1
+            path = os.path.join(self.path, f'{name}-{self._count}')
+            try:
+                os.mkdir(path)
+                break
+            except FileExistsError:
+                continue
+
+        if cpus and 'cpu' in self.enabled:
+            with open(os.path.join(path, 'cpu.max'), 'w') as fp:
+                fp.write(f'{int(cpus * CPU_PERIOD)} {CPU_PERIOD}')
+
+        if mem and 'memory' in self.enabled:
+            with open(os.path.join(path, 'memory.max'), 'w') as fp:
+                fp.write(str(int(mem)))
+
+        return path
+
+    def remove(self, path):
+        """Removes a task cgroup. This fails if processes started by the task
+        are still running, then the cgroup is left behind."""
+        self._rmdir(path)
+
+    def close(self):
+        if self.path is not None:
+            self._rmdir(self.path)
+            self.path = None
+
+    def _rmdir(self, path):
+        try:
+            os.rmdir(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log.debug(f'Failed to remove cgroup {path}: {e}')
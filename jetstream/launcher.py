@@ -0,0 +1,475 @@
+"""Fork-server process launcher for the LocalBackend
+
+Forking gets slower as the forking process gets bigger, because the page
+tables of the parent have to be copied. A runner holding a large workflow
+pays this for every task it spawns, and under load fork starts failing with
+BlockingIOError. The launcher is a small helper process, started before the
+workflow is loaded, that spawns task commands on behalf of the runner. Its
+memory stays small, so spawn latency and throughput do not depend on the
+size of the runner.
+
+The helper is this module run as a script with only the standard library
+imported. It is connected to the runner by two pipes, and the protocol is one
+JSON object per line in each direction. Requests:
+
+    {"id": 1, "cmd": "echo hi", "stdin": null, "stdout": "/path/a.log",
+     "stderr": "/path/a.log", "cwd": null, "env": {"JS_PROJECT_PATH": "/p"},
+     "unset": [], "executable": "/bin/bash", "affinity": [0, 1],
+     "cgroup": null}
+
+The helper opens the stdin/stdout/stderr paths itself, and the environment is
+sent as changes from the environment the helper was started with. Responses:
+
+    {"id": 1, "pid": 12345}
+    {"id": 1, "returncode": 0, "rusage": {"ru_maxrss": 2048, ...}}
+    {"id": 1, "error": "...", "errno": 11}
+
+Exit statuses follow the subprocess convention, a negative returncode is the
+signal that ended the process. Processes are reaped with os.wait4, and their
+rusage is sent with the exit status (see jetstream.accounting). Commands that are not given a stdout or stderr
+path share the stdout/stderr of the runner, as they would without the
+launcher.
+
+Enable it with the `launcher` option of the LocalBackend. The CLI starts it
+with `prestart` before loading anything, otherwise it is started the first
+time a backend needs it.
+"""
+import asyncio
+import atexit
+import functools
+import importlib.util
+import itertools
+import json
+import logging
+import os
+import selectors
+import signal
+import subprocess
+import sys
+
+log = logging.getLogger(__name__)
+
+_launcher = None
+_isolation = None
+
+
+def _returncode(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _load_isolation():
+    """Returns jetstream.isolation. The helper cannot import the jetstream
+    package, but that module only needs the standard library, so it is
+    loaded from its file."""
+    global _isolation
+
+    if _isolation is None:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'isolation.py')
+        spec = importlib.util.spec_from_file_location('isolation', path)
+        _isolation = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(_isolation)
+
+    return _isolation
+
+
+def _launch(request, base_env):
+    """Starts the process for a spawn request in the helper"""
+    files = []
+
+    def open_path(path, mode):
+        if not path:
+            return None
+        fp = open(path, mode)
+        files.append(fp)
+        return fp
+
+    try:
+        stdin = open_path(request.get('stdin'), 'rb')
+        stdout = open_path(request.get('stdout'), 'wb')
+
+        if request.get('stderr') and request['stderr'] == request.get('stdout'):
+            stderr = subprocess.STDOUT
+        else:
+            stderr = open_path(request.get('stderr'), 'wb')
+
+        env = dict(base_env)
+        env.update(request.get('env') or {})
+        for key in request.get('unset') or []:
+            env.pop(key, None)
+
+        if request.get('affinity') or request.get('cgroup'):
+            preexec_fn = functools.partial(
+                _load_isolation().enter,
+                affinity=request.get('affinity'),
+                cgroup=request.get('cgroup')
+            )
+        else:
+            preexec_fn = None
+
+        return subprocess.Popen(
+            request['cmd'],
+            shell=True,
+            executable=request.get('executable') or '/bin/bash',
+            stdin=stdin,
+            stdout=stdout,
+            stderr=stderr,
+            cwd=request.get('cwd'),
+            env=env,
+            preexec_fn=preexec_fn,
+        )
+    finally:
+        for fp in files:
+            fp.close()
+
+
+def serve(rfd, wfd):
+    """Helper process main loop. Reads spawn requests from rfd and writes
+    responses to wfd until the runner closes its end of the request pipe."""
+    base_env = dict(os.environ)
+    children = {}
+
+    def send(message):
+        _write_all(wfd, json.dumps(message).encode() + b'\n')
+
+    def reap():
+        while children:
+            try:
+                pid, status, ru = os.wait4(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+
+            if pid == 0:
+                return
+
+            try:
+                request_id, p = children.pop(pid)
+            except KeyError:
+                continue
+
+            # Popen must not try to reap this process again
+            p.returncode = _returncode(status)
+            rusage = {k: getattr(ru, k) for k in dir(ru)
+                      if k.startswith('ru_')}
+            send({'id': request_id, 'returncode': p.returncode,
+                  'rusage': rusage})
+
+    # SIGCHLD wakes the select loop through the wakeup fd. Signals with a
+    # Python handler are reset to the default in children, unlike ignored
+    # signals, so Ctrl-C still reaches the task commands.
+    sig_r, sig_w = os.pipe()
+    os.set_blocking(sig_r, False)
+    os.set_blocking(sig_w, False)
+    signal.set_wakeup_fd(sig_w)
+    signal.signal(signal.SIGCHLD, lambda *args: None)
+    signal.signal(signal.SIGINT, lambda *args: None)
+
+    sel = selectors.DefaultSelector()
+    sel.register(rfd, selectors.EVENT_READ)
+    sel.register(sig_r, selectors.EVENT_READ)
+    buffer = b''
+
+    while 1:
+        for key, events in sel.select():
+            if key.fd == sig_r:
+                while 1:
+                    try:
+                        if not os.read(sig_r, 4096):
+                            break
+                    except BlockingIOError:
+                        break
+                reap()
+                continue
+
+            data = os.read(rfd, 65536)
+            if not data:
+                return
+
+            *lines, buffer = (buffer + data).split(b'\n')
+
+            for line in lines:
+                request = json.loads(line.decode())
+                request_id = request['id']
+
+                try:
+                    p = _launch(request, base_env)
+                except OSError as e:
+                    send({'id': request_id, 'error': str(e),
+                          'errno': e.errno, 'filename': e.filename})
+                except Exception as e:
+                    send({'id': request_id, 'error': str(e)})
+                else:
+                    children[p.pid] = (request_id, p)
+                    send({'id': request_id, 'pid': p.pid})
+
+            reap()
+
+
+class LaunchedProcess:
+    """A process started by the launcher, this has the same pid, returncode
+    and wait() as asyncio.subprocess.Process. The rusage of the process is
+    set when it exits."""
+    def __init__(self, pid, exited):
+        self.pid = pid
+        self.returncode = None
+        self.rusage = None
+        self._exited = exited
+
+    def __repr__(self):
+        return f'<LaunchedProcess {self.pid}>'
+
+    async def wait(self):
+        message = await self._exited
+        self.returncode = message['returncode']
+        self.rusage = message.get('rusage')
+        return self.returncode
+
+
+class Launcher:
+    """Runner side of the launcher. `start` starts the helper process, and
+    `spawn` sends it requests from the event loop."""
+    def __init__(self):
+        self.proc = None
+        self._env = None
+        self._ids = itertools.count(1)
+        self._waiters = {}
+        self._loop = None
+        self._rfd = None
+        self._wfd = None
+        self._rbuf = b''
+        self._wbuf = bytearray()
+
+    def __repr__(self):
+        pid = self.proc.pid if self.proc else None
+        return f'<Launcher pid={pid}>'
+
+    def is_running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        """Starts the helper process if it is not already running"""
+        if self.is_running():
+            return
+
+        self.stop()
+        req_r, req_w = os.pipe()
+        resp_r, resp_w = os.pipe()
+
+        try:
+            # Isolated mode, only the standard library is needed
+            self.proc = subprocess.Popen(
+                [sys.executable, '-I', '-S', os.path.abspath(__file__),
+                 str(req_r), str(resp_w)],
+                pass_fds=(req_r, resp_w),
+            )
+        finally:
+            os.close(req_r)
+            os.close(resp_w)
+
+        os.set_blocking(req_w, False)
+        os.set_blocking(resp_r, False)
+        self._wfd = req_w
+        self._rfd = resp_r
+        self._env = dict(os.environ)
+        log.info(f'Started process launcher: {self.proc.pid}')
+
+    def stop(self):
+        """Closes the pipes to the helper, which makes it exit. Processes it
+        started are left running."""
+        self._detach()
+        self._fail_waiters(ConnectionError('Process launcher stopped'))
+
+        for fd in (self._rfd, self._wfd):
+            if fd is not None:
+                os.close(fd)
+
+        self._rfd = self._wfd = None
+        self._rbuf = b''
+        self._wbuf = bytearray()
+
+        if self.proc is not None:
+            try:
+                self.proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+            self.proc = None
+
+    def _attach(self):
+        """Watches the response pipe from the current event loop. Runners
+        create a new loop for each run, so this moves to the newest one."""
+        loop = asyncio.get_event_loop()
+
+        if self._loop is loop:
+            return
+
+        self._detach()
+        self._fail_waiters(ConnectionError('Event loop changed'))
+        loop.add_reader(self._rfd, self._on_readable)
+        self._loop = loop
+
+    def _detach(self):
+        loop, self._loop = self._loop, None
+
+        if loop is None or loop.is_closed():
+            return
+
+        loop.remove_reader(self._rfd)
+        loop.remove_writer(self._wfd)
+
+    def _fail_waiters(self, error):
+        waiters, self._waiters = self._waiters, {}
+
+        for futures in waiters.values():
+            for fut in futures:
+                if not fut.done():
+                    fut.set_exception(error)
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._rfd, 65536)
+        except BlockingIOError:
+            return
+
+        if not data:
+            log.error('Process launcher exited unexpectedly')
+            self._detach()
+            self._fail_waiters(ConnectionError('Process launcher exited'))
+            return
+
+        *lines, self._rbuf = (self._rbuf + data).split(b'\n')
+
+        for line in lines:
+            self._dispatch(json.loads(line.decode()))
+
+    def _dispatch(self, message):
+        request_id = message['id']
+
+        try:
+            started, exited = self._waiters[request_id]
+        except KeyError:
+            log.debug(f'Launcher response for unknown request: {message}')
+            return
+
+        if 'pid' in message:
+            started.set_result(message['pid'])
+        elif 'returncode' in message:
+            del self._waiters[request_id]
+            exited.set_result(message)
+        else:
+            del self._waiters[request_id]
+            code = message.get('errno')
+            if code is None:
+                err = RuntimeError(message['error'])
+            else:
+                # OSError picks the subclass for the errno, so EAGAIN is
+                # raised as BlockingIOError like a failed fork would be
+                err = OSError(code, os.strerror(code), message.get('filename'))
+            started.set_exception(err)
+            exited.cancel()
+
+    def _on_writable(self):
+        try:
+            n = os.write(self._wfd, self._wbuf)
+        except BlockingIOError:
+            return
+
+        del self._wbuf[:n]
+
+        if not self._wbuf:
+            self._loop.remove_writer(self._wfd)
+
+    def _send(self, message):
+        pending = bool(self._wbuf)
+        self._wbuf += json.dumps(message).encode() + b'\n'
+
+        if not pending:
+            # The request pipe is non-blocking, anything that does not fit
+            # is written when the helper has read some of it
+            try:
+                n = os.write(self._wfd, self._wbuf)
+                del self._wbuf[:n]
+            except BlockingIOError:
+                pass
+            except BrokenPipeError:
+                raise ConnectionError('Process launcher exited') from None
+
+            if self._wbuf:
+                self._loop.add_writer(self._wfd, self._on_writable)
+
+    async def spawn(self, cmd, *, stdin=None, stdout=None, stderr=None,
+                    cwd=None, env=None, executable='/bin/bash',
+                    affinity=None, cgroup=None):
+        """Starts a shell command in the helper process and returns a
+        LaunchedProcess. Arguments are paths instead of file objects, the
+        affinity and cgroup are entered in the child (see
+        jetstream.isolation). Errors starting the process are raised as the
+        same OSError that subprocess would raise."""
+        if not self.is_running():
+            raise ConnectionError('Process launcher is not running')
+
+        self._attach()
+
+        if env is None:
+            env = os.environ
+
+        changed = {k: v for k, v in env.items() if self._env.get(k) != v}
+        unset = [k for k in self._env if k not in env]
+        request_id = next(self._ids)
+        started = self._loop.create_future()
+        exited = self._loop.create_future()
+        self._waiters[request_id] = (started, exited)
+
+        self._send({
+            'id': request_id,
+            'cmd': cmd,
+            'stdin': stdin,
+            'stdout': stdout,
+            'stderr': stderr,
+            'cwd': cwd,
+            'env': changed,
+            'unset': unset,
+            'executable': executable,
+            'affinity': affinity,
+            'cgroup': cgroup,
+        })
+
+        pid = await started
+        return LaunchedProcess(pid, exited)
+
+
+def get_launcher():
+    """Returns the launcher shared by all LocalBackends in this process,
+    starting the helper process if needed"""
+    global _launcher
+
+    if _launcher is None:
+        _launcher = Launcher()
+        atexit.register(_launcher.stop)
+
+    _launcher.start()
+    return _launcher
+
+
+def prestart():
+    """Starts the launcher now if any backend in the settings uses it. This
+    is called by the CLI before workflows are loaded, so that the helper is
+    forked while the runner is still small."""
+    import jetstream
+
+    for name, params in jetstream.settings['backends'].get(dict).items():
+        if isinstance(params, dict) and params.get('launcher'):
+            log.debug(f'Backend {name} uses the process launcher')
+            return get_launcher()
+
+
+if __name__ == '__main__':
+    serve(int(sys.argv[1]), int(sys.argv[2]))
@@ -0,0 +1,253 @@
+"""Storage for task logs in a project
+
+Tasks in a project used to write their output to `logs/<task>.log`, one flat
+directory with a file for every task. With 100k+ tasks that directory is
+slow to list, back up, or even open files in, especially on NFS. The log
+store spreads logs across 256 subdirectories named by the first two hex
+digits of a hash of the task name:
+
+    logs/3f/bwa_mem_sample1.log
+
+When a task finishes, the runner compresses its log to `<log>.gz` in a
+background thread. Finished logs can then be packed into archive segments
+(`jetstream project --archive-logs`). Each segment is a file with the
+compressed logs concatenated, and an index with the offset and length of
+each log in it:
+
+    logs/archive/segment-00001.dat
+    logs/archive/segment-00001.idx
+
+Logs are always read through the store: a plain log is used first (the task
+is running or was run again), then the compressed log, then the newest
+archived copy. Paths saved in task states do not change when logs are
+compressed or archived, they are the key used to find the log.
+"""
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import jetstream
+from jetstream import utils
+
+log = logging.getLogger(__name__)
+
+ARCHIVE_DIR = 'archive'
+SEGMENT_FORMAT = 'segment-{:05d}'
+
+
+def shard(name):
+    """Returns the subdirectory name for a task: two hex digits of a hash
+    of the name"""
+    return hashlib.sha1(name.encode()).hexdigest()[:2]
+
+
+def read_file(path):
+    """Returns the text of a log file, or its gzipped copy. Raises
+    FileNotFoundError if neither exists."""
+    try:
+        with open(path, 'r') as fp:
+            return fp.read()
+    except FileNotFoundError:
+        pass
+
+    try:
+        with gzip.open(path + '.gz', 'rt') as fp:
+            return fp.read()
+    except FileNotFoundError:
+        raise FileNotFoundError(f'Log file not found: {path}') from None
+
+
+class LogStore:
+    """Task log files inside a project logs directory.
+
+    :param logs_dir: Directory where logs are kept
+    :param layout: "hashed" puts logs in subdirectories, "flat" puts them
+        all directly in logs_dir
+    :param compress: Compress logs when tasks finish
+    :param segment_size: Size where archive segments are started, in the
+        same format as the mem directive
+    """
+    def __init__(self, logs_dir, layout='hashed', compress=True,
+                 segment_size='1G'):
+        if layout not in ('hashed', 'flat'):
+            raise ValueError(f'Unknown log store layout: {layout}')
+
+        self.logs_dir = os.path.abspath(logs_dir)
+        self.archive_dir = os.path.join(self.logs_dir, ARCHIVE_DIR)
+        self.layout = layout
+        self.compress = compress
+        self.segment_size = int(utils.parse_mem(segment_size) * 1024 ** 2)
+        self._dirs = set()
+        self._index = None
+
+    def __repr__(self):
+        return f'<LogStore {self.layout} {self.logs_dir}>'
+
+    @classmethod
+    def from_settings(cls, logs_dir):
+        params = jetstream.settings['projects']['logs'].get(dict)
+        return cls(logs_dir, **params)
+
+    def path(self, name, suffix='.log'):
+        """Returns the path for a task file, and creates its directory.
+        Directories that were created are remembered, so this only touches
+        the filesystem once for each one."""
+        if self.layout == 'hashed':
+            directory = os.path.join(self.logs_dir, shard(name))
+        else:
+            directory = self.logs_dir
+
+        if directory not in self._dirs:
+            os.makedirs(directory, exist_ok=True)
+            self._dirs.add(directory)
+
+        return os.path.join(directory, f'{name}{suffix}')
+
+    def owns(self, path):
+        """True if the path is a log inside this store. Files given by the
+        stdout/stderr directives are left alone."""
+        if not path:
+            return False
+
+        path = os.path.abspath(path)
+        return path.startswith(self.logs_dir + os.sep) \
+            and not path.startswith(self.archive_dir + os.sep) \
+            and path.endswith('.log')
+
+    def finish(self, *paths):
+        """Compresses the logs of a finished task. Paths that are not in the
+        store, or are missing, are skipped. Errors are logged, a log that
+        could not be compressed is still readable."""
+        if not self.compress:
+            return
+
+        for path in set(paths):
+            if not self.owns(path):
+                continue
+
+            try:
+                with open(path, 'rb') as src, \
+                        gzip.open(path + '.gz', 'wb', compresslevel=6) as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                log.exception(f'Failed to compress log: {path}')
+
+    def read(self, path):
+        """Returns the text of a task log. Raises FileNotFoundError if it is
+        not found in any form."""
+        try:
+            return read_file(path)
+        except FileNotFoundError:
+            if not self.owns(path):
+                raise
+
+        try:
+            segment, offset, length = self.index()[self._key(path)]
+        except KeyError:
+            raise FileNotFoundError(f'Log file not found: {path}') from None
+
+        with open(os.path.join(self.archive_dir, segment + '.dat'), 'rb') as fp:
+            fp.seek(offset)
+            data = fp.read(length)
+
+        return gzip.decompress(data).decode()
+
+    def _key(self, path):
+        return os.path.relpath(os.path.abspath(path), self.logs_dir)
+
+    def _segments(self):
+        try:
+            names = os.listdir(self.archive_dir)
+        except FileNotFoundError:
+            return []
+
+        return sorted(n[:-4] for n in names if n.endswith('.idx'))
+
+    def index(self):
+        """Returns {log key: (segment, offset, length)} for every archived
+        log. Logs archived more than once are found in the newest segment."""
+        if self._index is None:
+            index = {}
+
+            for segment in self._segments():
+                path = os.path.join(self.archive_dir, segment + '.idx')
+                with open(path, 'r') as fp:
+                    for line in fp:
+                        entry = json.loads(line)
+                        index[entry['key']] = \
+                            (segment, entry['offset'], entry['length'])
+
+            self._index = index
+
+        return self._index
+
+    def finished_logs(self):
+        """Yields the compressed logs that have not been archived"""
+        for root, dirs, files in os.walk(self.logs_dir):
+            if root == self.logs_dir and ARCHIVE_DIR in dirs:
+                dirs.remove(ARCHIVE_DIR)
+
+            for f in sorted(files):
+                if f.endswith('.log.gz'):
+                    yield os.path.join(root, f)
+
+    def archive(self):
+        """Packs compressed logs into archive segments and removes them.
+        Segments are only appended to, and a log is only removed after its
+        index entry is written, so an interrupted archive loses nothing.
+        This should not be run while a runner is writing to the project.
+        Returns the number of logs archived."""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        segments = self._segments()
+
+        if segments:
+            number = int(segments[-1].rsplit('-', 1)[1])
+        else:
+            number = 1
+
+        count = 0
+        dat = idx = None
+
+        try:
+            for gz_path in self.finished_logs():
+                if dat is None or dat.tell() >= self.segment_size:
+                    if dat is not None:
+                        dat.close()
+                        idx.close()
+                        number += 1
+
+                    segment = SEGMENT_FORMAT.format(number)
+                    base = os.path.join(self.archive_dir, segment)
+                    dat = open(base + '.dat', 'ab')
+                    idx = open(base + '.idx', 'a')
+
+                with open(gz_path, 'rb') as fp:
+                    data = fp.read()
+
+                offset = dat.tell()
+                dat.write(data)
+                dat.flush()
+
+                entry = {
+                    'key': self._key(gz_path[:-3]),
+                    'offset': offset,
+                    'length': len(data),
+                }
+                idx.write(json.dumps(entry) + '\n')
+                idx.flush()
+
+                os.remove(gz_path)
+                count += 1
+        finally:
+            if dat is not None:
+                dat.close()
+                idx.close()
+
+        self._index = None
+        log.info(f'Archived {count} logs in {self.archive_dir}')
+        return count
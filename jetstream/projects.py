@@ -4,12 +4,14 @@ import time
 from datetime import datetime
 import filelock
 import jetstream
+from jetstream.logstore import LogStore
 
 log = logging.getLogger(__name__)
 INDEX_DIR = 'jetstream'
 INDEX_FILENAME = 'project.yaml'
 LOGS_DIR = 'logs'
 HISTORY_DIR = 'history'
+SPOOL_DIR = 'spool'
 PID_FILENAME = 'pid.lock'
 WORKFLOW_FILENAME = 'workflow.pickle'
 
@@ -48,6 +50,7 @@ class ProjectPaths:
         self.index_path = os.path.join(self.index_dir, INDEX_FILENAME)
         self.logs_dir = os.path.join(self.index_dir, LOGS_DIR)
         self.history_dir = os.path.join(self.index_dir, HISTORY_DIR)
+        self.spool_dir = os.path.join(self.index_dir, SPOOL_DIR)
         self.pid_path = os.path.join(self.index_dir, PID_FILENAME)
         self.workflow_path = os.path.join(self.index_dir, WORKFLOW_FILENAME)
 
@@ -77,6 +80,7 @@ class Project:
         timeout = jetstream.settings['projects']['lock_timeout'].get(int)
         self.paths = ProjectPaths(path or os.getcwd())
         self.lock = PidFileLock(self.paths.pid_path, timeout=timeout)
+        self._log_store = None
 
         try:
             self.index = jetstream.utils.load_yaml(self.paths.index_path)
@@ -91,6 +95,13 @@ class Project:
     def __repr__(self):
         return f'<Project path={self.path}>'
 
+    @property
+    def log_store(self):
+        """The LogStore for task logs in this project"""
+        if self._log_store is None:
+            self._log_store = LogStore.from_settings(self.paths.logs_dir)
+        return self._log_store
+
     def add_to_history(self, note=None, data=None):
         tries = jetstream.settings['projects']['history_max_tries'].get(int)
         format = jetstream.settings['projects']['history_filename'].get(str)
@@ -0,0 +1,205 @@
+"""Routing of Slurm jobs to the partition where they will start soonest
+
+Clusters often have several partitions that a job could run in (short,
+normal, long, ...), and a job submitted to a busy one waits while another
+one has idle nodes. Given a list of candidate partitions, the
+PartitionRouter picks one for each job from snapshots of the cluster: sinfo
+for the state, time limit, node size and idle cpus of each partition, and
+squeue for the cpus of the jobs pending in them:
+
+    sinfo -h -p short,long -o '%R|%a|%l|%C|%c|%m'
+    squeue -h -r -t PENDING -p short,long -o '%P|%C'
+
+A partition can take a job if it is up, its nodes have enough cpus and
+memory for the job, and its time limit is at least the walltime of the job.
+The job goes to the one of those with the smallest backlog: the cpus that
+pending jobs (and this one) need beyond the idle cpus, relative to the size
+of the partition. Ties go to the partition listed first, so list the
+preferred partitions first.
+
+Snapshots are only refreshed every refresh seconds, jobs routed in between
+are counted as pending in their partition so that a burst of submissions is
+spread over the partitions instead of following one stale snapshot.
+"""
+import logging
+import time
+from jetstream import utils
+
+log = logging.getLogger(__name__)
+
+SINFO_FORMAT = '%R|%a|%l|%C|%c|%m'
+PENDING_FORMAT = '%P|%C'
+
+
+def parse_time_limit(value):
+    """Returns the seconds in a sinfo time limit, None for infinite"""
+    value = value.strip()
+
+    if value.lower() in ('infinite', 'unlimited', 'n/a', ''):
+        return None
+
+    return utils.parse_walltime(value)
+
+
+def parse_count(value):
+    """sinfo counts that vary between nodes have a + suffix, e.g. 64+"""
+    value = value.strip().rstrip('+')
+    return int(value) if value.isdigit() else None
+
+
+class Partition:
+    """Snapshot of a partition. Times are in seconds and memory in MB."""
+    def __init__(self, name, up=True, max_time=None, cpus=0, idle_cpus=0,
+                 node_cpus=None, node_mem=None, pending_cpus=0,
+                 pending_jobs=0):
+        self.name = name
+        self.up = up
+        self.max_time = max_time
+        self.cpus = cpus
+        self.idle_cpus = idle_cpus
+        self.node_cpus = node_cpus
+        self.node_mem = node_mem
+        self.pending_cpus = pending_cpus
+        self.pending_jobs = pending_jobs
+
+    def __repr__(self):
+        return f'<Partition {self.name} idle={self.idle_cpus}/{self.cpus} ' \
+               f'pending={self.pending_cpus}>'
+
+    def admits(self, cpus=1, mem=None, walltime=None):
+        """True if a job with these resources can run in this partition"""
+        if not self.up:
+            return False
+        elif self.node_cpus is not None and cpus > self.node_cpus:
+            return False
+        elif self.node_mem is not None and mem is not None \
+                and mem > self.node_mem:
+            return False
+        elif self.max_time is not None and walltime is not None \
+                and walltime > self.max_time:
+            return False
+        return True
+
+    def backlog(self, cpus=1):
+        """Cpus needed beyond the idle cpus to start the pending jobs and a
+        job with this many cpus, as a fraction of the partition"""
+        needed = self.pending_cpus + cpus - self.idle_cpus
+        return max(0, needed) / max(self.cpus, 1)
+
+    def claim(self, cpus=1):
+        """Counts a job routed here as pending until the next snapshot"""
+        self.pending_cpus += cpus
+        self.pending_jobs += 1
+
+
+def parse_sinfo(data, delimiter='|'):
+    """Returns {name: Partition} from the output of sinfo -o SINFO_FORMAT.
+    sinfo prints a line for each group of nodes that differ, these are
+    added up."""
+    partitions = {}
+
+    for line in data.splitlines():
+        fields = line.strip().split(delimiter)
+        if len(fields) != 6:
+            continue
+
+        name, avail, limit, cpus, node_cpus, node_mem = fields
+        allocated, idle, other, total = (int(c) for c in cpus.split('/'))
+        node_cpus = parse_count(node_cpus)
+        node_mem = parse_count(node_mem)
+
+        p = partitions.get(name)
+        if p is None:
+            p = partitions[name] = Partition(
+                name, up=False, max_time=parse_time_limit(limit))
+
+        p.up = p.up or avail.strip() == 'up'
+        p.cpus += total - other
+        p.idle_cpus += idle
+
+        if node_cpus is not None:
+            p.node_cpus = max(p.node_cpus or 0, node_cpus)
+        if node_mem is not None:
+            p.node_mem = max(p.node_mem or 0, node_mem)
+
+    return partitions
+
+
+def parse_pending(data, partitions, delimiter='|'):
+    """Adds the pending jobs in the output of squeue -o PENDING_FORMAT to
+    the partitions. Jobs submitted to several partitions count in each."""
+    for line in data.splitlines():
+        names, _, cpus = line.strip().partition(delimiter)
+
+        try:
+            cpus = int(cpus)
+        except ValueError:
+            continue
+
+        for name in names.split(','):
+            p = partitions.get(name)
+            if p is not None:
+                p.claim(cpus)
+
+    return partitions
+
+
+class PartitionRouter:
+    """Picks a partition for each job from the candidates
+
+    :param candidates: Partition names, in order of preference
+    :param refresh: Seconds a snapshot is used before it is refreshed
+    """
+    def __init__(self, candidates, refresh=30):
+        self.candidates = list(candidates)
+        self.refresh = refresh
+        self.partitions = {}
+        self.updated = None
+
+    def __repr__(self):
+        return f'<PartitionRouter {",".join(self.candidates)}>'
+
+    def is_stale(self, now=None):
+        if self.updated is None:
+            return True
+        return (now or time.time()) - self.updated >= self.refresh
+
+    def update(self, partitions, now=None):
+        """Replaces the snapshot, partitions is {name: Partition}. None
+        (the cluster could not be queried) keeps the previous snapshot until
+        the next refresh."""
+        self.updated = now or time.time()
+
+        if partitions is None:
+            return
+
+        missing = [c for c in self.candidates if c not in partitions]
+        if missing:
+            log.warning(f'Partitions not found by sinfo: {missing}')
+
+        self.partitions = partitions
+
+    def route(self, cpus=1, mem=None, walltime=None):
+        """Returns the name of the partition for a job with these resources
+        (mem in MB, walltime in seconds), and counts the job as pending in
+        it. Returns the first candidate if there is no snapshot yet, and
+        None if no partition in the snapshot can take the job."""
+        if not self.partitions:
+            return self.candidates[0] if self.candidates else None
+
+        cpus = cpus or 1
+        best = None
+
+        for name in self.candidates:
+            p = self.partitions.get(name)
+            if p is None or not p.admits(cpus, mem, walltime):
+                continue
+
+            if best is None or p.backlog(cpus) < best.backlog(cpus):
+                best = p
+
+        if best is None:
+            return None
+
+        best.claim(cpus)
+        return best.name
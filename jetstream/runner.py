@@ -1,17 +1,85 @@
 import asyncio
+import functools
 import logging
 import os
 import signal
 import sys
-from asyncio import BoundedSemaphore, Event
+import time
+from asyncio import Event
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from datetime import datetime, timedelta
 
+import confuse
 import jetstream
-from jetstream import utils, settings
+from jetstream import fusion, utils, settings
+from jetstream.accounting import UsageSummary
+from jetstream.concurrency import AdaptiveConcurrency, ConcurrencyLimit
+from jetstream.history import History
+from jetstream.workflows import WorkflowGraphIterator
 
 log = logging.getLogger(__name__)
 
+# Exec directive code objects are cached by their source. Templates often
+# generate many exec directives from the same macro, so the code is shared
+# across tasks and runs in this process. The cache is bounded because the
+# daemon compiles directives for every run it is sent.
+EXEC_CACHE_SIZE = 1024
+
+
+@functools.lru_cache(maxsize=EXEC_CACHE_SIZE)
+def compile_exec_directive(source):
+    """Returns the compiled code object for an exec directive. Code is
+    compiled once for each unique source string and then reused, for the
+    last EXEC_CACHE_SIZE sources."""
+    return compile(source, '<exec directive>', 'exec')
+
+
+ROUTING_LIMITS = ('max_cpus', 'max_mem', 'max_walltime')
+
+
+def match_rule(rule, task):
+    """True if a task is within every limit in a routing rule. Tasks without
+    a walltime directive never match a max_walltime limit."""
+    d = task.directives
+
+    if 'max_cpus' in rule:
+        if (d.get('cpus') or 0) > rule['max_cpus']:
+            return False
+
+    if 'max_mem' in rule:
+        mem = utils.parse_mem(d.get('mem')) or 0
+        if mem > utils.parse_mem(rule['max_mem']):
+            return False
+
+    if 'max_walltime' in rule:
+        walltime = utils.parse_walltime(d.get('walltime'))
+        if walltime is None \
+                or walltime > utils.parse_walltime(rule['max_walltime']):
+            return False
+
+    return True
+
+
+def backend_exists(name):
+    """True if a backend with this name is defined in the settings"""
+    return settings['backends'][name].exists()
+
+
+def check_rule(rule):
+    """Raises a ValueError if a routing rule is not valid"""
+    if not isinstance(rule, dict) or 'backend' not in rule:
+        raise ValueError(f'Routing rules need a backend: {rule}')
+
+    if not backend_exists(rule['backend']):
+        raise ValueError(f'Unknown backend in routing rule: {rule["backend"]}')
+
+    unknown = set(rule) - set(ROUTING_LIMITS) - {'backend'}
+    if unknown:
+        raise ValueError(f'Unknown routing rule limits: {", ".join(unknown)}')
+
+    return rule
+
 
 @contextmanager
 def sigterm_ignored():
@@ -32,8 +100,9 @@ def sigterm_ignored():
 
 
 class Runner:
-    def __init__(self, backend=None, max_concurrency=None, throttle=None,
-                 autosave=True, autosave_min=None, autosave_max=None):
+    def __init__(self, backend=None, max_concurrency=None, autosave=True,
+                 autosave_min=None, autosave_max=None,
+                 adaptive_concurrency=None, history=None, routing=None):
         backend = backend or jetstream.settings['backend'].get(str)
 
         # Runner backends also connect the asyncio event loop, so they can't
@@ -41,24 +110,56 @@ class Runner:
         # class and properties based on the name, then store them until the
         # event loop is started. Runner.backend is eventually set when
         # Runner._start_backend is called.
+        self.backend_name = backend
         self.backend_cls, self.backend_params = jetstream.lookup_backend(backend)
         self.backend = None
 
+        # Other backends that tasks are routed to are started when the first
+        # task needs them. Runner.backends holds every backend instance by
+        # name, including the run backend.
+        self.backends = {}
+        routing = routing or settings['runner']['routing'].get(dict)
+        self.routing_rules = [check_rule(r) for r in routing.get('rules') or []]
+        self.routing_overflow = routing.get('overflow')
+        if self.routing_overflow:
+            check_rule(self.routing_overflow)
+
         self.autosave = autosave
         self.autosave_min = autosave_min or settings['runner']['autosave_min'].get()
         self.autosave_max = autosave_max or settings['runner']['autosave_max'].get()
-        self.throttle = throttle or settings['runner']['throttle'].get()
         self.max_concurrency = max_concurrency \
                                or settings['runner']['max_concurrency'].get()
+        if adaptive_concurrency is None:
+            adaptive_concurrency = \
+                settings['runner']['concurrency']['adaptive'].get(bool)
+        self.adaptive_concurrency = adaptive_concurrency
+        self.concurrency = None
+
+        # Finished tasks are recorded in the shared runtime history unless
+        # history=False, it is disabled in the settings, or the
+        # JETSTREAM_NO_HISTORY environment variable is set.
+        if history is None:
+            history = settings['history']['enabled'].get(bool) \
+                      and not os.environ.get('JETSTREAM_NO_HISTORY')
+        if history is True:
+            history = History()
+        self.history = history or None
+
         self._conc_sem = None
         self._condition = None
         self._errs = False
+        self._event = None
+        # Exec code sees the globals of this module (utils, settings, ...),
+        # as it did when it was run with exec(source, None, locals)
+        self._exec_namespace = dict(globals(), runner=self)
+        self._exec_stats = {'count': 0, 'exec_time': 0.0, 'reload_time': 0.0}
         self._futures = []
+        self._log_executor = None
         self._main = None
         self._previous_directory = None
         self._run_started = None
+        self._wakeup = None
         self._workflow_iterator = None
-        self._workflow_len = None
 
         self._loop = None
         self._pipeline = None
@@ -81,9 +182,23 @@ class Runner:
     def workflow(self):
         return self._workflow
 
+    def get_project(self, task):
+        """Returns the project that a task belongs to. The runner only has a
+        single project, MultiRunner overrides this."""
+        return self.project
+
+    def get_workflow(self, task):
+        """Returns the workflow that a task belongs to. The runner only has a
+        single workflow, MultiRunner overrides this."""
+        return self.workflow
+
     # Synchronization methods for events that should wait on tasks to return
     def notify_waiters(self):
+        """Wakes the scheduler loop and the autosaver. This is called when
+        task futures return, but anything that changes the workflow or frees
+        resources while the run is in progress should call it too."""
         self._event.set()
+        self._wakeup.set()
 
     async def wait_for_next_task_future(self, timeout=None):
         self._event.clear()
@@ -117,7 +232,8 @@ class Runner:
                     log.debug('Autosaver wait timed out')
 
                 log.debug('Autosaver saving workflow...')
-                self.workflow.save()
+                self.save()
+                self.save_history()
                 last_save = datetime.now()
         except asyncio.CancelledError:
             pass
@@ -168,11 +284,13 @@ class Runner:
                 break
 
             if task is None:
-                await self._yield()
+                if not await self._yield():
+                    self._stalled(self._workflow_iterator)
+                    break
             else:
                 self.process_exec_directives(task)
 
-                if task.directives.get('cmd'):
+                if task.directives.get('cmd') or task.directives.get('call'):
                     if not task.is_done():
                         # If the task was completed by the exec directive, we
                         # do not need to attempt to run the cmd
@@ -192,17 +310,27 @@ class Runner:
         self.loop.create_task(self._autosave_coro())
 
     def _start_backend(self):
-        """Starts up any additional coroutines required by the backend"""
-        self.backend = self.backend_cls(**self.backend_params)
-        self.backend.runner = self
-        backend_coroutines = getattr(self.backend, 'coroutines', [])
+        """Starts the run backend"""
+        self.backends = {}
+        self.backend = self._start_backend_instance(
+            self.backend_name, self.backend_cls, self.backend_params)
+
+    def _start_backend_instance(self, name, cls, params):
+        """Creates a backend and starts any additional coroutines required
+        by the backend"""
+        backend = cls(**params)
+        backend.runner = self
+        backend_coroutines = getattr(backend, 'coroutines', [])
 
         if not isinstance(backend_coroutines, (list, tuple)):
             raise ValueError('Backend.coroutines must be a list, or tuple')
         else:
             for c in backend_coroutines:
                 task = self.loop.create_task(c())
-                task.add_done_callback(self.handler)
+                task.add_done_callback(self.backend_coroutine_done)
+
+        self.backends[name] = backend
+        return backend
 
     def _start_event_loop(self):
         if asyncio._get_running_loop() is not None:
@@ -211,43 +339,246 @@ class Runner:
         self._loop = asyncio.events.new_event_loop()
         asyncio.events.set_event_loop(self._loop)
         self._event = Event()
+        self._wakeup = Event()
 
     async def _yield(self):
         """Since the workflow is a simple synchronous class, it will just
         return None when there are no tasks ready to be launched. This method
-        allows the runner to "pause" checking the workflow until a task
-        future returns, or a timeout (whichever happens first). This greatly
-        reduces the cpu load of the runner while idle by not constantly
-        checking the workflow for new tasks. """
-        delay = self.throttle * (self._workflow_len or 0)
-        log.debug(f'Yield for {delay}s or when next future returns')
-
+        allows the runner to "pause" checking the workflow until something
+        happens that could make another task ready: a task future returns,
+        the workflow is changed, or resources are freed (see notify_waiters).
+
+        The wakeup event is only cleared after it fires, so events that
+        happen while the workflow is being scanned are not lost. If nothing
+        is in flight, nothing can wake the runner, and the remaining tasks
+        will never become ready. Returns False in that case."""
+        if not self._futures and not self._wakeup.is_set():
+            return False
+
+        log.debug('Yield until the next runner event')
+        await self._wakeup.wait()
+        self._wakeup.clear()
+        return True
+
+    def _stalled(self, iterator):
+        """Skips the tasks left in a workflow iterator that can never start,
+        so that the run reports them instead of leaving them new"""
+        blocked = [t for t in iterator.tasks if not t.is_done()]
+        log.critical(f'Run stalled: {len(blocked)} tasks are waiting '
+                     f'on dependencies that will never complete')
+
+        for task in blocked:
+            task.skip(stalled=True)
+
+        self._errs = True
+
+    def get_backend(self, name):
+        """Returns the backend instance for a backend name in the settings,
+        starting it if this is the first task that uses it"""
         try:
-            await self.wait_for_next_task_future(timeout=delay)
-        except asyncio.TimeoutError:
+            return self.backends[name]
+        except KeyError:
             pass
 
+        try:
+            cls, params = jetstream.lookup_backend(name)
+        except confuse.NotFoundError:
+            raise ValueError(f'Unknown backend: {name}') from None
+
+        log.info(f'Starting backend for routed tasks: {name}')
+        return self._start_backend_instance(name, cls, params)
+
+    def _rule_backend(self, task):
+        """Returns the backend name given by the backend directive or the
+        first matching routing rule, or None"""
+        name = task.directives.get('backend')
+
+        if name is None:
+            for rule in self.routing_rules:
+                if match_rule(rule, task):
+                    return rule['backend']
+
+        return name
+
+    def route(self, task):
+        """Chooses the backend for a task. A backend directive is used
+        first, then the first routing rule that matches the task, then the
+        run backend. While the run backend is saturated, tasks that match the
+        overflow rule are sent to the overflow backend instead, unless they
+        were started ahead of their predecessors. The name of the chosen
+        backend is saved in task.state."""
+        name = self._rule_backend(task)
+
+        if name is None:
+            name = self.backend_name
+            overflow = self.routing_overflow
+
+            if overflow and not task.state.get('submit_ahead') \
+                    and self.backend.is_saturated() \
+                    and match_rule(overflow, task):
+                other = self.get_backend(overflow['backend'])
+
+                if not other.is_saturated():
+                    log.debug(f'Overflow: {task.name} -> {overflow["backend"]}')
+                    name = overflow['backend']
+
+        task.state['backend'] = name
+        return self.get_backend(name)
+
+    def iterate(self, workflow):
+        """Returns the iterator that yields ready tasks from a workflow"""
+        graph = workflow.graph
+        return WorkflowGraphIterator(
+            graph, ready=lambda task: self.is_ready(graph, task))
+
+    def is_ready(self, graph, task):
+        """True if a task can be started: it is new and its predecessors are
+        complete. Backends with submit_ahead (see SlurmBackend) also take a
+        task whose unfinished predecessors were submitted to that backend,
+        and hold it until they complete. Predecessors can be held the same
+        way, up to submit_ahead levels past the complete tasks. The level of
+        a task is saved in task.state['submit_ahead']."""
+        if graph.is_ready(task):
+            task.state.pop('submit_ahead', None)
+            return True
+
+        if task.status != 'new' or task.directives.get('fused') \
+                or not any(b.submit_ahead for b in self.backends.values()):
+            return False
+
+        name = self._rule_backend(task) or self.backend_name
+        backend = self.backends.get(name)
+
+        if backend is None or not backend.submit_ahead:
+            return False
+
+        level = 0
+        for dep in graph.predecessors(task):
+            if dep.is_complete():
+                continue
+
+            if dep.state.get('backend') != name \
+                    or not backend.is_submitted(dep):
+                return False
+
+            level = max(level, dep.state.get('submit_ahead', 0) + 1)
+
+        if level > backend.submit_ahead:
+            return False
+
+        task.state['submit_ahead'] = level
+        return True
+
+    def task_submitted(self, task):
+        """Called by backends with submit_ahead when a task has been
+        submitted, so that its successors are checked again"""
+        self.notify_waiters()
+
     async def process_cmd_directives(self, task):
         await self._conc_sem.acquire()
-        future = self.loop.create_task(self.backend.spawn(task))
+        name = task.directives.get('backend')
+
+        if task.directives.get('fused'):
+            steps = fusion.fused_steps(task, self.get_workflow(task))
+        else:
+            steps = [task]
+
+        if name is not None and not backend_exists(name):
+            # Fused steps share the backend directive, they are skipped
+            # when the first one fails
+            err = f'Unknown backend "{name}"'
+            future = self.loop.create_task(self.reject(task, err))
+        elif len(steps) > 1:
+            future = self.loop.create_task(self.spawn_fused(steps))
+        else:
+            backend = self.route(task)
+
+            if task.directives.get('call') and not backend.runs_calls:
+                name = task.state.get('backend', self.backend_name)
+                err = f'Call directives are not supported by the "{name}" ' \
+                      f'backend'
+                future = self.loop.create_task(self.reject(task, err))
+            else:
+                future = self.loop.create_task(backend.spawn(task))
+
         future.add_done_callback(self.handler)
         self._futures.append(future)
 
+        if self.routing_overflow:
+            # Let the backend start on the task, so that it reports whether
+            # it is saturated before the next task is routed
+            await asyncio.sleep(0)
+
+    async def reject(self, task, err):
+        """Fails a task that cannot be sent to a backend, for example a call
+        directive for a backend that cannot run Python callables, or a
+        backend directive that is not in the settings"""
+        log.error(f'{err}: {task.name}')
+        task.state['err'] = err
+        task.fail(-1, force=True)
+        return task
+
+    async def spawn_fused(self, steps):
+        """Sends a chain of tasks to the backend as one submission (see
+        jetstream.fusion), then reports the outcome back onto each task.
+        Returns the first task, the others are recorded here since the
+        handler only sees the first."""
+        head = steps[0]
+
+        for step in steps[1:]:
+            step.pending()
+
+        fd_paths = [self.backend.get_fd_paths(s) for s in steps]
+        path = fusion.status_path(head, self.get_project(head))
+        fused = fusion.FusedTask(steps, fd_paths, path)
+        backend = self.route(fused)
+        log.info(f'Fused {len(steps)} tasks into one submission: {head.name}')
+
+        await backend.spawn(fused)
+        fusion.report(fused, self.get_workflow(head))
+
+        for step in steps[1:]:
+            self.record_history(step)
+            self.finish_logs(step)
+
+        return head
+
     def process_exec_directives(self, task):
+        """Runs the exec directive for a task, if present. The code is
+        compiled once per unique source (see compile_exec_directive) and
+        executed with a fresh copy of the prepared namespace: the globals of
+        this module, plus `task` and `runner`.
+
+        The time spent executing the code, and the time spent rebuilding the
+        workflow graph afterwards, are recorded in task.state and added to the
+        run totals reported at shutdown."""
         exec_directive = task.directives.get('exec')
 
         if exec_directive:
-            env = {'runner': self, 'task': task}
-            exec(exec_directive, None, env)
+            code = compile_exec_directive(exec_directive)
+            namespace = dict(self._exec_namespace, task=task)
+
+            start = time.perf_counter()
+            exec(code, namespace)
+            executed = time.perf_counter()
             self._workflow_graph = self.workflow.reload_graph()
-            self._workflow_iterator = iter(self.workflow.graph)
+            self._workflow_iterator = self.iterate(self.workflow)
+            reloaded = time.perf_counter()
+
+            exec_time = executed - start
+            reload_time = reloaded - executed
+            task.state.update(exec_time=exec_time, reload_time=reload_time)
+            self._exec_stats['count'] += 1
+            self._exec_stats['exec_time'] += exec_time
+            self._exec_stats['reload_time'] += reload_time
+            log.debug(f'Exec directive for {task.name}: {exec_time:.3f}s, '
+                      f'graph reload: {reload_time:.3f}s')
 
     def preflight(self):
         """Called prior to start"""
         if self.autosave:
             if self.workflow.path:
-                log.info(f'Saving workflow: {self.workflow.path}')
-                self.workflow.save()
+                self.save()
                 self._start_autosave()
             else:
                 log.warning(
@@ -259,9 +590,21 @@ class Runner:
     def shutdown(self):
         """Called after shutdown"""
         if self.autosave:
-            if self.workflow.path:
-                log.info(f'Saving workflow: {self.workflow.path}')
-                self.workflow.save()
+            self.save()
+
+        self.save_history()
+
+        if self._exec_stats['count']:
+            stats = self._exec_stats
+            log.info(f'Exec directives: {stats["count"]} run, '
+                     f'{stats["exec_time"]:.3f}s executing, '
+                     f'{stats["reload_time"]:.3f}s reloading workflow graph')
+
+        if self.concurrency:
+            log.info(f'Adaptive concurrency: {self.concurrency.summary()}')
+
+        if self.usage.tasks:
+            log.info(f'Cpu efficiency: {self.usage.summary()}')
 
         log.info(f'Total run time: {datetime.now() - self._run_started}')
 
@@ -270,9 +613,14 @@ class Runner:
         try:
             res = future.result()
             if isinstance(res, jetstream.Task):
+                res.state.pop('interrupted', None)
+                self.record_history(res)
+                self.finish_logs(res)
+                self.usage.add(res)
+
                 if res.is_failed():
                     log.debug(f'Skipping descendants for: {res.name}')
-                    self._workflow_iterator.graph.skip_descendants(res)
+                    self.get_workflow(res).graph.skip_descendants(res)
         except (KeyboardInterrupt, asyncio.CancelledError):
             self._errs = True
         except Exception:
@@ -280,10 +628,63 @@ class Runner:
             if self._main and not self._main.cancelled():
                 self._main.cancel()
         finally:
+            if self.concurrency:
+                self.concurrency.task_done()
+
             self.notify_waiters()
             self._conc_sem.release()
             self._futures.remove(future)
 
+    def backend_coroutine_done(self, future):
+        """Callback added to backend coroutines. They run until the run is
+        over, so the run is stopped if one of them fails."""
+        if future.cancelled():
+            return
+
+        exc = future.exception()
+        if exc is not None:
+            log.error(f'Backend coroutine failed: {exc!r}')
+            self._errs = True
+            if self._main and not self._main.cancelled():
+                self._main.cancel()
+
+    def record_history(self, task):
+        """Adds a finished task to the runtime history"""
+        if self.history and task.status in ('complete', 'failed'):
+            project = self.get_project(task)
+            self.history.record(
+                task,
+                backend=task.state.get('backend', self.backend_name),
+                project=project.path if project else None
+            )
+
+    def finish_logs(self, task):
+        """Compresses the logs of a finished task in the project log store.
+        This happens in a background thread so that large logs do not hold
+        up the event loop."""
+        project = self.get_project(task)
+
+        if not project or not project.log_store.compress or task.is_new():
+            return
+
+        if self._log_executor is None:
+            self._log_executor = ThreadPoolExecutor(1)
+
+        self._log_executor.submit(
+            project.log_store.finish,
+            task.state.get('stdout_path'),
+            task.state.get('stderr_path')
+        )
+
+    def save_history(self):
+        """Writes finished task records to the runtime history. Errors are
+        logged, the history should never stop a run."""
+        if self.history:
+            try:
+                self.history.flush()
+            except Exception:
+                log.exception(f'Failed to save task history: {self.history}')
+
     def set_environment_variables(self):
         if self.pipeline:
             self.pipeline.set_environment_variables()
@@ -292,34 +693,55 @@ class Runner:
             self.project.set_environment_variables()
             os.environ['JS_PROJECT_PATH'] = self.project.path
 
+    def save(self):
+        """Saves progress for the workflow if it has a path"""
+        if self.workflow.path:
+            log.info(f'Saving workflow: {self.workflow.path}')
+            self.workflow.save()
+
     def start(self, workflow, pipeline=None, project=None):
         """Called to start the runner on a workflow."""
         if project:
-            try:
-                project.lock.acquire()
-            except TimeoutError:
-                err = 'Failed to acquire project lock, there may be a run pending. If ' \
-                      'this problem persists, and a run is not pending, remove the lock ' \
-                      'file located at <project>/jetstream/pid.lock'
-                raise TimeoutError(err) from None
-
+            acquire_project_lock(project)
             self._previous_directory = os.getcwd()
             os.chdir(project.paths.path)
 
         self._pipeline = pipeline
         self._project = project
         self._workflow = workflow
-        self._workflow_len = len(workflow)
-        self._workflow_iterator = iter(self.workflow.graph)
+        self._workflow_iterator = self.iterate(self.workflow)
+
+        try:
+            self._run()
+        finally:
+            if project:
+                project.lock.release()
+                os.chdir(self._previous_directory)
+
+    def _run(self):
+        """Starts the event loop and backend, then runs the main coroutine
+        until all tasks are done. Cleanup happens here regardless of errors."""
         self._run_started = datetime.now()
         self._errs = False
+        self._exec_stats = {'count': 0, 'exec_time': 0.0, 'reload_time': 0.0}
+        self.usage = UsageSummary()
         self._start_event_loop()
         self._start_backend()
 
         if self.max_concurrency is None:
             self.max_concurrency = utils.guess_max_forks()
 
-        self._conc_sem = BoundedSemaphore(value=self.max_concurrency)
+        self._conc_sem = ConcurrencyLimit(self.max_concurrency)
+
+        if self.adaptive_concurrency:
+            params = settings['runner']['concurrency'].get(dict).copy()
+            params.pop('adaptive', None)
+            self.concurrency = AdaptiveConcurrency(
+                self._conc_sem,
+                maximum=self.max_concurrency,
+                **params
+            )
+            self.loop.create_task(self.concurrency.coro())
 
         with sigterm_ignored():
             self.preflight()
@@ -332,10 +754,261 @@ class Runner:
                 log.debug(f'Runner finished shutdown, errs={self._errs}')
 
                 if self._errs:
-                    self.backend.cancel()
+                    for backend in self.backends.values():
+                        backend.cancel()
+
+                for backend in self.backends.values():
+                    backend.close()
+
+                if self._log_executor is not None:
+                    self._log_executor.shutdown()
+                    self._log_executor = None
 
                 self.shutdown()
 
+
+class WorkflowRun:
+    """State for one workflow, and its project, inside a MultiRunner"""
+    def __init__(self, workflow, project=None, iterator=None):
+        self.workflow = workflow
+        self.project = project
+        self.iterator = iterator or iter(workflow.graph)
+        self.in_flight = 0
+        self.idle = False
+        self.done = False
+
+    def __repr__(self):
+        return f'<WorkflowRun {self.project or self.workflow}>'
+
+    def save(self):
+        if self.workflow.path:
+            log.info(f'Saving workflow: {self.workflow.path}')
+            self.workflow.save()
+
+
+class MultiRunner(Runner):
+    """Runs several workflows in a single event loop.
+
+    Each workflow may have a project. All of the workflows share one backend
+    instance, so the backend resources (LocalBackend cpus, the SlurmBackend
+    job monitor, etc.) and max_concurrency are shared between them. Ready
+    tasks are taken from the workflow with the fewest tasks in flight, so a
+    large project cannot starve the others. Each workflow is saved to its own
+    path, and a project lock is released as soon as its workflow is done.
+
+    The runner does not change directory into each project. Backends use
+    BaseBackend.get_cwd and BaseBackend.get_env to run tasks in the right
+    project directory. While an exec directive is running, runner.workflow
+    and runner.project refer to the workflow and project of that task.
+
+    If keep_alive is set, the runner keeps waiting for new runs (see add_run)
+    after all of the current runs are done, instead of returning.
+    """
+    def __init__(self, *args, **kwargs):
+        super(MultiRunner, self).__init__(*args, **kwargs)
+        self.keep_alive = False
+        self._runs = []
+        self._task_runs = {}
+
+    @property
+    def runs(self):
+        return self._runs
+
+    def add_run(self, workflow, project=None):
+        """Adds a workflow to the runner while it is running. The project
+        lock should already be held by the caller."""
+        run = WorkflowRun(workflow, project, self.iterate(workflow))
+        self._runs.append(run)
+        self.notify_waiters()
+        return run
+
+    def _get_run(self, task):
+        # Fused submissions belong to the run of their first step
+        if isinstance(task, fusion.FusedTask):
+            task = task.head
+        return self._task_runs[id(task)]
+
+    def get_project(self, task):
+        return self._get_run(task).project
+
+    def get_workflow(self, task):
+        return self._get_run(task).workflow
+
+    def _finish_run(self, run):
+        run.done = True
+        log.info(f'Run complete: {run}')
+
+        if self.autosave:
+            run.save()
+
+        if run.project:
+            run.project.lock.release()
+
+    def _next_task(self):
+        """Returns the next ready task and its run, or (None, None) if no
+        tasks are ready right now. Runs are checked in order of their number
+        of tasks in flight. A run that had nothing ready is marked idle, and
+        skipped until one of its own tasks returns, because tasks in other
+        workflows cannot change its dependencies."""
+        for run in sorted(self._runs, key=lambda r: r.in_flight):
+            if run.done or run.idle:
+                continue
+
+            try:
+                task = next(run.iterator)
+            except StopIteration:
+                self._finish_run(run)
+                continue
+
+            if task is None:
+                run.idle = True
+            else:
+                return task, run
+
+        return None, None
+
+    async def _spawn_new_tasks(self):
+        while 1:
+            task, run = self._next_task()
+
+            if task is not None:
+                self.process_exec_directives(task, run)
+
+                if task.directives.get('cmd') or task.directives.get('call'):
+                    if not task.is_done():
+                        self._task_runs[id(task)] = run
+                        run.in_flight += 1
+                        await self.process_cmd_directives(task)
+                else:
+                    log.info(f'Complete: {task.name}')
+                    task.complete()
+                    await asyncio.sleep(0)
+
+                continue
+
+            active = [r for r in self._runs if not r.done]
+
+            if not active and not self.keep_alive:
+                break
+            elif await self._yield():
+                continue
+
+            # Nothing is in flight, so the active runs can never progress
+            for run in active:
+                self._stalled(run.iterator)
+                self._finish_run(run)
+
+            if not self.keep_alive:
+                break
+
+            log.debug('Waiting for new runs')
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+        if self._futures:
+            await asyncio.wait(self._futures)
+
+        log.info('Run complete!')
+
+    def process_exec_directives(self, task, run=None):
+        """Exec directives run with runner.workflow and runner.project set to
+        the workflow and project that the task belongs to."""
+        run = run or self._task_runs[id(task)]
+        self._workflow = run.workflow
+        self._project = run.project
+        self._workflow_iterator = run.iterator
+
+        try:
+            super(MultiRunner, self).process_exec_directives(task)
+            run.iterator = self._workflow_iterator
+        finally:
+            self._workflow = None
+            self._project = None
+            self._workflow_iterator = None
+
+    async def spawn_fused(self, steps):
+        # The backend looks up the project for each step, they all belong to
+        # the same run as the first
+        run = self._task_runs[id(steps[0])]
+
+        for step in steps[1:]:
+            self._task_runs[id(step)] = run
+
+        try:
+            return await super(MultiRunner, self).spawn_fused(steps)
+        finally:
+            for step in steps[1:]:
+                self._task_runs.pop(id(step), None)
+
+    def task_submitted(self, task):
+        run = self._task_runs.get(id(task))
+
+        if run is not None:
+            run.idle = False
+
+        super(MultiRunner, self).task_submitted(task)
+
+    def handler(self, future):
+        try:
+            res = future.result()
+        except BaseException:
+            res = None
+
+        run = self._task_runs.get(id(res))
+
+        if run is not None:
+            run.in_flight -= 1
+            run.idle = False
+
+        try:
+            super(MultiRunner, self).handler(future)
+        finally:
+            self._task_runs.pop(id(res), None)
+
+    def preflight(self):
+        if self.autosave:
+            for run in self._runs:
+                if not run.workflow.path:
+                    log.warning(
+                        f'Autosave is enabled, but no path has been set for '
+                        f'{run}. Progress will not be saved.'
+                    )
+
+            self.save()
+            self._start_autosave()
+
+    def save(self):
+        for run in self._runs:
+            if not run.done:
+                run.save()
+
+    def start(self, runs):
+        """Called to start the runner on several workflows. Runs should be an
+        iterable of (workflow, project) pairs, project may be None."""
+        self._runs = []
+        self._task_runs = {}
+
+        try:
+            for workflow, project in runs:
                 if project:
-                    project.lock.release()
-                    os.chdir(self._previous_directory)
+                    acquire_project_lock(project)
+
+                self._runs.append(
+                    WorkflowRun(workflow, project, self.iterate(workflow)))
+
+            self._run()
+        finally:
+            for run in self._runs:
+                if run.project and run.project.lock.is_locked:
+                    run.project.lock.release()
+
+
+def acquire_project_lock(project):
+    """Acquires the pid lock for a project before starting a run"""
+    try:
+        project.lock.acquire()
+    except TimeoutError:
+        err = 'Failed to acquire project lock, there may be a run pending. If ' \
+              'this problem persists, and a run is not pending, remove the lock ' \
+              'file located at <project>/jetstream/pid.lock'
+        raise TimeoutError(err) from None
@@ -0,0 +1,368 @@
+"""Discrete-event simulation of workflow runs
+
+Before starting a long run, `simulate` predicts how long a workflow will take
+on a modeled backend, and where the bottleneck is. It replays the runner
+scheduling: a task becomes ready when all of its predecessors are complete,
+ready tasks are started in workflow order as resources allow, and tasks
+without a cmd or call complete immediately without using resources. Instead of
+scanning the workflow for ready tasks like WorkflowGraphIterator does, the
+simulation counts remaining dependencies for each task. Ready tasks are kept
+in one heap for each resource request, so each scheduling decision only has
+to look at a handful of heaps, and the simulation time grows roughly linearly
+with the number of tasks.
+
+Task durations are estimated by `estimate_duration`, see that function for
+the directives it uses. It can also use the runtime history of previous runs
+(see jetstream.history).
+
+Resource models are simplified. The Slurm model pools the cpus and memory of
+all nodes, so node fragmentation is ignored, and each job waits in the queue
+for a fixed delay before it can start. Tasks that ask for more than a single
+node are an error.
+"""
+import heapq
+import logging
+from collections import defaultdict
+from datetime import timedelta
+import jetstream
+from jetstream import utils
+
+log = logging.getLogger(__name__)
+
+
+class ResourceModel:
+    """Capacity of the resources that tasks are run on.
+
+    :param cpus: Total cpus available
+    :param mem: Total memory available (MB), None means it is not limited
+    :param max_concurrency: Max tasks running at once, None means no limit
+    :param min_cpus: Cpus used by a task that does not set the cpus directive
+    :param queue_delay: Seconds that each task waits before it can start
+    :param node_cpus: Largest cpus request that a single task can make
+    :param node_mem: Largest mem request (MB) that a single task can make
+    """
+    def __init__(self, cpus, mem=None, max_concurrency=None, min_cpus=0,
+                 queue_delay=0, node_cpus=None, node_mem=None):
+        self.cpus = cpus
+        self.mem = mem
+        self.max_concurrency = max_concurrency
+        self.min_cpus = min_cpus
+        self.queue_delay = queue_delay
+        self.node_cpus = node_cpus or cpus
+        self.node_mem = node_mem or mem
+
+    def __repr__(self):
+        return f'<ResourceModel cpus={self.cpus} mem={self.mem}>'
+
+    def request(self, task):
+        """Returns the (cpus, mem) that a task will hold while it runs"""
+        cpus = max(task.directives.get('cpus') or 0, self.min_cpus)
+        mem = utils.parse_mem(task.directives.get('mem')) or 0
+
+        if cpus > self.node_cpus:
+            raise ValueError(f'{task.name} requests {cpus} cpus, but the '
+                             f'model only has {self.node_cpus}')
+
+        if self.node_mem is not None and mem > self.node_mem:
+            raise ValueError(f'{task.name} requests {mem}MB mem, but the '
+                             f'model only has {self.node_mem}MB')
+
+        return cpus, mem
+
+
+def local_model(cpus=None, mem=None, max_concurrency=None):
+    """Models the LocalBackend on this machine, or one with the given cpus"""
+    cpus = cpus or jetstream.utils.guess_local_cpus()
+    return ResourceModel(cpus, mem=mem, max_concurrency=max_concurrency)
+
+
+def slurm_model(nodes, node_cpus, node_mem=None, queue_delay=0):
+    """Models a Slurm partition with identical nodes. Jobs that do not set
+    cpus are given one cpu, like Slurm does."""
+    mem = nodes * node_mem if node_mem else None
+    return ResourceModel(
+        nodes * node_cpus,
+        mem=mem,
+        min_cpus=1,
+        queue_delay=queue_delay,
+        node_cpus=node_cpus,
+        node_mem=node_mem
+    )
+
+
+def _runs(task):
+    """True if the runner sends this task to a backend"""
+    return bool(task.directives.get('cmd') or task.directives.get('call'))
+
+
+def estimate_duration(task, default=60, history=None):
+    """Returns the estimated seconds that a task will run. Tasks without a cmd
+    or call take no time. Otherwise the first of these is used:
+
+    - expected_duration directive: seconds, or a walltime string with a ":"
+      or "-" (see utils.parse_duration)
+    - history: the median of previous runs, when a History.estimator
+      function is given
+    - walltime directive: this is an upper bound, so it is pessimistic
+    - default
+    """
+    if not _runs(task):
+        return 0
+
+    expected = utils.parse_duration(task.directives.get('expected_duration'))
+
+    if expected is not None:
+        return expected
+
+    if history is not None:
+        previous = history(task)
+        if previous is not None:
+            return previous
+
+    walltime = utils.parse_walltime(task.directives.get('walltime'))
+
+    if walltime is not None:
+        return walltime
+
+    return default
+
+
+def _utilisation_curve(usage, makespan, capacity, bins):
+    """Averages the step function of cpus in use into equal time bins. Returns
+    a list of [bin start time, fraction of capacity used]."""
+    if makespan <= 0 or not capacity:
+        return []
+
+    width = makespan / bins
+    totals = [0.0] * bins
+    points = usage + [(makespan, 0)]
+
+    for (t0, used), (t1, _) in zip(points, points[1:]):
+        if not used or t1 <= t0:
+            continue
+
+        first = min(int(t0 / width), bins - 1)
+        last = min(int(t1 / width), bins - 1)
+
+        for i in range(first, last + 1):
+            start = max(t0, i * width)
+            end = t1 if i == last else min(t1, (i + 1) * width)
+            if end > start:
+                totals[i] += used * (end - start)
+
+    return [[round(i * width, 3), round(total / (width * capacity), 4)]
+            for i, total in enumerate(totals)]
+
+
+def simulate(workflow, model=None, estimate=None, bins=50):
+    """Simulates a run of the workflow on the resource model, and returns a
+    report dictionary with the predicted makespan, the cpu utilisation curve,
+    the critical path, and the tasks that waited longest for resources.
+
+    Tasks that are already complete are treated as done at time zero, every
+    other task is simulated as if it will succeed.
+
+    :param workflow: Workflow to simulate
+    :param model: ResourceModel, defaults to local_model()
+    :param estimate: Callable that returns the seconds a task will run,
+        defaults to estimate_duration
+    :param bins: Number of points in the utilisation curve
+    """
+    model = model or local_model()
+    estimate = estimate or estimate_duration
+    graph = workflow.graph.G
+    tasks = workflow.tasks
+    names = list(tasks)
+    order = {name: i for i, name in enumerate(names)}
+
+    # The event loop works on task indices (workflow order) and plain lists
+    # instead of names and graph views, which is most of its cost
+    adjacency = dict(graph.adjacency())
+    successors = [[order[s] for s in adjacency[name]] for name in names]
+    count = len(names)
+
+    runs = [False] * count
+    remaining = [0] * count
+    durations = {}
+    requests = [None] * count
+    earliest = [0] * count
+    critical = [None] * count
+    ready_at = [None] * count
+    started = [None] * count
+    finished = [None] * count
+
+    for i, task in enumerate(tasks.values()):
+        if task.is_complete():
+            finished[i] = 0
+        else:
+            runs[i] = _runs(task)
+            durations[i] = estimate(task)
+            requests[i] = model.request(task)
+
+    for i in durations:
+        for succ in successors[i]:
+            remaining[succ] += 1
+
+    ready = defaultdict(list)
+    events = []
+    seq = 0
+    now = 0
+    cpus_used = 0
+    mem_used = 0
+    running = 0
+    usage = [(0, 0)]
+    waits = defaultdict(lambda: [0, 0.0])
+    queue_delay = model.queue_delay
+    max_concurrency = model.max_concurrency
+    max_cpus = model.cpus
+    max_mem = model.mem
+
+    def push(time, kind, i):
+        nonlocal seq
+        seq += 1
+        heapq.heappush(events, (time, seq, kind, i))
+
+    def make_ready(i):
+        if not runs[i]:
+            ready_at[i] = started[i] = now
+            complete(i)
+        elif queue_delay:
+            push(now + queue_delay, 'ready', i)
+        else:
+            ready_at[i] = now
+            heapq.heappush(ready[requests[i]], i)
+
+    def complete(i):
+        # Iterative to handle long chains of tasks without a cmd
+        stack = [i]
+        while stack:
+            i = stack.pop()
+            finished[i] = now
+            eft = earliest[i] + durations[i] + queue_delay
+
+            for succ in successors[i]:
+                if finished[succ] is not None:
+                    continue
+
+                if eft >= earliest[succ]:
+                    earliest[succ] = eft
+                    critical[succ] = i
+
+                remaining[succ] -= 1
+
+                if remaining[succ] == 0:
+                    if runs[succ]:
+                        make_ready(succ)
+                    else:
+                        ready_at[succ] = started[succ] = now
+                        stack.append(succ)
+
+    def schedule():
+        nonlocal cpus_used, mem_used, running
+
+        while ready:
+            if max_concurrency is not None and running >= max_concurrency:
+                return
+
+            best = None
+            for request, heap in ready.items():
+                cpus, mem = request
+                if cpus_used + cpus > max_cpus:
+                    continue
+                if max_mem is not None and mem_used + mem > max_mem:
+                    continue
+                if best is None or heap[0] < ready[best][0]:
+                    best = request
+
+            if best is None:
+                return
+
+            i = heapq.heappop(ready[best])
+            if not ready[best]:
+                del ready[best]
+
+            cpus, mem = best
+            cpus_used += cpus
+            mem_used += mem
+            running += 1
+            usage.append((now, cpus_used))
+            started[i] = now
+            push(now + durations[i], 'finish', i)
+
+            wait = waits[best]
+            wait[0] += 1
+            wait[1] += now - ready_at[i]
+
+    for i in durations:
+        if remaining[i] == 0 and finished[i] is None:
+            make_ready(i)
+
+    schedule()
+
+    while events:
+        now, _, kind, i = heapq.heappop(events)
+
+        if kind == 'ready':
+            ready_at[i] = now
+            heapq.heappush(ready[requests[i]], i)
+        else:
+            cpus, mem = requests[i]
+            cpus_used -= cpus
+            mem_used -= mem
+            running -= 1
+            usage.append((now, cpus_used))
+            complete(i)
+
+        if not events or events[0][0] != now:
+            schedule()
+
+    done = [f for f in finished if f is not None]
+    unfinished = len(tasks) - len(done)
+    if unfinished:
+        log.warning(f'Simulation ended with {unfinished} tasks not run')
+
+    makespan = max(done, default=0)
+    curve = _utilisation_curve(usage, makespan, model.cpus, bins)
+    busy = sum(u for t, u in curve) / len(curve) if curve else 0
+
+    if durations:
+        end = max(durations, key=lambda i: (earliest[i] + durations[i], i))
+        path_length = earliest[end] + durations[end] + queue_delay
+        path = [end]
+        while critical[path[-1]] is not None:
+            path.append(critical[path[-1]])
+        path = [names[i] for i in reversed(path)]
+    else:
+        path_length = 0
+        path = []
+
+    resource_wait = sum(w for n, w in waits.values())
+    waiting = sorted(waits.items(), key=lambda i: i[1][1], reverse=True)
+
+    if makespan and path_length >= 0.9 * makespan:
+        bottleneck = 'dependencies'
+    else:
+        bottleneck = 'resources'
+
+    return {
+        'tasks': len(tasks),
+        'simulated': len(durations),
+        'makespan': makespan,
+        'makespan_hms': str(timedelta(seconds=round(makespan))),
+        'bottleneck': bottleneck,
+        'critical_path': {
+            'length': path_length,
+            'tasks': path,
+        },
+        'utilisation': {
+            'mean': round(busy, 4),
+            'curve': curve,
+        },
+        'resource_wait': {
+            'total': resource_wait,
+            'by_request': [
+                {'cpus': c, 'mem': m, 'tasks': n, 'wait': w}
+                for (c, m), (n, w) in waiting[:10]
+            ],
+        },
+    }
@@ -0,0 +1,134 @@
+"""Right-sizing of memory and walltime requests from the runtime history
+
+Templates usually ask for more mem and walltime than tasks need, to be safe.
+Oversized requests make jobs harder to backfill and lower their priority.
+The SizingPolicy requests a percentile of what previous runs used (MaxRSS
+and elapsed time, see jetstream.history) plus a margin instead, never more
+than the directive:
+
+    mem: 32G, previous runs p95 MaxRSS 5.1G, margin 0.25 -> --mem 6528M
+
+Previous runs are found by task identity, then name, then by the tags of
+the task, so tag tasks that do the same kind of work for different inputs
+(e.g. tags: [bwa_mem]) to share their history. A resource is only sized
+when there are at least min_count successful runs to go on.
+
+A job that fails with TIMEOUT or OUT_OF_MEMORY after being sized is
+submitted again with that limit multiplied by escalation, up to the
+directive. Sized values are kept in task.state['slurm_resources'] and
+override the directives when the job is submitted.
+"""
+import logging
+import math
+from jetstream import utils
+
+log = logging.getLogger(__name__)
+
+# Slurm job states caused by each limit
+LIMIT_STATES = {
+    'TIMEOUT': 'walltime',
+    'OUT_OF_MEMORY': 'mem',
+}
+
+
+def format_mem(mb):
+    """Formats megabytes for the Slurm --mem option"""
+    return f'{math.ceil(mb)}M'
+
+
+class SizingPolicy:
+    """Chooses mem and walltime requests for tasks from estimates of their
+    usage.
+
+    :param estimate_mem: Function that returns the expected MaxRSS of a task
+        in megabytes, or None if it is not known
+    :param estimate_walltime: Function that returns the expected elapsed
+        seconds of a task, or None
+    :param margin: Fraction added to the estimates
+    :param escalation: Factor a limit is raised by when a job hits it
+    :param min_mem: Smallest mem request, same format as the mem directive
+    :param min_walltime: Smallest walltime request, same format as the
+        walltime directive
+    """
+    def __init__(self, estimate_mem, estimate_walltime, margin=0.25,
+                 escalation=2, min_mem='256M', min_walltime='10'):
+        self.estimate_mem = estimate_mem
+        self.estimate_walltime = estimate_walltime
+        self.margin = margin
+        self.escalation = escalation
+        self.min_mem = utils.parse_mem(min_mem)
+        self.min_walltime = utils.parse_walltime(min_walltime)
+
+    def __repr__(self):
+        return f'<SizingPolicy margin={self.margin} ' \
+               f'escalation={self.escalation}>'
+
+    @classmethod
+    def from_history(cls, history, percentile=95, min_count=5, **kwargs):
+        """Returns a policy with estimates from the percentile of previous
+        runs in a History"""
+        mem = history.estimator(
+            'max_rss', q=percentile, min_count=min_count, tags=True)
+        walltime = history.estimator(
+            'elapsed', q=percentile, min_count=min_count, tags=True)
+        return cls(mem, walltime, **kwargs)
+
+    def _sized(self, estimate, directive, minimum):
+        """Returns the request for a resource, or None to use the
+        directive"""
+        if estimate is None or directive is None:
+            return None
+
+        value = max(estimate * (1 + self.margin), minimum or 0)
+        return value if value < directive else None
+
+    def size(self, task):
+        """Returns {resource: value} for the resources of a task that are
+        requested below their directive, values are formatted for sbatch"""
+        sized = {}
+
+        mem = self._sized(
+            self.estimate_mem(task),
+            utils.parse_mem(task.directives.get('mem')),
+            self.min_mem)
+        if mem is not None:
+            sized['mem'] = format_mem(mem)
+
+        walltime = self._sized(
+            self.estimate_walltime(task),
+            utils.parse_walltime(task.directives.get('walltime')),
+            self.min_walltime)
+        if walltime is not None:
+            sized['walltime'] = utils.format_walltime(walltime)
+
+        return sized
+
+    def escalate(self, task, state):
+        """Raises the limit that a job of the task hit, given its Slurm job
+        state. The limit goes back to the directive when the escalated value
+        would reach it. Returns False if the job did not fail because of a
+        sized limit, then it should fail as usual."""
+        resource = LIMIT_STATES.get(state)
+        sized = dict(task.state.get('slurm_resources') or {})
+
+        if resource is None or resource not in sized:
+            return False
+
+        if resource == 'mem':
+            parse, fmt = utils.parse_mem, format_mem
+        else:
+            parse, fmt = utils.parse_walltime, utils.format_walltime
+
+        value = parse(sized[resource]) * self.escalation
+
+        if value < parse(task.directives[resource]):
+            sized[resource] = fmt(value)
+        else:
+            del sized[resource]
+
+        task.state['slurm_resources'] = sized
+        task.state['slurm_escalations'] = \
+            task.state.get('slurm_escalations', 0) + 1
+        log.info(f'{state}: {task.name} {resource} raised to '
+                 f'{sized.get(resource, task.directives[resource])}')
+        return True
@@ -0,0 +1,263 @@
+"""Exit records written by batch jobs when they finish
+
+Finding out that a Slurm job has finished used to mean polling sacct, and
+every task waited up to sacct_frequency seconds after its job ended. Jobs
+submitted with a spool directory write a small exit record there as their
+last step instead, and the backend completes the task as soon as the record
+shows up:
+
+    jetstream/spool/123456_7.exit
+
+    ExitCode=0
+    Start=1600000000
+    End=1600000042
+    0m0.001s 0m0.002s
+    0m31.250s 0m4.500s
+
+The last two lines are the output of the bash `times` builtin: user and
+system cpu time of the shell, then of its children. Records are written to a
+hidden temporary file and renamed, so a record is never seen half written.
+
+The SpoolWatcher uses inotify when it is available (Linux), and also scans
+the directory every scan_interval seconds. inotify does not see files
+created by other hosts on NFS, the scan is what finds those. Records are
+removed by the backend once they have been used.
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+import re
+import shlex
+import struct
+from datetime import datetime
+from jetstream.accounting import format_cpu_time
+
+log = logging.getLogger(__name__)
+
+SUFFIX = '.exit'
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_event = struct.Struct('iIII')
+_times_pattern = re.compile(r'(\d+)m([\d.]+)s')
+
+
+def record_script(spool_dir):
+    """Lines of bash that write the exit record of a job. They are added
+    after the cmd, which has to run in a subshell so that an exit in the cmd
+    does not skip them. The start time is saved by record_start."""
+    spool = shlex.quote(spool_dir)
+    return [
+        'jetstream_rc=$?',
+        'jetstream_jid=${SLURM_ARRAY_JOB_ID:+'
+        '${SLURM_ARRAY_JOB_ID}_${SLURM_ARRAY_TASK_ID}}',
+        'jetstream_jid=${jetstream_jid:-$SLURM_JOB_ID}',
+        '{ echo "ExitCode=$jetstream_rc"; echo "Start=$jetstream_start"; '
+        'echo "End=$(date +%s)"; times; } '
+        f'> {spool}/.$jetstream_jid.tmp '
+        f'&& mv -f {spool}/.$jetstream_jid.tmp {spool}/$jetstream_jid{SUFFIX}',
+        'exit $jetstream_rc',
+    ]
+
+
+def record_start():
+    return 'jetstream_start=$(date +%s)'
+
+
+def parse_seconds(value):
+    """Seconds in the output of the bash times builtin, e.g. 1m2.500s"""
+    match = _times_pattern.fullmatch(value)
+    if match is None:
+        raise ValueError(f'Unrecognized time: {value}')
+    return int(match.group(1)) * 60 + float(match.group(2))
+
+
+def parse_record(text):
+    """Returns a dict with ExitCode, Start, End (unix times), and UserCPU,
+    SystemCPU (seconds used by the job and its children) from the text of
+    an exit record. Raises ValueError if the record is not complete."""
+    lines = text.splitlines()
+    record = {}
+
+    for line in lines[:3]:
+        key, _, value = line.partition('=')
+        record[key] = int(value)
+
+    if not {'ExitCode', 'Start', 'End'}.issubset(record):
+        raise ValueError(f'Incomplete exit record: {text!r}')
+
+    user = system = 0.0
+    for line in lines[3:5]:
+        fields = line.split()
+        if len(fields) == 2:
+            user += parse_seconds(fields[0])
+            system += parse_seconds(fields[1])
+
+    record.update(UserCPU=user, SystemCPU=system)
+    return record
+
+
+def read_record(path):
+    with open(path) as fp:
+        return parse_record(fp.read())
+
+
+def job_data(jid, record):
+    """Returns job data for an exit record in the format of parsed sacct
+    output. The job is COMPLETED if the cmd returned 0, otherwise FAILED."""
+    rc = record['ExitCode']
+    elapsed = max(0, record['End'] - record['Start'])
+    cpu = record['UserCPU'] + record['SystemCPU']
+
+    return {
+        'JobID': jid,
+        'State': 'COMPLETED' if rc == 0 else 'FAILED',
+        'ExitCode': f'{rc}:0',
+        'Start': datetime.fromtimestamp(record['Start']).isoformat(),
+        'End': datetime.fromtimestamp(record['End']).isoformat(),
+        'Elapsed': format_cpu_time(elapsed).split('.')[0],
+        'ElapsedRaw': str(elapsed),
+        'TotalCPU': format_cpu_time(cpu),
+        'UserCPU': format_cpu_time(record['UserCPU']),
+        'SystemCPU': format_cpu_time(record['SystemCPU']),
+        '_steps': [],
+    }
+
+
+class Inotify:
+    """Minimal inotify binding with ctypes. Raises OSError if inotify is not
+    available."""
+    def __init__(self, path, mask=IN_MOVED_TO | IN_CLOSE_WRITE):
+        name = ctypes.util.find_library('c')
+        try:
+            libc = ctypes.CDLL(name, use_errno=True)
+            init = libc.inotify_init1
+            add_watch = libc.inotify_add_watch
+        except (OSError, AttributeError):
+            raise OSError('inotify is not available') from None
+
+        self.fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        if add_watch(self.fd, os.fsencode(path), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, os.strerror(errno), path)
+
+    def read(self):
+        """Returns the file names in the events that can be read now"""
+        names = []
+
+        while 1:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+
+            if not data:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = _event.unpack_from(data, offset)
+                offset += _event.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if name:
+                    names.append(os.fsdecode(name))
+
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class SpoolWatcher:
+    """Calls callback(name, path) for each exit record that appears in a
+    spool directory, where name is the job id. Records already in the
+    directory are found by the first scan. The same record is reported once,
+    until forget is called for it.
+
+    :param path: Spool directory, it is created if it does not exist
+    :param callback: Called with the job id and path of each new record
+    :param loop: Event loop that runs the watcher
+    :param scan_interval: Seconds between directory scans
+    """
+    def __init__(self, path, callback, loop, scan_interval=5):
+        self.path = os.path.abspath(path)
+        self.callback = callback
+        self.loop = loop
+        self.scan_interval = scan_interval
+        self.inotify = None
+        self._seen = set()
+        self._timer = None
+
+    def __repr__(self):
+        mode = 'inotify' if self.inotify else 'scan'
+        return f'<SpoolWatcher {mode} {self.path}>'
+
+    def start(self):
+        os.makedirs(self.path, exist_ok=True)
+
+        try:
+            self.inotify = Inotify(self.path)
+            self.loop.add_reader(self.inotify.fd, self._read_events)
+        except (OSError, NotImplementedError) as e:
+            log.debug(f'Spool {self.path} is only scanned: {e}')
+            if self.inotify is not None:
+                self.inotify.close()
+                self.inotify = None
+
+        self.scan()
+        log.debug(f'Started {self}')
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if self.inotify is not None:
+            self.loop.remove_reader(self.inotify.fd)
+            self.inotify.close()
+            self.inotify = None
+
+    def forget(self, name):
+        self._seen.discard(name)
+
+    def _found(self, filename):
+        if filename.startswith('.') or not filename.endswith(SUFFIX):
+            return
+
+        name = filename[:-len(SUFFIX)]
+        if name in self._seen:
+            return
+
+        self._seen.add(name)
+        try:
+            self.callback(name, os.path.join(self.path, filename))
+        except Exception:
+            log.exception(f'Error handling exit record: {filename}')
+
+    def _read_events(self):
+        for filename in self.inotify.read():
+            self._found(filename)
+
+    def scan(self):
+        """Reports every record in the directory, and schedules the next
+        scan"""
+        try:
+            with os.scandir(self.path) as entries:
+                filenames = [e.name for e in entries]
+        except OSError as e:
+            log.warning(f'Failed to scan spool {self.path}: {e}')
+            filenames = []
+
+        for filename in filenames:
+            self._found(filename)
+
+        self._timer = self.loop.call_later(self.scan_interval, self.scan)
@@ -13,6 +13,14 @@ IDENTITY = (
     'exec'
 )
 
+# Added to the identity of tasks with a call directive. Other tasks keep the
+# same identity they had before call directives were added.
+CALL_IDENTITY = (
+    'call',
+    'args',
+    'kwargs'
+)
+
 VALID_STATES = (
     'new',
     'pending',
@@ -119,7 +127,12 @@ class Task:
 
     def _get_identity(self, directives):
         components = []
-        for d in IDENTITY:
+        fields = IDENTITY
+
+        if directives.get('call'):
+            fields += CALL_IDENTITY
+
+        for d in fields:
             val = directives.get(d, '')
 
             try:
@@ -9,13 +9,11 @@ import io
 import json
 import logging
 import os
-import subprocess
 import sys
 import yaml
 from collections.abc import Sequence, Mapping
 from datetime import datetime
 from getpass import getuser
-from multiprocessing import cpu_count
 from socket import gethostname
 from uuid import getnode, uuid4
 
@@ -215,20 +213,24 @@ def dynamic_import(path):
         raise AttributeError(err) from None
 
 
-def guess_local_cpus( default=1):
-    return cpu_count() or default
+def guess_local_cpus(default=1):
+    """Returns the number of cpus this process may use: its cpu affinity and
+    cgroup cpu quota (see jetstream.capacity)"""
+    return jetstream.capacity.detect().cpus or default
 
 
 def guess_max_forks(default=500):
-    """Returns 1/4 of current ulimit -u value. This leaves a good amount of
-    room for subprocesses to continue."""
-    try:
-        res = int(0.25 * int(subprocess.check_output('ulimit -u', shell=True)))
-        return res
-    except subprocess.CalledProcessError as e:
-        log.debug('Guessing max forks with ulimit -u failed, using default')
+    """Returns 1/4 of the process limit (RLIMIT_NPROC or the cgroup pids
+    limit). This leaves a good amount of room for subprocesses to
+    continue."""
+    procs = jetstream.capacity.detect().procs
+
+    if procs is None:
+        log.debug('No process limit found for max forks, using default')
         return default
 
+    return max(1, procs // 4)
+
 
 def is_gzip(path, magic_number=b'\x1f\x8b'):
     """Returns True if the path is gzipped."""
@@ -332,6 +334,96 @@ def parse_json(data):
     return json.loads(data)
 
 
+def parse_elapsed(value):
+    """Returns the seconds in a timedelta string, like the elapsed_time saved
+    in task.state: "1 day, 2:03:04.5" or "0:00:05.123456". Returns None if
+    the value cannot be parsed."""
+    try:
+        days = 0
+        if 'day' in value:
+            d, _, value = value.partition(',')
+            days = int(d.split()[0])
+
+        h, m, sec = value.strip().split(':')
+        return days * 86400 + int(h) * 3600 + int(m) * 60 + float(sec)
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def parse_mem(value):
+    """Returns the megabytes in a memory value given in the same format as
+    the Slurm --mem option: a number with an optional K, M, G, or T suffix.
+    Plain numbers are megabytes. Returns None for empty values."""
+    units = {'K': 1 / 1024, 'M': 1, 'G': 1024, 'T': 1024 ** 2}
+
+    if value is None or value == '':
+        return None
+    elif isinstance(value, (int, float)):
+        return float(value)
+
+    value = str(value).strip().upper().rstrip('B')
+
+    if value and value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    else:
+        return float(value)
+
+
+def parse_walltime(value):
+    """Returns the seconds in a walltime given in any of the formats accepted
+    by the Slurm --time option: "minutes", "minutes:seconds",
+    "hours:minutes:seconds", "days-hours", "days-hours:minutes" and
+    "days-hours:minutes:seconds". Returns None for empty values."""
+    if value is None or value == '':
+        return None
+    elif isinstance(value, (int, float)):
+        return float(value) * 60
+
+    value = str(value).strip()
+    days, sep, rest = value.partition('-')
+
+    if sep:
+        days = int(days)
+        parts = [int(p) for p in rest.split(':')]
+        parts += [0] * (3 - len(parts))
+        hours, minutes, seconds = parts
+    else:
+        days = 0
+        parts = [float(p) for p in value.split(':')]
+        if len(parts) == 1:
+            hours, minutes, seconds = 0, parts[0], 0
+        elif len(parts) == 2:
+            hours, (minutes, seconds) = 0, parts
+        else:
+            hours, minutes, seconds = parts
+
+    return days * 86400 + hours * 3600 + minutes * 60 + seconds
+
+
+def parse_duration(value):
+    """Returns the seconds in a duration like the expected_duration directive.
+    Numbers, and strings of a number, are seconds. Other strings are walltimes
+    (see parse_walltime), so "1:30:00" is 90 minutes. Returns None for empty
+    values."""
+    if value is None or value == '':
+        return None
+
+    try:
+        return float(value)
+    except ValueError:
+        return parse_walltime(value)
+
+
+def format_walltime(seconds):
+    """Returns seconds as a walltime string that Slurm accepts for the --time
+    option: "days-hours:minutes:seconds". Partial seconds are rounded up."""
+    seconds = int(-(-seconds // 1))
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return f'{days}-{hours:02d}:{minutes:02d}:{seconds:02d}'
+
+
 def parse_table(data, dialect='unix', headers=True, ordered=False):
     """Attempts to load a table file in any format. Returns a list of 
     dictionaries (or list of lists if no header is available). This requires 
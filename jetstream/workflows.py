@@ -168,15 +168,28 @@ class Workflow:
         log.info('Resume: Resetting state for any pending tasks...')
         for task in self:
             if task.status == 'pending':
-                self.reset_task(task)
+                self.reset_interrupted(task)
 
     def retry(self):
         """Resets state for any "pending" or "failed" tasks """
         log.info('Retry: Resetting state for any pending or failed tasks...')
         for task in self:
-            if task.status in ('pending', 'failed', 'skipped'):
+            if task.status == 'pending':
+                self.reset_interrupted(task)
+            elif task.status in ('failed', 'skipped'):
                 self.reset_task(task)
 
+    def reset_interrupted(self, task):
+        """Resets a task that was pending when the last run stopped. Its
+        previous state is kept in task.state['interrupted'], so the backend
+        can pick up a job that is still running for it instead of starting
+        the task again (see SlurmBackend.reattach)."""
+        previous = dict(task.state)
+        previous.pop('interrupted', None)
+        previous['identity'] = task.identity
+        self.reset_task(task)
+        task.state['interrupted'] = previous
+
     def reset_task(self, task):
         task.reset()
 
@@ -330,8 +343,13 @@ class WorkflowGraph:
 
 
 class WorkflowGraphIterator:
-    def __init__(self, graph):
+    """Yields tasks as they become ready, and None when no task is ready
+    right now. ready(task) decides if a task can start, it defaults to
+    graph.is_ready. The runner replaces it to start tasks before their
+    predecessors are complete on backends that submit ahead."""
+    def __init__(self, graph, ready=None):
         self.graph = graph
+        self.ready = ready or graph.is_ready
         self.tasks = list(self.graph.workflow)
         self.i = 0
 
@@ -343,7 +361,7 @@ class WorkflowGraphIterator:
             task = self.tasks[self.i]
             self.i += 1
 
-            if self.graph.is_ready(task):
+            if self.ready(task):
                 task.pending()
                 return task
 
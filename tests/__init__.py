@@ -0,0 +1,4 @@
+import os
+
+# Tasks run by the tests are not recorded in the user's runtime history
+os.environ['JETSTREAM_NO_HISTORY'] = '1'
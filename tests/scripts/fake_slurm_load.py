@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Load test of the SlurmBackend against a fake Slurm cluster
+
+Runs a workflow of short tasks through the runner and the SlurmBackend, with
+jobs scheduled by jetstream.fakeslurm. Jobs are not run, each one takes
+--runtime seconds. Tasks are in chains of --depth tasks, so that dependency
+handling (and submit_ahead) is part of the measurement. Reports the wall
+time of the run and the sbatch/sacct/squeue calls made. Example:
+
+    python tests/scripts/fake_slurm_load.py --tasks 100000 --depth 4 \\
+        --cpus 2000 --runtime 5 --submit-ahead 3
+
+With --partitions the cluster has several partitions (see
+jetstream.fakeslurm), jobs go to the first one unless --route lets the
+backend choose among all of them.
+"""
+import argparse
+import logging
+import os
+import tempfile
+import time
+import jetstream
+from jetstream import fakeslurm
+
+COUNTED = ('sbatch', 'sacct', 'squeue', 'sinfo')
+
+
+def count_calls(cluster):
+    """Wraps the fake commands to count how often they are run"""
+    for command in COUNTED:
+        path = os.path.join(cluster.bin_dir, command)
+        wrapper = path + '.counted'
+        with open(wrapper, 'w') as fp:
+            fp.write(f'#!/bin/bash\necho >> {path}.calls\n'
+                     f'exec {path} "$@"\n')
+        os.chmod(wrapper, 0o755)
+
+
+def calls(cluster, command):
+    try:
+        with open(os.path.join(cluster.bin_dir, command + '.calls')) as fp:
+            return len(fp.readlines())
+    except FileNotFoundError:
+        return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tasks', type=int, default=10000)
+    parser.add_argument('--depth', type=int, default=1,
+                        help='tasks in each chain [%(default)s]')
+    parser.add_argument('--cpus', type=int, default=1000,
+                        help='fake cluster cpus [%(default)s]')
+    parser.add_argument('--runtime', type=float, default=1,
+                        help='seconds each job runs [%(default)s]')
+    parser.add_argument('--queue-delay', type=float, default=1)
+    parser.add_argument('--queue-jitter', type=float, default=0)
+    parser.add_argument('--fail-rate', type=float, default=0)
+    parser.add_argument('--sacct-frequency', type=float, default=5)
+    parser.add_argument('--array-max-size', type=int, default=1000)
+    parser.add_argument('--submit-ahead', type=int, default=0)
+    parser.add_argument('--max-concurrency', type=int, default=None)
+    parser.add_argument('--spool', action='store_true',
+                        help='complete tasks from job exit records, jobs '
+                             'are run (sleep --runtime) to write them')
+    parser.add_argument('--partitions',
+                        help='fake cluster partitions, e.g. a:100,b:100')
+    parser.add_argument('--route', action='store_true',
+                        help='route jobs to the partitions')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING)
+    jetstream.settings.read(user=False)
+
+    wf = jetstream.Workflow()
+    cmd = f'sleep {args.runtime}' if args.spool else 'true'
+    for i in range(args.tasks):
+        after = f'task{i - 1}' if i % args.depth else None
+        wf.new_task(name=f'task{i}', cmd=cmd, after=after,
+                    stdout='/dev/null')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cluster = fakeslurm.FakeSlurm(
+            tmp, cpus=args.cpus,
+            runtime=None if args.spool else args.runtime,
+            queue_delay=args.queue_delay, queue_jitter=args.queue_jitter,
+            fail_rate=args.fail_rate, partitions=args.partitions)
+
+        with cluster:
+            count_calls(cluster)
+            params = {
+                f'{c}_executable': os.path.join(cluster.bin_dir, c)
+                + ('.counted' if c in COUNTED else '')
+                for c in fakeslurm.COMMANDS
+            }
+            params.update({
+                '()': 'jetstream.backends.slurm.SlurmBackend',
+                'sacct_frequency': args.sacct_frequency,
+                'array_max_size': args.array_max_size,
+                'submit_ahead': args.submit_ahead,
+                'max_submit_jobs': args.tasks,
+                'sbatch_rate': None,
+                'spool': args.spool,
+                'spool_dir': os.path.join(tmp, 'spool'),
+            })
+            if args.route and args.partitions:
+                params['partitions'] = [
+                    p.partition(':')[0] for p in args.partitions.split(',')]
+            jetstream.settings.set({'backends': {'fake_slurm': params}})
+
+            runner = jetstream.Runner(
+                backend='fake_slurm', autosave=0,
+                max_concurrency=args.max_concurrency or args.tasks)
+            start = time.perf_counter()
+            runner.start(workflow=wf)
+            elapsed = time.perf_counter() - start
+
+            counts = {c: calls(cluster, c) for c in COUNTED}
+
+    summary = wf.summary()
+    print(f'{args.tasks} tasks in chains of {args.depth}, {args.cpus} cpus, '
+          f'{args.runtime}s jobs, submit_ahead={args.submit_ahead}, '
+          f'spool={args.spool}, partitions={args.partitions}, '
+          f'route={args.route}')
+    print(f'wall time: {elapsed:.1f}s')
+    print('calls: ' + ', '.join(f'{c}={n}' for c, n in counts.items()))
+    print('tasks: ' + ', '.join(f'{k}={v}' for k, v in sorted(summary.items())))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+"""Slurm status polling benchmark for the SlurmBackend job monitor
+
+Compares the bytes transferred and the parse time of one poll for a number
+of tracked jobs, with synthetic command output (no cluster needed):
+
+- all: "sacct --format all" for every tracked job (the old job monitor)
+- narrow: sacct with only the fields in the default settings, for every job
+- squeue: "squeue -o '%i %T'" for every job, plus narrow sacct for the jobs
+  that have left the queue since the last poll (the job monitor now)
+
+Example:
+
+    python tests/scripts/sacct_poll.py --jobs 10000 --finished 0.05
+"""
+import argparse
+import random
+import time
+import jetstream
+from jetstream.backends import slurm
+
+# Fields returned by "sacct --format all" (Slurm 20.11)
+ALL_FIELDS = (
+    'Account AdminComment AllocCPUS AllocNodes AllocTRES AssocID AveCPU '
+    'AveCPUFreq AveDiskRead AveDiskWrite AvePages AveRSS AveVMSize BlockID '
+    'Cluster Comment Constraints ConsumedEnergy ConsumedEnergyRaw CPUTime '
+    'CPUTimeRAW DBIndex DerivedExitCode Elapsed ElapsedRaw Eligible End '
+    'ExitCode Flags GID Group JobID JobIDRaw JobName Layout MaxDiskRead '
+    'MaxDiskReadNode MaxDiskReadTask MaxDiskWrite MaxDiskWriteNode '
+    'MaxDiskWriteTask MaxPages MaxPagesNode MaxPagesTask MaxRSS MaxRSSNode '
+    'MaxRSSTask MaxVMSize MaxVMSizeNode MaxVMSizeTask McsLabel MinCPU '
+    'MinCPUNode MinCPUTask NCPUS NNodes NodeList NTasks Priority Partition '
+    'QOS QOSRAW Reason ReqCPUFreq ReqCPUFreqMin ReqCPUFreqMax ReqCPUFreqGov '
+    'ReqCPUS ReqMem ReqNodes ReqTRES Reservation ReservationId Reserved '
+    'ResvCPU ResvCPURAW Start State Submit Suspended SystemCPU SystemComment '
+    'Timelimit TimelimitRaw TotalCPU TRESUsageInAve TRESUsageInMax '
+    'TRESUsageInMaxNode TRESUsageInMaxTask TRESUsageInMin TRESUsageInMinNode '
+    'TRESUsageInMinTask TRESUsageInTot TRESUsageOutAve TRESUsageOutMax '
+    'TRESUsageOutMaxNode TRESUsageOutMaxTask TRESUsageOutMin '
+    'TRESUsageOutMinNode TRESUsageOutMinTask TRESUsageOutTot UID User '
+    'UserCPU WCKey WCKeyID WorkDir'
+).split()
+
+SAMPLES = {
+    'AllocTRES': 'billing=4,cpu=4,mem=16G,node=1',
+    'ReqTRES': 'billing=4,cpu=4,mem=16G,node=1',
+    'Comment': '{"id": "0123456789abcdef0123456789abcdef01234567", "tags": []}',
+    'NodeList': 'node-0042',
+    'WorkDir': '/scratch/projects/p01234/analysis',
+    'TRESUsageInTot': 'cpu=00:12:34,energy=0,fs/disk=123456789,mem=1234M,'
+                      'pages=0,vmem=2345M',
+}
+
+
+def value(field, i):
+    if field in SAMPLES:
+        return SAMPLES[field]
+    elif field.endswith(('CPU', 'Time', 'Elapsed')):
+        return '00:12:34'
+    elif field in ('Start', 'End', 'Submit', 'Eligible'):
+        return '2020-01-01T12:34:56'
+    return str(i % 1000)
+
+
+def sacct_output(job_ids, fields):
+    """Output of sacct -P for jobs with a batch and extern step each"""
+    d = slurm.sacct_delimiter
+    lines = [d.join(fields)]
+
+    for jid in job_ids:
+        for jobid, state in ((jid, 'COMPLETED'), (f'{jid}.batch', 'COMPLETED'),
+                             (f'{jid}.extern', 'COMPLETED')):
+            row = []
+            for f in fields:
+                if f == 'JobID':
+                    row.append(jobid)
+                elif f == 'State':
+                    row.append(state)
+                elif f == 'ExitCode':
+                    row.append('0:0')
+                else:
+                    row.append(value(f, int(jid)))
+            lines.append(d.join(row))
+
+    return '\n'.join(lines) + '\n'
+
+
+def squeue_output(job_ids):
+    states = ('PENDING', 'RUNNING')
+    return ''.join(f'{jid} {states[int(jid) % 2]}\n' for jid in job_ids)
+
+
+def measure(outputs, parsers, repeat):
+    size = sum(len(o.encode()) for o in outputs)
+    start = time.perf_counter()
+
+    for i in range(repeat):
+        for output, parse in zip(outputs, parsers):
+            parse(output)
+
+    return size, (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--jobs', type=int, default=10000,
+                        help='tracked jobs [%(default)s]')
+    parser.add_argument('--finished', type=float, default=0.05,
+                        help='fraction of jobs that left the queue since the '
+                             'last poll [%(default)s]')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='parse each output this many times')
+    args = parser.parse_args()
+
+    jetstream.settings.read(user=False)
+    fields = jetstream.settings['backends']['slurm']['sacct_fields'].get(list)
+    narrow = tuple(dict.fromkeys(slurm.SACCT_REQUIRED_FIELDS + tuple(fields)))
+
+    job_ids = [str(1000000 + i) for i in range(args.jobs)]
+    random.seed(0)
+    finished = random.sample(job_ids, int(args.jobs * args.finished))
+    queued = sorted(set(job_ids) - set(finished))
+
+    modes = (
+        ('all', [sacct_output(job_ids, ALL_FIELDS)],
+         [slurm.parse_sacct]),
+        ('narrow', [sacct_output(job_ids, narrow)],
+         [slurm.parse_sacct]),
+        ('squeue', [squeue_output(queued), sacct_output(finished, narrow)],
+         [slurm.parse_squeue, slurm.parse_sacct]),
+    )
+
+    print(f'{args.jobs} jobs tracked, {len(finished)} finished, '
+          f'{len(narrow)} narrow fields, {len(ALL_FIELDS)} in all')
+    print(f'{"mode":>8} {"bytes":>12} {"parse_ms":>10}')
+
+    for name, outputs, parsers in modes:
+        size, seconds = measure(outputs, parsers, args.repeat)
+        print(f'{name:>8} {size:>12,} {seconds * 1000:>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Scale benchmark for jetstream simulate
+
+Builds a workflow of --tasks tasks in --width independent chains that join
+in a final task, with mixed resource requests, and times the three steps of
+"jetstream simulate": building the workflow, building its graph, and the
+simulation itself. Example:
+
+    python tests/scripts/simulate_scale.py --tasks 100000 1000000
+"""
+import argparse
+import cProfile
+import pstats
+import time
+import jetstream
+from jetstream import simulation
+
+
+def build(n, width):
+    wf = jetstream.Workflow()
+    for i in range(n - 1):
+        after = f't{i - width}' if i >= width else None
+        wf.new_task(name=f't{i}', cmd='true', after=after, cpus=1 + i % 4,
+                    expected_duration=10 + i % 50)
+    wf.new_task(name='join', cmd='true',
+                after=[f't{i}' for i in range(max(0, n - 1 - width), n - 1)])
+    return wf
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tasks', type=int, nargs='+', default=[100000])
+    parser.add_argument('--width', type=int, default=1000,
+                        help='independent chains [%(default)s]')
+    parser.add_argument('--cpus', type=int, default=512,
+                        help='cpus of the modeled backend [%(default)s]')
+    parser.add_argument('--profile', action='store_true',
+                        help='print the top functions of the simulation')
+    args = parser.parse_args()
+
+    jetstream.settings.read(user=False)
+    model = simulation.local_model(cpus=args.cpus)
+    print(f'{"tasks":>10} {"build_s":>9} {"graph_s":>9} {"simulate_s":>11} '
+          f'{"makespan":>12}')
+
+    for n in args.tasks:
+        start = time.perf_counter()
+        wf = build(n, args.width)
+        built = time.perf_counter()
+        wf.graph
+        graphed = time.perf_counter()
+
+        if args.profile:
+            profile = cProfile.Profile()
+            report = profile.runcall(simulation.simulate, wf, model)
+        else:
+            report = simulation.simulate(wf, model)
+        simulated = time.perf_counter()
+
+        print(f'{n:>10} {built - start:>9.2f} {graphed - built:>9.2f} '
+              f'{simulated - graphed:>11.2f} {report["makespan_hms"]:>12}')
+
+        if args.profile:
+            pstats.Stats(profile).sort_stats('cumulative').print_stats(15)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Spawn-rate benchmark for the LocalBackend process launcher
+
+Starts short commands as fast as possible, directly from this process with
+asyncio.create_subprocess_shell (what the LocalBackend does by default), and
+through the process launcher. A ballast of memory stands in for a runner
+with a large workflow loaded, the launcher is started before the ballast is
+allocated, like the CLI does. Example:
+
+    python tests/scripts/spawn_rate.py --tasks 2000 --ballast 0 1000 4000
+"""
+import argparse
+import asyncio
+import time
+from jetstream import launcher
+
+
+async def spawn_direct(cmd):
+    p = await asyncio.create_subprocess_shell(cmd, executable='/bin/bash')
+    return await p.wait()
+
+
+async def spawn_launcher(cmd):
+    p = await launcher.get_launcher().spawn(cmd)
+    return await p.wait()
+
+
+async def bench(spawn, tasks, concurrency, cmd):
+    sem = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one():
+        async with sem:
+            start = time.perf_counter()
+            rc = await spawn(cmd)
+            latencies.append(time.perf_counter() - start)
+            if rc != 0:
+                raise RuntimeError(f'Command failed: {rc}')
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one() for i in range(tasks)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'rate': tasks / elapsed,
+        'p50': latencies[len(latencies) // 2] * 1000,
+        'p99': latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tasks', type=int, default=1000,
+                        help='commands started for each measurement')
+    parser.add_argument('--concurrency', type=int, default=32,
+                        help='commands running at once')
+    parser.add_argument('--cmd', default='true',
+                        help='command to spawn [%(default)s]')
+    parser.add_argument('--ballast', type=int, nargs='+', default=[0, 1000],
+                        help='MB of memory held by this process, one '
+                             'measurement for each value')
+    args = parser.parse_args()
+
+    launcher.get_launcher()
+    loop = asyncio.get_event_loop()
+    ballast = bytearray()
+
+    print(f'{"ballast_mb":>10} {"mode":>9} {"spawns/s":>9} '
+          f'{"p50_ms":>8} {"p99_ms":>8}')
+
+    for mb in sorted(args.ballast):
+        # Touch every page so it is mapped in the page tables
+        ballast.extend(b'\1' * (mb * 2 ** 20 - len(ballast)))
+
+        for mode, spawn in (('direct', spawn_direct),
+                            ('launcher', spawn_launcher)):
+            r = loop.run_until_complete(
+                bench(spawn, args.tasks, args.concurrency, args.cmd))
+            print(f'{mb:>10} {mode:>9} {r["rate"]:>9.1f} '
+                  f'{r["p50"]:>8.2f} {r["p99"]:>8.2f}')
+
+
+if __name__ == '__main__':
+    main()
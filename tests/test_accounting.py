@@ -0,0 +1,11 @@
+from unittest import TestCase
+from jetstream.accounting import format_cpu_time, parse_cpu_time
+
+
+class AccountingTests(TestCase):
+    def test_cpu_time_format(self):
+        self.assertEqual(format_cpu_time(61.5), '00:01:01.500')
+        self.assertEqual(format_cpu_time(90061), '1-01:01:01.000')
+        self.assertEqual(parse_cpu_time('01:01.500'), 61.5)
+        self.assertEqual(parse_cpu_time('1-01:01:01'), 90061)
+        self.assertIsNone(parse_cpu_time(''))
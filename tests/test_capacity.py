@@ -0,0 +1,44 @@
+import os
+import tempfile
+from unittest import TestCase
+from jetstream import capacity, utils
+
+
+class CapacityTests(TestCase):
+    def test_capacity_cgroups(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        mount = os.path.join(temp_dir.name, 'sys', 'cpu')
+        leaf = os.path.join(mount, 'job_1')
+        os.makedirs(leaf)
+        for path, quota in ((mount, 800000), (leaf, 200000)):
+            with open(os.path.join(path, 'cpu.cfs_quota_us'), 'w') as fp:
+                fp.write(str(quota))
+            with open(os.path.join(path, 'cpu.cfs_period_us'), 'w') as fp:
+                fp.write('100000')
+
+        # The container mount starts at /slurm in the hierarchy
+        mountinfo = os.path.join(temp_dir.name, 'mountinfo')
+        with open(mountinfo, 'w') as fp:
+            fp.write(f'30 25 0:26 /slurm {mount} rw - cgroup cgroup '
+                     f'rw,cpu,cpuacct\n')
+        cgroup = os.path.join(temp_dir.name, 'cgroup')
+        with open(cgroup, 'w') as fp:
+            fp.write('4:cpu,cpuacct:/slurm/job_1\n0::/\n')
+
+        dirs = capacity.cgroup_v1_dirs(mountinfo, cgroup)
+        self.assertEqual(dirs['cpu'], (mount, leaf))
+
+        # Limits are the smallest between the cgroup and the mount point
+        quota = capacity._limits(*dirs['cpu'], (
+            'cpu.cfs_quota_us', 'cpu.cfs_period_us'), capacity._parse_cfs)
+        self.assertEqual(quota, 2)
+
+        self.assertEqual(capacity._parse_cpu_max('250000 100000'), 2.5)
+        self.assertIsNone(capacity._parse_cpu_max('max 100000'))
+        self.assertIsNone(capacity._parse_bytes('9223372036854771712'))
+
+        detected = capacity.detect()
+        self.assertGreaterEqual(detected.cpus, 1)
+        self.assertLessEqual(detected.cpus, os.cpu_count())
+        self.assertEqual(utils.guess_local_cpus(), detected.cpus)
@@ -1,9 +1,12 @@
 import os
+import subprocess
 import sys
 import tempfile
+import time
 import jetstream
 from unittest import TestCase
 from jetstream.cli import main as cli_main
+import jetstream.daemon
 
 jetstream.settings.clear()
 jetstream.settings.read(user=False)
@@ -132,6 +135,57 @@ class TestCli(TestCase):
         args = ['tasks', '--project', p.paths.path]
         cli_main(args)
 
+    def test_run_projects(self):
+        """run a template for several projects at once"""
+        a = jetstream.init('a')
+        b = jetstream.init('b')
+
+        with open('testwf.jst', 'w') as fp:
+            fp.write('- cmd: "true"\n')
+
+        args = ['run', 'testwf.jst', '--projects', a.path, b.path]
+        cli_main(args)
+
+        self.assertEqual(a.load_workflow().summary(), {'complete': 1})
+        self.assertEqual(b.load_workflow().summary(), {'complete': 1})
+
+    def test_daemon(self):
+        """daemon should accept project runs over its socket"""
+        p = jetstream.init()
+        wf = p.load_workflow()
+        wf.new_task(name='hello', cmd='echo hello')
+        wf.save()
+
+        sock = os.path.join(self.temp_dir.name, 'daemon.sock')
+        cmd = [sys.executable, '-m', 'jetstream', 'daemon', 'start',
+               '--socket', sock, '-l', 'silent']
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(TESTS_DIR))
+        proc = subprocess.Popen(cmd, env=env)
+
+        try:
+            for i in range(100):
+                if os.path.exists(sock):
+                    break
+                time.sleep(0.1)
+
+            cli_main(['daemon', 'submit', '--socket', sock])
+
+            for i in range(100):
+                status = jetstream.daemon.request({'action': 'status'}, sock)
+                if status['history']:
+                    break
+                time.sleep(0.1)
+
+            self.assertEqual(status['history'][0]['summary'], {'complete': 1})
+            cli_main(['daemon', 'stop', '--socket', sock])
+            self.assertEqual(proc.wait(timeout=30), 0)
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+
+        self.assertFalse(p.is_locked)
+        self.assertEqual(p.load_workflow().summary(), {'complete': 1})
+
     def test_render(self):
         """jetstream render should just render and print the template"""
         render_test = """{% for i in range(3) %} 
@@ -0,0 +1,58 @@
+from unittest import TestCase
+from jetstream.concurrency import AdaptiveConcurrency, ConcurrencyLimit
+
+
+class ConcurrencyTests(TestCase):
+    def test_adaptive_concurrency_aimd(self):
+        limit = ConcurrencyLimit(10)
+        ac = AdaptiveConcurrency(limit, maximum=100, initial=10, increase=5,
+                                 max_load=float('inf'), min_mem_available=0)
+
+        # Not saturated, the limit is held
+        self.assertEqual(ac.check(1)['action'], 'hold')
+        self.assertEqual(limit.value, 10)
+
+        # Saturated, the limit increases additively
+        limit.in_use = 10
+        self.assertEqual(ac.check(1)['action'], 'increase')
+        self.assertEqual(limit.value, 15)
+
+        # Fork failures decrease it multiplicatively
+        ac._fork_failures = 2
+        self.assertEqual(ac.check(1)['action'], 'decrease')
+        self.assertEqual(limit.value, 7)
+        self.assertEqual(ac.summary()['decreases'], 1)
+
+    def test_adaptive_concurrency_fork_failure(self):
+        limit = ConcurrencyLimit(64)
+        ac = AdaptiveConcurrency(limit, maximum=64, initial=64, interval=60,
+                                 max_load=float('inf'), min_mem_available=0)
+
+        # The limit is decreased right away, once per interval
+        ac.fork_failed()
+        ac.fork_failed()
+        self.assertEqual(limit.value, 32)
+
+        # The next check does not decrease it again for the same failures
+        self.assertEqual(ac.check(1)['action'], 'hold')
+        self.assertEqual(limit.value, 32)
+        self.assertEqual(ac.check(1)['fork_failures'], 0)
+
+    def test_adaptive_concurrency_rate_drop(self):
+        limit = ConcurrencyLimit(10)
+        ac = AdaptiveConcurrency(limit, maximum=100, initial=10, increase=10,
+                                 decrease=0.9, rate_drop=0.5,
+                                 max_load=float('inf'), min_mem_available=0)
+        limit.in_use = 100
+
+        # A smaller drop in completion rate than rate_drop is not a decrease
+        self.assertEqual(ac.check(1)['action'], 'increase')
+        ac._completed = 10
+        self.assertEqual(ac.check(1)['action'], 'increase')
+        ac._completed = 6
+        self.assertEqual(ac.check(1)['action'], 'increase')
+        self.assertEqual(limit.value, 40)
+
+        ac._completed = 2
+        self.assertEqual(ac.check(1)['action'], 'decrease')
+        self.assertEqual(limit.value, 36)
@@ -0,0 +1,21 @@
+from unittest import TestCase
+import jetstream
+from jetstream import fusion
+
+
+class FusionTests(TestCase):
+    def test_fusion_limits(self):
+        wf = jetstream.Workflow()
+        wf.new_task(name='t0', cmd='true', walltime='1:00:00')
+        for i in range(1, 6):
+            wf.new_task(name=f't{i}', cmd='true', after=f't{i-1}',
+                        walltime='1:00:00', cpus=4 if i == 3 else 1)
+
+        chains = fusion.find_chains(wf, max_length=2)
+        self.assertEqual(chains, [['t0', 't1'], ['t2', 't3'], ['t4', 't5']])
+
+        chains = fusion.find_chains(wf, max_cpus=2)
+        self.assertEqual(chains, [['t0', 't1', 't2'], ['t4', 't5']])
+
+        chains = fusion.find_chains(wf, max_walltime='3:00:00')
+        self.assertEqual(chains, [['t0', 't1', 't2'], ['t3', 't4', 't5']])
@@ -0,0 +1,10 @@
+from unittest import TestCase
+from jetstream.history import percentile
+
+
+class HistoryTests(TestCase):
+    def test_history_percentile(self):
+        values = [1, 2, 3, 4, 5]
+        self.assertEqual(percentile(values, 50), 3)
+        self.assertEqual(percentile(values, 90), 4.6)
+        self.assertIsNone(percentile([], 50))
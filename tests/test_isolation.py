@@ -0,0 +1,14 @@
+from unittest import TestCase
+from jetstream.isolation import CpuAllocator
+
+
+class IsolationTests(TestCase):
+    def test_cpu_allocator(self):
+        cpus = CpuAllocator([0, 1, 2, 3])
+        a = cpus.acquire(2)
+        b = cpus.acquire(3)
+        self.assertEqual(a, [0, 1])
+        self.assertEqual(b, [0, 2, 3])
+        cpus.release(a)
+        self.assertEqual(cpus.acquire(1), [1])
+        self.assertEqual(len(cpus.acquire(8)), 4)
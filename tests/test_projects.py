@@ -1,7 +1,12 @@
+import asyncio
 import os
+import subprocess
 import tempfile
+import time
 import jetstream
 from unittest import TestCase
+from jetstream.cli.subcommands import run as run_cmd
+from jetstream.cli.subcommands import tasks as tasks_cmd
 
 jetstream.settings.clear()
 jetstream.settings.read(user=False)
@@ -71,4 +76,764 @@ class RunnerBasics(TestCase):
         runner.start(workflow=wf)
 
         self.assertTrue(t.is_complete())
-    
\ No newline at end of file
+    
+    def test_runner_dependencies(self):
+        runner = jetstream.Runner()
+        wf = jetstream.Workflow()
+        t1 = wf.new_task(name='t1', cmd='sleep 1', stdout='/dev/null')
+        t2 = wf.new_task(name='t2', cmd='true', after='t1', stdout='/dev/null')
+        runner.start(workflow=wf)
+
+        self.assertTrue(t1.is_complete())
+        self.assertTrue(t2.is_complete())
+
+    def test_runner_stalled(self):
+        """Runs should stop when remaining tasks can never become ready"""
+        runner = jetstream.Runner()
+        wf = jetstream.Workflow()
+        t1 = wf.new_task(name='t1', cmd='true', stdout='/dev/null')
+        t2 = wf.new_task(name='t2', cmd='true', after='t1', stdout='/dev/null')
+        t1.pending()
+        runner.start(workflow=wf)
+
+        # The tasks that never ran are skipped, so the run reports an error
+        self.assertTrue(t2.is_skipped())
+        self.assertTrue(t2.state['stalled'])
+        self.assertTrue(runner._errs)
+        self.assertTrue(run_cmd.check_for_failures(wf))
+
+    def test_runner_exec_cache(self):
+        """Identical exec directives should only be compiled once"""
+        runner = jetstream.Runner()
+        wf = jetstream.Workflow()
+        source = 'task.state["answer"] = 42'
+        t1 = wf.new_task(name='t1', exec=source)
+        t2 = wf.new_task(name='t2', exec=source)
+        runner.start(workflow=wf)
+
+        self.assertEqual(t1.state['answer'], 42)
+        self.assertEqual(t2.state['answer'], 42)
+        self.assertIn('reload_time', t2.state)
+        code = jetstream.runner.compile_exec_directive(source)
+        self.assertIs(code, jetstream.runner.compile_exec_directive(source))
+
+        # The cache is bounded for long-lived runners like the daemon
+        info = jetstream.runner.compile_exec_directive.cache_info()
+        self.assertEqual(info.maxsize, jetstream.runner.EXEC_CACHE_SIZE)
+        self.assertGreater(info.hits, 0)
+
+    def test_runner_exec_namespace(self):
+        """Exec code can use the globals of the runner module"""
+        runner = jetstream.Runner()
+        wf = jetstream.Workflow()
+        t = wf.new_task(name='t', exec=(
+            'task.state["names"] = [utils.__name__, '
+            'settings.__class__.__name__, asyncio.__name__, '
+            'runner.__class__.__name__]'))
+        runner.start(workflow=wf)
+
+        self.assertEqual(t.state['names'],
+                         ['jetstream.utils', 'LazyConfig', 'asyncio', 'Runner'])
+
+    def test_multi_runner(self):
+        """MultiRunner should run several projects with one backend"""
+        runs = []
+        for name in ('project_a', 'project_b'):
+            p = jetstream.init(name)
+            wf = p.load_workflow()
+            wf.new_task(name='write', cmd='echo $JS_PROJECT_PATH > out.txt')
+            wf.new_task(name='after', cmd='true', after='write')
+            runs.append((wf, p))
+
+        runner = jetstream.MultiRunner()
+        runner.start(runs)
+
+        for wf, p in runs:
+            self.assertFalse(p.is_locked)
+            with open(os.path.join(p.path, 'out.txt')) as fp:
+                self.assertEqual(fp.read().strip(), p.path)
+
+            saved = p.load_workflow()
+            self.assertEqual(saved.summary(), {'complete': 2})
+
+    def test_runner_adaptive_concurrency(self):
+        runner = jetstream.Runner(adaptive_concurrency=True)
+        wf = jetstream.Workflow()
+        for i in range(20):
+            wf.new_task(name=f't{i}', cmd='true', stdout='/dev/null')
+        runner.start(workflow=wf)
+
+        self.assertEqual(wf.summary(), {'complete': 20})
+        self.assertIsNotNone(runner.concurrency)
+
+    def test_runner_history(self):
+        path = os.path.join(self._temp_dir.name, 'history.sqlite')
+        history = jetstream.history.History(path)
+        runner = jetstream.Runner(history=history)
+        wf = jetstream.Workflow()
+        for i in range(5):
+            wf.new_task(name=f'align_{i}', cmd='true', stdout='/dev/null',
+                        tags=['align'])
+        wf.new_task(name='fails', cmd='false', stdout='/dev/null')
+        runner.start(workflow=wf)
+
+        history = jetstream.history.History(path)
+        result = history.percentiles('align_*', qs=(50, 100))
+        self.assertEqual(result['count'], 5)
+        self.assertGreaterEqual(result['p100'], result['p50'])
+        self.assertEqual(len(history.query(tag='align')), 5)
+        self.assertEqual(len(history.query(status=None)), 6)
+
+        estimate = history.estimator()
+        self.assertIsNotNone(estimate(wf['align_0']))
+        self.assertIsNone(estimate(wf['fails']))
+
+    def test_runner_fusion(self):
+        runner = jetstream.Runner(history=False)
+        wf = jetstream.Workflow()
+        wf.new_task(name='index', cmd='echo index > index.txt')
+        wf.new_task(name='stats', cmd='cat index.txt > stats.txt',
+                    after='index')
+        wf.new_task(name='checksum', cmd='cat stats.txt', stdout='sum.txt',
+                    after='stats')
+        wf.new_task(name='report', cmd='true', after='checksum')
+        wf.new_task(name='other', cmd='true', after='index')
+
+        # index has two children, so the chain starts at stats
+        chains = jetstream.fusion.fuse(wf)
+        self.assertEqual(chains, [['stats', 'checksum', 'report']])
+
+        runner.start(workflow=wf)
+
+        self.assertEqual(wf.summary(), {'complete': 5})
+        self.assertEqual(wf['checksum'].state['fused'], 'stats-fused')
+        self.assertNotIn('fused', wf['other'].state)
+        with open('sum.txt') as fp:
+            self.assertEqual(fp.read(), 'index\n')
+
+    def test_runner_fusion_failure(self):
+        runner = jetstream.Runner(history=False)
+        wf = jetstream.Workflow()
+        wf.new_task(name='a', cmd='true', stdout='/dev/null')
+        wf.new_task(name='b', cmd='exit 3', after='a', stdout='/dev/null')
+        wf.new_task(name='c', cmd='true', after='b', stdout='/dev/null')
+        wf.new_task(name='d', cmd='true', after='c', stdout='/dev/null')
+        jetstream.fusion.fuse(wf)
+        runner.start(workflow=wf)
+
+        self.assertTrue(wf['a'].is_complete())
+        self.assertTrue(wf['b'].is_failed())
+        self.assertEqual(wf['b'].state['returncode'], 3)
+        self.assertTrue(wf['c'].is_skipped())
+        self.assertTrue(wf['d'].is_skipped())
+
+    def test_runner_routing(self):
+        # Extra backends stay in the settings, they are only used by name
+        jetstream.settings.set({'backends': {
+            'one': {'()': 'jetstream.backends.local.LocalBackend', 'cpus': 1},
+            'small': {'()': 'jetstream.backends.local.LocalBackend', 'cpus': 1},
+        }})
+
+        routing = {
+            'rules': [{'backend': 'small', 'max_walltime': '0:01:00'}],
+            'overflow': {'backend': 'small', 'max_cpus': 1},
+        }
+        runner = jetstream.Runner(backend='one', history=False,
+                                  routing=routing)
+        wf = jetstream.Workflow()
+        wf.new_task(name='directive', cmd='true', backend='small')
+        wf.new_task(name='rule', cmd='true', walltime='0:00:30')
+        for i in range(4):
+            wf.new_task(name=f'big{i}', cmd='sleep 0.2', cpus=1)
+        wf.new_task(name='unknown', cmd='true', backend='nope')
+        wf.new_task(name='after_unknown', cmd='true', after='unknown')
+        runner.start(workflow=wf)
+
+        # An unknown backend directive fails that task, not the whole run
+        self.assertEqual(wf.summary(),
+                         {'complete': 6, 'failed': 1, 'skipped': 1})
+        self.assertIn('nope', wf['unknown'].state['err'])
+        self.assertEqual(set(runner.backends), {'one', 'small'})
+        self.assertEqual(wf['directive'].state['backend'], 'small')
+        self.assertEqual(wf['rule'].state['backend'], 'small')
+        used = {wf[f'big{i}'].state['backend'] for i in range(4)}
+        self.assertEqual(used, {'one', 'small'})
+
+    def test_routing_rules(self):
+        from jetstream.runner import check_rule, match_rule
+        t = jetstream.Task(cmd='true', cpus=2, mem='4G')
+        self.assertTrue(match_rule({'max_cpus': 2, 'max_mem': '8G'}, t))
+        self.assertFalse(match_rule({'max_mem': '1G'}, t))
+        self.assertFalse(match_rule({'max_walltime': '1:00:00'}, t))
+
+        with self.assertRaises(ValueError):
+            check_rule({'backend': 'local', 'max_gpus': 1})
+
+        with self.assertRaises(ValueError):
+            check_rule({'backend': 'nope', 'max_cpus': 1})
+
+        with self.assertRaises(ValueError):
+            jetstream.Runner(routing={'overflow': {'backend': 'nope'}})
+
+    def test_runner_launcher(self):
+        jetstream.settings.set({'backends': {
+            'launched': {'()': 'jetstream.backends.local.LocalBackend',
+                         'launcher': True},
+        }})
+
+        p = jetstream.init()
+        runner = jetstream.Runner(backend='launched', history=False)
+        wf = jetstream.Workflow()
+        wf.new_task(name='env', cmd='echo $JS_PROJECT_PATH; pwd')
+        wf.new_task(name='fails', cmd='echo failing >&2; exit 3')
+        runner.start(workflow=wf, project=p)
+
+        self.assertIsNotNone(runner.backend.launcher)
+        self.assertTrue(wf['env'].is_complete())
+        logs = p.log_store.read(wf['env'].state['stdout_path'])
+        self.assertEqual(logs.split(), [p.path, p.path])
+
+        self.assertTrue(wf['fails'].is_failed())
+        self.assertEqual(wf['fails'].state['returncode'], 3)
+        logs = p.log_store.read(wf['fails'].state['stderr_path'])
+        self.assertEqual(logs, 'failing\n')
+
+    def test_runner_call(self):
+        p = jetstream.init()
+        runner = jetstream.Runner(backend='local', history=False)
+        wf = jetstream.Workflow()
+        wf.new_task(name='prints', call='print', args=['hello', 'call'])
+        wf.new_task(name='returns', call='len', args=[[1, 2, 3]])
+        wf.new_task(name='cwd', call='os.getcwd')
+        wf.new_task(name='env', call='os.getenv', args=['JS_PROJECT_PATH'])
+        wf.new_task(name='kwargs', call='sorted', args=[[1, 3, 2]],
+                    kwargs={'reverse': True})
+        wf.new_task(name='raises', call='int', args=['x'])
+        runner.start(workflow=wf, project=p)
+
+        self.assertTrue(wf['prints'].is_complete())
+        logs = p.log_store.read(wf['prints'].state['stdout_path'])
+        self.assertEqual(logs, 'hello call\n')
+
+        self.assertEqual(wf['returns'].state['returned'], 3)
+        self.assertEqual(wf['cwd'].state['returned'], p.path)
+        self.assertEqual(wf['env'].state['returned'], p.path)
+        self.assertEqual(wf['kwargs'].state['returned'], [3, 2, 1])
+
+        self.assertTrue(wf['raises'].is_failed())
+        self.assertEqual(wf['raises'].state['returncode'], 1)
+        logs = p.log_store.read(wf['raises'].state['stderr_path'])
+        self.assertIn('ValueError', logs)
+
+    def test_runner_isolation(self):
+        # A fake cgroup tree, the files are written like cgroupfs would be
+        root = os.path.abspath('cgroup')
+        run_group = os.path.join(root, f'jetstream-{os.getpid()}')
+        os.makedirs(run_group)
+        with open(os.path.join(run_group, 'cgroup.controllers'), 'w') as fp:
+            fp.write('cpuset cpu io memory pids\n')
+
+        for launcher in (False, True):
+            jetstream.settings.set({'backends': {
+                'isolated': {'()': 'jetstream.backends.local.LocalBackend',
+                             'isolate': True, 'launcher': launcher,
+                             'cgroup_root': root},
+            }})
+
+            runner = jetstream.Runner(backend='isolated', history=False)
+            wf = jetstream.Workflow()
+            wf.new_task(name='pinned', cpus=1, mem='1M', stdout='pinned.txt',
+                        cmd='grep Cpus_allowed_list /proc/self/status')
+            wf.new_task(name='free', cmd='true')
+            runner.start(workflow=wf)
+
+            t = wf['pinned']
+            self.assertTrue(t.is_complete())
+            self.assertEqual(t.state['cpu_affinity'], [0])
+            self.assertNotIn('cpu_affinity', wf['free'].state)
+            with open('pinned.txt') as fp:
+                self.assertEqual(fp.read().split()[-1], '0')
+
+            cgroup = t.state['cgroup']
+            self.assertEqual(os.path.dirname(cgroup), run_group)
+            with open(os.path.join(run_group, 'cgroup.subtree_control')) as fp:
+                self.assertEqual(fp.read(), '+cpu +memory')
+            with open(os.path.join(cgroup, 'cpu.max')) as fp:
+                self.assertEqual(fp.read(), '100000 100000')
+            with open(os.path.join(cgroup, 'memory.max')) as fp:
+                self.assertEqual(fp.read(), str(2 ** 20))
+            with open(os.path.join(cgroup, 'cgroup.procs')) as fp:
+                self.assertTrue(fp.read().isdigit())
+
+    def test_runner_rusage(self):
+        # On Python 3.12 and later, only the launcher collects rusage
+        launchers = (False, True)
+        if jetstream.accounting.RusageChildWatcher is None:
+            launchers = (True,)
+
+        for launcher in launchers:
+            jetstream.settings.set({'backends': {
+                'rusage': {'()': 'jetstream.backends.local.LocalBackend',
+                           'launcher': launcher},
+            }})
+
+            runner = jetstream.Runner(backend='rusage', history=False)
+            wf = jetstream.Workflow()
+            wf.new_task(name='busy', cpus=1,
+                        cmd='i=0; while [ $i -lt 20000 ]; do i=$((i+1)); done')
+            wf.new_task(name='fails', cmd='exit 2')
+            runner.start(workflow=wf)
+
+            rusage = wf['busy'].state['rusage']
+            self.assertEqual(rusage['State'], 'COMPLETED')
+            self.assertEqual(rusage['AllocCPUS'], '1')
+            self.assertTrue(rusage['MaxRSS'].endswith('K'))
+            self.assertGreater(
+                jetstream.accounting.parse_cpu_time(rusage['TotalCPU']), 0)
+            self.assertEqual(wf['fails'].state['rusage']['ExitCode'], '2:0')
+
+            self.assertEqual(runner.usage.tasks, 2)
+            self.assertGreater(runner.usage.efficiency(), 0)
+
+    def test_log_store(self):
+        p = jetstream.init()
+        runner = jetstream.Runner(backend='local', history=False)
+        wf = jetstream.Workflow()
+        for i in range(20):
+            wf.new_task(name=f'task{i}', cmd=f'echo task{i}')
+        wf.new_task(name='own', cmd='echo own', stdout='own.txt')
+        runner.start(workflow=wf, project=p)
+
+        path = wf['task0'].state['stdout_path']
+        shard = os.path.basename(os.path.dirname(path))
+        self.assertEqual(shard, jetstream.logstore.shard('task0'))
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(path + '.gz'))
+        self.assertEqual(p.log_store.read(path), 'task0\n')
+
+        # Logs from the stdout directive are not compressed
+        self.assertTrue(os.path.exists('own.txt'))
+
+        self.assertEqual(p.log_store.archive(), 20)
+        self.assertFalse(os.path.exists(path + '.gz'))
+        for i in range(20):
+            logs = p.log_store.read(wf[f'task{i}'].state['stdout_path'])
+            self.assertEqual(logs, f'task{i}\n')
+
+        # A task that runs again is read from its new log
+        wf['task0'].reset()
+        wf['task0'].directives['cmd'] = 'echo again'
+        runner.start(workflow=wf, project=p)
+        self.assertEqual(p.log_store.read(path), 'again\n')
+        self.assertEqual(p.log_store.archive(), 1)
+        self.assertEqual(p.log_store.read(path), 'again\n')
+
+        details = tasks_cmd.get_details(
+            wf['task1'], log_store=p.log_store)
+        self.assertIn('task1', details.split('logs:')[1])
+
+    def test_runner_mem_limit(self):
+        jetstream.settings.set({'backends': {
+            'small': {'()': 'jetstream.backends.local.LocalBackend',
+                      'cpus': 4, 'mem': '100M'},
+        }})
+
+        runner = jetstream.Runner(backend='small', history=False)
+        wf = jetstream.Workflow()
+        for i in range(3):
+            wf.new_task(name=f't{i}', mem='60M', stdout=f't{i}.txt',
+                        cmd='date +%s.%N; sleep 0.3; date +%s.%N')
+        wf.new_task(name='huge', mem='1G', cmd='true', stdout='/dev/null')
+        runner.start(workflow=wf)
+
+        self.assertEqual(wf.summary(), {'complete': 4})
+        self.assertEqual(runner.backend.mem, 100)
+
+        spans = []
+        for i in range(3):
+            with open(f't{i}.txt') as fp:
+                spans.append([float(t) for t in fp.read().split()])
+
+        # Only one 60M task fits at a time
+        spans.sort()
+        for a, b in zip(spans, spans[1:]):
+            self.assertLessEqual(a[1], b[0])
+
+    def test_slurm_arrays(self):
+        from jetstream.backends import slurm
+        with open('sbatch', 'w') as fp:
+            fp.write('#!/bin/bash\n'
+                     '[ "$1" == "--version" ] && exit 0\n'
+                     'n=$(ls -1 script.* 2>/dev/null | wc -l)\n'
+                     'echo "$@" > args.$n; cat > script.$n; echo $((n+500))\n')
+        os.chmod('sbatch', 0o755)
+
+        class Runner:
+            loop = asyncio.new_event_loop()
+
+            def get_project(self, task):
+                return None
+
+        asyncio.set_event_loop(Runner.loop)
+        self.addCleanup(Runner.loop.close)
+        backend = slurm.SlurmBackend(
+            sbatch_executable=os.path.abspath('sbatch'), array_delay=0.1,
+            array_max_size=3, max_submit_jobs=100, sbatch_rate=None,
+            sbatch_parallel=1)
+        backend.runner = Runner()
+
+        tasks = [jetstream.Task(name=f't{i}', cmd=f'echo t{i}',
+                                stdout=f't{i}.log', cpus=2)
+                 for i in range(4)]
+        tasks.append(jetstream.Task(name='other', cmd='echo other', cpus=4))
+
+        async def submit_all():
+            return await asyncio.gather(*[
+                backend.submit_array_element(t, backend.get_fd_paths(t))
+                for t in tasks])
+
+        jobs = Runner.loop.run_until_complete(submit_all())
+        self.assertEqual([j.jid for j in jobs],
+                         ['500_0', '500_1', '500_2', '501', '502'])
+
+        # One array of 3, and single jobs for the remaining tasks
+        self.assertEqual(len(os.listdir('.')), 1 + 3 * 2)
+        with open('args.0') as fp:
+            self.assertIn('--array=0-2', fp.read().split())
+        with open('args.1') as fp:
+            self.assertNotIn('--array', fp.read())
+
+        # Each array index runs its own cmd with its own output
+        for i in range(3):
+            env = dict(os.environ, SLURM_ARRAY_TASK_ID=str(i))
+            subprocess.run(['bash', 'script.0'], env=env, check=True)
+            with open(f't{i}.log') as fp:
+                self.assertEqual(fp.read(), f't{i}\n')
+
+        # Elements are found in the array job steps from sacct
+        d = slurm.sacct_delimiter
+        out = '\n'.join(d.join(r) for r in [
+            ('JobID', 'State', 'ExitCode'),
+            ('500_0', 'COMPLETED', '0:0'),
+            ('500_0.batch', 'COMPLETED', '0:0'),
+            ('500_1', 'FAILED', '3:0'),
+            ('500_[2]', 'PENDING', '0:0'),
+        ])
+        elements = slurm.array_elements(slurm.parse_sacct(out))
+        self.assertEqual(sorted(elements), ['500_0', '500_1'])
+        self.assertEqual(len(elements['500_0']['_steps']), 1)
+        job = slurm.SlurmBatchJob('500_1')
+        job.job_data = elements['500_1']
+        self.assertEqual(job.returncode(), 3)
+
+    def test_slurm_submit_ahead(self):
+        from jetstream.backends import slurm
+        with open('sbatch', 'w') as fp:
+            fp.write('#!/bin/bash\n'
+                     '[ "$1" == "--version" ] && exit 0\n'
+                     'n=$(ls -1 args.* 2>/dev/null | wc -l)\n'
+                     'echo "$@" > args.$n; cat > /dev/null; echo $((n+500))\n')
+        os.chmod('sbatch', 0o755)
+
+        jetstream.settings.set({'backends': {'slurm_ahead': {
+            '()': 'jetstream.backends.slurm.SlurmBackend',
+            'sbatch_executable': os.path.abspath('sbatch'),
+            'submit_ahead': 2,
+            'array_max_size': 0,
+            'max_submit_jobs': 100,
+            'sbatch_rate': None,
+        }}})
+
+        wf = jetstream.Workflow()
+        for name, after in (('a', None), ('b', 'a'), ('c', 'b'), ('d', 'c')):
+            wf.new_task(name=name, cmd='true', after=after)
+
+        runner = jetstream.Runner(backend='slurm_ahead')
+        runner._start_event_loop()
+        self.addCleanup(runner._cleanup_event_loop)
+        runner._start_backend()
+        runner._workflow = wf
+        backend = runner.backend
+        it = runner.iterate(wf)
+        futures = {}
+
+        def spawn():
+            task = next(it)
+            runner.route(task)
+            futures[task.name] = runner.loop.create_task(backend.spawn(task))
+            runner.loop.run_until_complete(asyncio.sleep(0.5))
+            return task
+
+        def finish(task, state, exit_code):
+            job = backend.jobs.pop(task.state['slurm_job_id'])
+            job.job_data = {'JobID': job.jid, 'State': state,
+                            'ExitCode': exit_code, '_steps': []}
+            job.event.set()
+            return runner.loop.run_until_complete(futures[task.name])
+
+        # Successors are submitted up to 2 levels ahead of complete tasks,
+        # and wait for their predecessor jobs in the queue
+        a, b, c = spawn(), spawn(), spawn()
+        self.assertIsNone(next(it))
+        self.assertEqual([t.state.get('submit_ahead') for t in (a, b, c)],
+                         [None, 1, 2])
+        with open('args.1') as fp:
+            args = fp.read().split()
+        self.assertIn('--dependency=afterok:500', args)
+        self.assertIn('--kill-on-invalid-dep=yes', args)
+        with open('args.0') as fp:
+            self.assertNotIn('--dependency', fp.read())
+
+        # Failures skip the jobs held for them, Slurm cancels those
+        finish(a, 'FAILED', '1:0')
+        wf.graph.skip_descendants(a)
+        self.assertTrue(finish(b, 'CANCELLED', '0:0').is_skipped())
+        self.assertTrue(finish(c, 'CANCELLED', '0:0').is_skipped())
+        self.assertEqual(wf.tasks['d'].status, 'skipped')
+
+    def test_fake_slurm(self):
+        from jetstream import fakeslurm
+        wf = jetstream.Workflow()
+        wf.new_task(name='hello', cmd='echo hello', stdout='hello.log')
+        for i in range(3):
+            wf.new_task(name=f'fan{i}', cmd=f'echo {i}', after='hello',
+                        stdout=f'fan{i}.log')
+        wf.new_task(name='fail', cmd='exit 3', after='fan0')
+        wf.new_task(name='skipped', cmd='true', after='fail')
+        wf.new_task(name='slow', cmd='sleep 10', walltime='00:00:01')
+
+        with fakeslurm.FakeSlurm('slurm', cpus=2) as cluster:
+            params = cluster.executables()
+            params.update({
+                '()': 'jetstream.backends.slurm.SlurmBackend',
+                'sacct_frequency': 0.2,
+                'sacct_fields': ['JobID', 'State', 'Elapsed'],
+                'array_delay': 0.1,
+                'submit_ahead': 1,
+            })
+            jetstream.settings.set({'backends': {'fake_slurm': params}})
+            runner = jetstream.Runner(backend='fake_slurm')
+            runner.start(workflow=wf)
+
+        status = {t.name: t.status for t in wf.tasks.values()}
+        self.assertEqual(status, {
+            'hello': 'complete', 'fan0': 'complete', 'fan1': 'complete',
+            'fan2': 'complete', 'fail': 'failed', 'skipped': 'skipped',
+            'slow': 'failed'})
+        self.assertEqual(wf.tasks['fail'].state['returncode'], 3)
+        self.assertEqual(wf.tasks['slow'].state['slurm_sacct']['State'],
+                         'TIMEOUT')
+        # The fan out was submitted as one array held for hello
+        self.assertIn('slurm_dependencies', wf.tasks['fan2'].state)
+        self.assertIn('_', wf.tasks['fan2'].state['slurm_job_id'])
+        for i in range(3):
+            with open(f'fan{i}.log') as fp:
+                self.assertEqual(fp.read(), f'{i}\n')
+
+    def test_slurm_spool(self):
+        from jetstream import fakeslurm
+        wf = jetstream.Workflow()
+        wf.new_task(name='hello', cmd='echo hello', stdout='hello.log')
+        for i in range(3):
+            wf.new_task(name=f'fan{i}', cmd=f'echo {i}; exit {i}',
+                        after='hello', stdout=f'fan{i}.log')
+        wf.new_task(name='slow', cmd='sleep 10', walltime='00:00:01')
+
+        with fakeslurm.FakeSlurm('slurm', cpus=4) as cluster:
+            params = cluster.executables()
+            params.update({
+                '()': 'jetstream.backends.slurm.SlurmBackend',
+                'sacct_frequency': 60,
+                'sacct_fields': ['JobID', 'State', 'Elapsed', 'TotalCPU'],
+                'array_delay': 0.1,
+                'spool': True,
+                'spool_dir': 'spool',
+                'spool_scan_interval': 0.5,
+                'spool_reconcile_frequency': 3,
+            })
+            jetstream.settings.set({'backends': {'fake_slurm': params}})
+            runner = jetstream.Runner(backend='fake_slurm')
+            start = time.time()
+            runner.start(workflow=wf)
+            elapsed = time.time() - start
+
+        status = {t.name: t.status for t in wf.tasks.values()}
+        self.assertEqual(status, {
+            'hello': 'complete', 'fan0': 'complete', 'fan1': 'failed',
+            'fan2': 'failed', 'slow': 'failed'})
+        self.assertEqual(wf.tasks['fan2'].state['returncode'], 2)
+        # Tasks are completed from exit records, without waiting for sacct,
+        # the timed out job has no record and is found by reconciliation
+        self.assertLess(elapsed, 30)
+        self.assertEqual(wf.tasks['slow'].state['slurm_sacct']['State'],
+                         'TIMEOUT')
+        self.assertIn('_', wf.tasks['fan1'].state['slurm_job_id'])
+        # Cpu times have the same format as sacct
+        self.assertRegex(wf.tasks['hello'].state['slurm_sacct']['TotalCPU'],
+                         r'^\d\d:\d\d:\d\d\.\d{3}$')
+        self.assertEqual(os.listdir('spool'), [])
+        with open('fan1.log') as fp:
+            self.assertEqual(fp.read(), '1\n')
+
+    def test_slurm_reattach(self):
+        from jetstream import fakeslurm
+        wf = jetstream.Workflow()
+        wf.new_task(name='running', cmd='sleep 2; echo running',
+                    stdout='running.log')
+        wf.new_task(name='done', cmd='echo done', stdout='done.log')
+        wf.new_task(name='failed', cmd='exit 2')
+        wf.new_task(name='gone', cmd='echo gone', stdout='gone.log')
+        wf.new_task(name='after', cmd='echo after', after='running')
+
+        with fakeslurm.FakeSlurm('slurm', cpus=4) as cluster:
+            params = cluster.executables()
+
+            def submit(task):
+                args = [params['sbatch_executable'], '--parsable',
+                        '-o', task.directives.get('stdout', '/dev/null'),
+                        '--wrap', task.directives['cmd']]
+                return subprocess.run(
+                    args, check=True, stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE, universal_newlines=True
+                ).stdout.strip()
+
+            # A runner stopped while these tasks were in flight
+            jobs = {'gone': '999999'}
+            for name in ('running', 'done', 'failed'):
+                jobs[name] = submit(wf.tasks[name])
+            for name, jid in jobs.items():
+                wf.tasks[name].pending()
+                wf.tasks[name].state.update(
+                    slurm_job_id=jid, slurm_submitted=time.time())
+
+            time.sleep(1)
+            wf.resume()
+
+            params.update({
+                '()': 'jetstream.backends.slurm.SlurmBackend',
+                'sacct_frequency': 0.2,
+                'sacct_fields': ['JobID', 'State'],
+                'array_delay': 0.1,
+            })
+            jetstream.settings.set({'backends': {'fake_slurm': params}})
+            runner = jetstream.Runner(backend='fake_slurm')
+            runner.start(workflow=wf)
+
+        status = {t.name: t.status for t in wf.tasks.values()}
+        self.assertEqual(status, {
+            'running': 'complete', 'done': 'complete', 'failed': 'failed',
+            'gone': 'complete', 'after': 'complete'})
+        # Jobs that were still known to Slurm were not submitted again
+        for name in ('running', 'done', 'failed'):
+            self.assertEqual(wf.tasks[name].state['slurm_job_id'], jobs[name])
+            self.assertNotIn('interrupted', wf.tasks[name].state)
+        self.assertNotEqual(wf.tasks['gone'].state['slurm_job_id'], '999999')
+        self.assertEqual(wf.tasks['failed'].state['returncode'], 2)
+        for name in ('running', 'gone'):
+            with open(f'{name}.log') as fp:
+                self.assertEqual(fp.read(), f'{name}\n')
+
+    def test_slurm_sizing(self):
+        from jetstream import fakeslurm, sizing
+        from jetstream.history import History
+        cmd = 'python3 -c "x = bytearray(40 * 2 ** 20)"'
+        history = History('history.sqlite')
+        for i in range(3):
+            t = jetstream.Task(name='grow', cmd=cmd)
+            t.complete(0)
+            t.state['slurm_sacct'] = {'ElapsedRaw': '5', 'MaxRSS': '8M'}
+            history.record(t)
+
+        wf = jetstream.Workflow()
+        wf.new_task(name='grow', cmd=cmd, mem='1G', walltime='10')
+
+        with fakeslurm.FakeSlurm('slurm', cpus=2) as cluster:
+            params = cluster.executables()
+            params.update({
+                '()': 'jetstream.backends.slurm.SlurmBackend',
+                'sacct_frequency': 0.2,
+                'array_delay': 0.1,
+                'sizing': True,
+                'sizing_min_count': 3,
+                'sizing_min_mem': '8M',
+                'sizing_min_walltime': '1',
+            })
+            jetstream.settings.set({'backends': {'fake_slurm': params}})
+            runner = jetstream.Runner(backend='fake_slurm', history=history)
+            runner.start(workflow=wf)
+
+        # Sized from the history to 10M, then raised after each OOM
+        task = wf.tasks['grow']
+        self.assertEqual(task.status, 'complete')
+        self.assertEqual(task.state['slurm_resources'],
+                         {'mem': '80M', 'walltime': '0-00:01:00'})
+        self.assertEqual(task.state['slurm_escalations'], 3)
+        self.assertIn('MaxRSS', task.state['slurm_sacct'])
+
+        # Limits go back to the directive instead of past it
+        policy = sizing.SizingPolicy(lambda t: None, lambda t: None)
+        task = jetstream.Task(cmd='true', walltime='60')
+        task.state['slurm_resources'] = {'walltime': '20'}
+        self.assertTrue(policy.escalate(task, 'TIMEOUT'))
+        self.assertEqual(task.state['slurm_resources'],
+                         {'walltime': '0-00:40:00'})
+        self.assertTrue(policy.escalate(task, 'TIMEOUT'))
+        self.assertEqual(task.state['slurm_resources'], {})
+        self.assertFalse(policy.escalate(task, 'TIMEOUT'))
+        self.assertFalse(policy.escalate(task, 'FAILED'))
+
+    def test_slurm_partition_routing(self):
+        from jetstream import fakeslurm, routing
+        wf = jetstream.Workflow()
+        for i in range(4):
+            wf.new_task(name=f'short{i}', cmd='true', walltime='10')
+        wf.new_task(name='long', cmd='true', walltime='60')
+        wf.new_task(name='pinned', cmd='true', walltime='10',
+                    sbatch_args=['-p', 'short'])
+
+        with fakeslurm.FakeSlurm('slurm', partitions='short:1::30,long:2',
+                                 partition='short') as cluster:
+            params = cluster.executables()
+            params.update({
+                '()': 'jetstream.backends.slurm.SlurmBackend',
+                'sacct_frequency': 0.2,
+                'array_delay': 0.1,
+                'sacct_fields': ['Partition'],
+                'partitions': ['short', 'long'],
+            })
+            jetstream.settings.set({'backends': {'fake_slurm': params}})
+            runner = jetstream.Runner(backend='fake_slurm')
+            runner.start(workflow=wf)
+
+        used = set()
+        for task in wf.tasks.values():
+            self.assertEqual(task.status, 'complete')
+            partition = task.state['slurm_sacct']['Partition']
+            self.assertEqual(
+                task.state.get('slurm_partition', 'short'), partition)
+            used.add(partition)
+
+        # Over the time limit of short, and given by sbatch_args
+        self.assertEqual(wf.tasks['long'].state['slurm_partition'], 'long')
+        self.assertNotIn('slurm_partition', wf.tasks['pinned'].state)
+        self.assertEqual(used, {'short', 'long'})
+
+        # Jobs routed between snapshots count as pending
+        partitions = routing.parse_sinfo(
+            'short|up|30:00|0/1/0/1|1|1000\n'
+            'long|up|infinite|0/1/0/1|1|4000\n'
+            'long|up|infinite|1/1/1/3|2+|8000\n')
+        self.assertEqual(partitions['long'].cpus, 3)
+        self.assertEqual(partitions['long'].idle_cpus, 2)
+        self.assertEqual(partitions['long'].node_mem, 8000)
+        routing.parse_pending('long|1\nother,short|4\n', partitions)
+        self.assertEqual(partitions['short'].pending_cpus, 4)
+
+        router = routing.PartitionRouter(['short', 'long'])
+        self.assertEqual(router.route(), 'short')
+        partitions['short'].pending_cpus = 0
+        router.update(partitions)
+        self.assertEqual([router.route() for i in range(5)],
+                         ['short', 'long', 'long', 'long', 'short'])
+        self.assertEqual(router.route(walltime=3600), 'long')
+        self.assertIsNone(router.route(mem=16000))
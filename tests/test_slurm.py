@@ -0,0 +1,173 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+from jetstream.backends import slurm
+
+
+class SlurmTests(TestCase):
+    def setUp(self):
+        """ These tests run fake Slurm commands that write files, so setUp
+        creates a temp dir and chdir to it. """
+        super(SlurmTests, self).setUp()
+        self._original_dir = os.getcwd()
+        self._temp_dir = tempfile.TemporaryDirectory()
+        os.chdir(self._temp_dir.name)
+
+    def tearDown(self):
+        os.chdir(self._original_dir)
+        self._temp_dir.cleanup()
+
+    def test_slurm_submit_queue(self):
+        sbatch = os.path.join(self._temp_dir.name, 'sbatch')
+        with open(sbatch, 'w') as fp:
+            fp.write(
+                '#!/bin/bash\n'
+                'cat > /dev/null\n'
+                'n=$(cat calls 2>/dev/null || echo 0); echo $((n+1)) > calls\n'
+                'if [ -e limit ]; then rm limit\n'
+                '  echo "error: QOSMaxSubmitJobPerUserLimit" >&2; exit 1; fi\n'
+                'if [ -e fail ]; then rm fail; echo "timed out" >&2; exit 1; fi\n'
+                'echo "$((n+100));cluster"\n'
+            )
+        os.chmod(sbatch, 0o755)
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(loop.close)
+        ticks = []
+
+        async def ticker():
+            while 1:
+                ticks.append(time.monotonic())
+                await asyncio.sleep(0.01)
+
+        async def submit_all(queue, n):
+            return await asyncio.gather(
+                *[queue.submit([sbatch], 'true') for i in range(n)])
+
+        # Rate limited, and the loop keeps running while submitting
+        queue = slurm.SubmitQueue(rate=40, burst=1, max_submit_jobs=100)
+        t = loop.create_task(ticker())
+        start = time.monotonic()
+        jids = loop.run_until_complete(submit_all(queue, 10))
+        self.assertGreaterEqual(time.monotonic() - start, 9 / 40)
+        self.assertEqual(sorted(jids, key=int),
+                         [str(i) for i in range(100, 110)])
+        self.assertGreater(len(ticks), 10)
+        t.cancel()
+
+        # Failures are retried with backoff
+        open('fail', 'w').close()
+        queue = slurm.SubmitQueue(
+            rate=None, retry_delay=0.01, max_submit_jobs=100)
+        loop.run_until_complete(submit_all(queue, 1))
+        self.assertEqual(queue.failures, 1)
+
+        # Jobs over the limit wait until a job is released
+        queue = slurm.SubmitQueue(rate=None, max_submit_jobs=2)
+        held = loop.create_task(submit_all(queue, 3))
+        loop.run_until_complete(asyncio.sleep(0.5))
+        self.assertFalse(held.done())
+        self.assertEqual(queue.submitted, 2)
+        queue.release()
+        loop.run_until_complete(held)
+        self.assertEqual(queue.submitted, 3)
+
+        # A submit limit error from sbatch holds the job instead of failing
+        open('limit', 'w').close()
+        queue = slurm.SubmitQueue(
+            rate=None, retry_delay=0.01, max_submit_jobs=100)
+        loop.run_until_complete(submit_all(queue, 1))
+        self.assertEqual((queue.holds, queue.failures), (1, 0))
+
+    def test_slurm_poll(self):
+        d = slurm.sacct_delimiter
+        scripts = {
+            'sbatch': 'exit 0\n',
+            'squeue': 'echo "$@" > squeue.args\n'
+                      'echo "10 RUNNING"; echo "12_1 PENDING"\n',
+            'sacct': f'echo "$@" > sacct.args\n'
+                     f'printf "JobID{d}State{d}ExitCode\\n'
+                     f'11{d}FAILED{d}2:0\\n12_0{d}COMPLETED{d}0:0\\n"\n',
+        }
+        for name, script in scripts.items():
+            with open(name, 'w') as fp:
+                fp.write('#!/bin/bash\n' + script)
+            os.chmod(name, 0o755)
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.addCleanup(loop.close)
+        backend = slurm.SlurmBackend(
+            sbatch_executable=os.path.abspath('sbatch'),
+            sacct_executable=os.path.abspath('sacct'),
+            squeue_executable=os.path.abspath('squeue'),
+            sacct_fields=['JobID', 'Elapsed'], max_submit_jobs=100)
+
+        now = time.time()
+        for jid in ('10', '11', '12_0', '12_1'):
+            backend.jobs[jid] = slurm.SlurmBatchJob(jid)
+            backend.jobs[jid].submitted = now
+
+        data = loop.run_until_complete(backend.poll())
+
+        # Queued jobs are updated from squeue, the others come from sacct
+        self.assertEqual(backend.jobs['10'].job_data['State'], 'RUNNING')
+        self.assertTrue(backend.jobs['12_1'].is_pending())
+        self.assertEqual(data['11']['State'], 'FAILED')
+        self.assertEqual(data['12_0']['State'], 'COMPLETED')
+
+        with open('sacct.args') as fp:
+            args = fp.read().split()
+        self.assertEqual(args[args.index('--format') + 1],
+                         'JobID,State,ExitCode,Elapsed')
+        self.assertEqual(sorted(args[args.index('-j') + 1].split(',')),
+                         ['11', '12'])
+        self.assertIn('--starttime', args)
+
+
+class SlurmScheduleTests(TestCase):
+    def test_slurm_poll_schedule(self):
+        backend = slurm.SlurmBackend(
+            sbatch_executable=shutil.which('true'), sacct_frequency=10,
+            sacct_max_staleness=5000, sacct_backoff=0.1,
+            spool_reconcile_frequency=600, max_submit_jobs=100)
+        now = 100000
+
+        def due(submitted, started=None, expected=None, walltime=None,
+                spool_dir=None):
+            job = slurm.SlurmBatchJob('1')
+            job.submitted = submitted
+            job.started = started
+            job.expected = expected
+            job.walltime = walltime
+            job.spool_dir = spool_dir
+            backend.schedule_check(job, now)
+            return job.next_check - now
+
+        # New jobs are checked often, long running ones less and less
+        self.assertEqual(due(now - 5), 10)
+        self.assertEqual(due(now - 2000), 200)
+        self.assertEqual(due(now - 5000, now - 3000), 300)
+        self.assertEqual(due(now - 10 ** 6), 5000)
+        # Expected remaining time, walltime and exit records
+        self.assertEqual(due(now - 600, now - 600, expected=36600), 3600)
+        self.assertEqual(due(now - 600, now - 100, expected=9000,
+                             walltime=300), 200)
+        self.assertEqual(due(now - 5, spool_dir='spool'), 600)
+
+        # Added jobs can move the next poll earlier, never later
+        backend._next_update = time.time() + 1000
+        for jid in ('1', '2'):
+            job = slurm.SlurmBatchJob(jid)
+            job.submitted = time.time()
+            backend.track(job)
+        self.assertLess(backend._next_update, time.time() + 11)
+
+        # Polls are kept apart by the latency of the last ones
+        backend._last_poll = time.time()
+        backend._latency = 4
+        self.assertGreater(backend.next_poll(), time.time() + 39)
@@ -176,3 +176,10 @@ class TaskBasics(TestCase):
         t2 = tasks.from_dict(t1.to_dict())
 
         self.assertEqual(t1, t2)
+
+    def test_call_identity(self):
+        a = Task(call='print', args=['a'])
+        b = Task(call='print', args=['b'])
+        self.assertNotEqual(a.identity, b.identity)
+        self.assertEqual(Task(cmd='true', args=['a']).identity,
+                         Task(cmd='true').identity)
@@ -163,3 +163,29 @@ class UtilsLoaderParserTests(TestCase):
         self.run_parser_tst(data, parser, expected)
         self.run_loader_tst(data, loader, expected)
 
+
+    def test_parse_walltime(self):
+        parse = jetstream.utils.parse_walltime
+        self.assertEqual(parse('90'), 5400)
+        self.assertEqual(parse('1:30'), 90)
+        self.assertEqual(parse('01:00:05'), 3605)
+        self.assertEqual(parse('2-0'), 172800)
+        self.assertEqual(parse('1-01:02:03'), 90123)
+        self.assertIsNone(parse(None))
+
+    def test_parse_duration(self):
+        parse = jetstream.utils.parse_duration
+        self.assertEqual(parse(30), 30)
+        self.assertEqual(parse('30'), 30)
+        self.assertEqual(parse('2.5'), 2.5)
+        self.assertEqual(parse('1:30'), 90)
+        self.assertEqual(parse('2-0'), 172800)
+        self.assertIsNone(parse(''))
+
+    def test_parse_mem(self):
+        parse = jetstream.utils.parse_mem
+        self.assertEqual(parse('512'), 512)
+        self.assertEqual(parse('2G'), 2048)
+        self.assertEqual(parse('1024K'), 1)
+        self.assertEqual(parse('4gb'), 4096)
+        self.assertIsNone(parse(None))
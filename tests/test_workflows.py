@@ -329,3 +329,52 @@ class WorkflowSaving(TestCase):
         self.assertTrue(wf2['task50'].is_complete())
         self.assertEqual(wf2['task42'].state.get('foo'), 'bar')
 
+
+
+class WorkflowSimulation(TestCase):
+    def test_simulate_chain(self):
+        wf = jetstream.Workflow()
+        wf.new_task(name='a', cmd='a', expected_duration=10)
+        wf.new_task(name='b', cmd='b', after='a', expected_duration='20')
+        wf.new_task(name='c', cmd='c', after='b', walltime='0:30')
+        wf.new_task(name='done', after='c')
+
+        model = jetstream.simulation.local_model(cpus=4)
+        report = jetstream.simulation.simulate(wf, model)
+
+        self.assertEqual(report['makespan'], 60)
+        self.assertEqual(report['critical_path']['tasks'],
+                         ['a', 'b', 'c', 'done'])
+        self.assertEqual(report['bottleneck'], 'dependencies')
+
+    def test_simulate_resources(self):
+        wf = jetstream.Workflow()
+        for i in range(8):
+            wf.new_task(name=f'task{i}', cmd='x', cpus=2, expected_duration=10)
+
+        model = jetstream.simulation.local_model(cpus=4)
+        report = jetstream.simulation.simulate(wf, model, bins=4)
+
+        self.assertEqual(report['makespan'], 40)
+        self.assertEqual(report['bottleneck'], 'resources')
+        self.assertEqual(report['utilisation']['mean'], 1)
+        self.assertEqual(report['resource_wait']['total'], 120)
+
+    def test_simulate_slurm_model(self):
+        wf = jetstream.Workflow()
+        for i in range(4):
+            wf.new_task(name=f'task{i}', cmd='x', expected_duration=10)
+        wf.new_task(name='big', cmd='x', cpus=8)
+        wf['task0'].complete()
+
+        model = jetstream.simulation.slurm_model(
+            nodes=2, node_cpus=4, queue_delay=5)
+
+        with self.assertRaises(ValueError):
+            jetstream.simulation.simulate(wf, model)
+
+        wf.pop('big')
+        report = jetstream.simulation.simulate(wf, model)
+
+        self.assertEqual(report['simulated'], 3)
+        self.assertEqual(report['makespan'], 15)